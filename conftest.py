@@ -0,0 +1,77 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+pytest setup for the tests in src/ (python -m pytest from this folder).
+
+They run without Anki against the shim in tools/_shim.py. The source folder is
+imported as the package "src" without its __init__, which sets up the GUI.
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "tools"))
+import _shim  # noqa: E402
+
+_shim.install_fake_modules()  # only if Anki isn't installed
+_shim.load_package("src")
+
+
+@pytest.fixture
+def mw(tmp_path, monkeypatch):
+    """FakeMW with an empty shim collection, col.db commits every statement
+
+    The undo journal and the log go to tmp_path instead of src/user_files.
+    """
+    from src import instrumentation, journal
+    monkeypatch.setattr(journal, "journal_path", str(tmp_path / "last_reorganization.json"))
+    monkeypatch.setattr(instrumentation, "log_path", str(tmp_path / "note_organizer.log"))
+    monkeypatch.setattr(instrumentation.log, "handlers", [])
+    mw = _shim.setup(str(tmp_path / "collection.anki2"), package="src")
+    yield mw
+    mw.col.close()
+    for handler in instrumentation.log.handlers:
+        handler.close()
+
+
+@pytest.fixture
+def snapshot():
+    """snapshot(db): the collection without what a revert can't restore (guids, mod, usn)
+
+    Graves only count if they are for notes or cards that exist, those would
+    delete them with the next sync.
+    """
+    def snapshot(db):
+        notes = db.all("select id, mid, tags, flds, sfld, csum from notes order by id")
+        cards = db.all("select id, nid, did, ord, type, queue, due, odue, odid, ivl from cards order by id")
+        graves = db.all(
+            "select oid, type from graves where (type = 1 and oid in (select id from notes)) "
+            "or (type = 0 and oid in (select id from cards)) order by oid")
+        return notes, cards, graves
+    return snapshot
+
+
+@pytest.fixture
+def plan_for(mw):
+    """plan_for(nids) -> (rearranger, plan) that moves, creates, dupes and deletes notes
+
+    Without a browser the source cards are looked up like from the reviewer.
+    """
+    from src.rearranger import Rearranger
+
+    def plan_for(nids):
+        rows = [str(nid) for nid in reversed(nids[:4])] + [str(nid) for nid in nids[4:]]
+        rows.insert(2, "New: Same note type as previous")
+        rows.insert(5, "Dupe (sched): {}".format(nids[5]))
+        rows[-1] = "Del: " + rows[-1]
+        card = mw.col.getCard(mw.col.db.scalar("select id from cards order by id limit 1"))
+        rearranger = Rearranger(card=card)
+        return rearranger, rearranger.plan(rows, None, [], repos=True)
+    return plan_for
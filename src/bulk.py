@@ -0,0 +1,211 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Set-based database operations that apply a whole plan in a few statements
+instead of one add/delete/flush cycle per note.
+
+The functions only take a DBProxy-like `db` (execute, executemany, list, scalar)
+so that they work on the collection of a running Anki as well as on a plain
+SQLite connection wrapper.
+"""
+
+from contextlib import contextmanager
+
+from anki.utils import guid64, ids2str
+
+
+# graves.type for removed cards and notes, see anki/consts.py REM_CARD, REM_NOTE
+REM_CARD = 0
+REM_NOTE = 1
+
+
+@contextmanager
+def savepoint(db, name):
+    """Run the statements of the block in a savepoint
+
+    On an exception everything since the start of the block is rolled back.
+    Savepoints nest, only the outermost one ends up in a commit (which Anki
+    does on its own schedule), so chunks inside a run don't cost a sync of
+    the journal each.
+    """
+    db.execute("savepoint " + name)
+    try:
+        yield
+    except BaseException:
+        db.execute("rollback to " + name)
+        db.execute("release " + name)
+        raise
+    db.execute("release " + name)
+
+
+def chunked(items, size):
+    """Consecutive lists of at most size items, one list for a size of 0 or None"""
+    items = list(items)
+    if not size or size <= 0:
+        size = len(items) or 1
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def renumber_notes(db, nid_map, usn, mod, flds=None, chunk_size=None, on_chunk=None):
+    """Change the nids of all notes in nid_map ({old_nid: new_nid}) at once
+
+    All new nids must be unassigned. The moved notes get a fresh guid and a grave
+    for the old nid so that the change goes out with a normal sync. Cards keep
+    their id and are only attached to the new nid.
+
+    flds: optional {old_nid: fields joined by \\x1f} written in the same
+    statement, e.g. for the backup of the original nid. They must not change
+    the sort field or the first field because sfld and csum aren't updated.
+
+    With chunk_size the notes are renumbered in chunks of that many notes, each
+    in its own savepoint. on_chunk(count) is called after every chunk and may
+    raise to stop, then all chunks are rolled back.
+    """
+    if not nid_map:
+        return 0
+    flds = flds or {}
+    db.execute("drop table if exists temp.no_nid_map")
+    db.execute(
+        "create temp table no_nid_map "
+        "(old integer primary key, new integer not null, guid text not null, flds text)")
+    with savepoint(db, "no_renumber"):
+        for chunk in chunked(nid_map.items(), chunk_size):
+            with savepoint(db, "no_renumber_chunk"):
+                db.execute("delete from no_nid_map")
+                db.executemany(
+                    "insert into no_nid_map (old, new, guid, flds) values (?, ?, ?, ?)",
+                    [(old, new, guid64(), flds.get(old)) for old, new in chunk])
+                db.execute(
+                    "update cards set nid = (select new from no_nid_map where old = cards.nid), "
+                    "mod = ?, usn = ? where nid in (select old from no_nid_map)", mod, usn)
+                db.execute(
+                    "update notes set id = (select new from no_nid_map where old = notes.id), "
+                    "guid = (select guid from no_nid_map where old = notes.id), "
+                    "flds = coalesce((select flds from no_nid_map where old = notes.id), flds), "
+                    "mod = ?, usn = ? where id in (select old from no_nid_map)", mod, usn)
+                db.execute(
+                    "insert into graves (usn, oid, type) "
+                    "select ?, old, ? from no_nid_map", usn, REM_NOTE)
+            if on_chunk is not None:
+                on_chunk(len(chunk))
+    db.execute("drop table temp.no_nid_map")
+    return len(nid_map)
+
+
+def delete_notes(db, nids, usn):
+    """Remove the notes in nids and their cards with a grave for each
+
+    For a collection that isn't open in Anki, a running Anki uses
+    col.remove_notes.
+    """
+    if not nids:
+        return 0
+    nids = ids2str(nids)
+    db.execute(
+        "insert into graves (usn, oid, type) "
+        "select ?, id, ? from cards where nid in " + nids, usn, REM_CARD)
+    db.execute(
+        "insert into graves (usn, oid, type) "
+        "select ?, id, ? from notes where id in " + nids, usn, REM_NOTE)
+    db.execute("delete from cards where nid in " + nids)
+    count = db.scalar("select count() from notes where id in " + nids)
+    db.execute("delete from notes where id in " + nids)
+    return count
+
+
+def reposition_new_cards(db, nidlist, usn, mod, created=()):
+    """Give the new cards of nidlist ascending due positions in the order of nidlist
+
+    Unlike sched.sortCards(..., shift=True) no other card is touched: the
+    positions the notes already had are handed out again in the order of
+    nidlist, so the reorganized notes keep their place relative to the rest of
+    the new queue. Notes in created (appended at the end of the queue by Anki)
+    share the position of the note in front of them and come after it because
+    their cards have bigger ids. Cards of one note keep their distance.
+
+    Returns the number of cards whose position changed.
+    """
+    if not nidlist:
+        return 0
+    rows = db.all(
+        "select id, nid, odid, case when odid then odue else due end "
+        "from cards where type = 0 and nid in " + ids2str(nidlist))
+    if not rows:
+        return 0
+    note_pos = {}
+    for _, nid, _, pos in rows:
+        if nid not in note_pos or pos < note_pos[nid]:
+            note_pos[nid] = pos
+    notes = [nid for nid in dict.fromkeys(nidlist) if nid in note_pos]
+    created = set(created)
+    anchors = [nid for nid in notes if nid not in created] or notes
+    slots = iter(sorted(note_pos[nid] for nid in anchors))
+    anchors = set(anchors)
+    new_pos = {}
+    previous = None
+    waiting = []  # created notes in front of the first anchor
+    for nid in notes:
+        if nid in anchors:
+            previous = next(slots)
+            new_pos[nid] = previous
+            for other in waiting:
+                new_pos[other] = previous
+            waiting = []
+        elif previous is None:
+            waiting.append(nid)
+        else:
+            new_pos[nid] = previous
+    due, odue = [], []
+    for cid, nid, odid, pos in rows:
+        pos_after = pos - note_pos[nid] + new_pos[nid]
+        if pos_after != pos:
+            (odue if odid else due).append((pos_after, mod, usn, cid))
+    if due:
+        db.executemany("update cards set due = ?, mod = ?, usn = ? where id = ?", due)
+    if odue:
+        db.executemany("update cards set odue = ?, mod = ?, usn = ? where id = ?", odue)
+    return len(due) + len(odue)
+
+
+def restore_notes(db, notes, cards, usn, mod):
+    """Insert deleted notes and cards again from their rows
+
+    notes and cards are rows of journal.NOTE_COLUMNS and journal.CARD_COLUMNS.
+    They get a new mod and usn so that they go out with the next sync, graves
+    of them that weren't synced yet are removed.
+    """
+    if not notes:
+        return 0
+    notes = [row[:3] + [mod, usn] + row[5:] for row in map(list, notes)]
+    cards = [row[:4] + [mod, usn] + row[6:] for row in map(list, cards)]
+    db.executemany(
+        "insert into notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data) "
+        "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", notes)
+    if cards:
+        db.executemany(
+            "insert into cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, "
+            "reps, lapses, left, odue, odid, flags, data) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", cards)
+    db.execute(
+        "delete from graves where usn = -1 and type = ? and oid in " + ids2str(row[0] for row in notes),
+        REM_NOTE)
+    db.execute(
+        "delete from graves where usn = -1 and type = ? and oid in " + ids2str(row[0] for row in cards),
+        REM_CARD)
+    return len(notes)
+
+
+def set_positions(db, positions, usn, mod):
+    """Set due and odue of new cards from {cid: (due, odue)}"""
+    if not positions:
+        return 0
+    db.executemany(
+        "update cards set due = ?, odue = ?, mod = ?, usn = ? where id = ? and type = 0",
+        [(due, odue, mod, usn, cid) for cid, (due, odue) in positions.items()])
+    return len(positions)
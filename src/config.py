@@ -10,6 +10,13 @@ def gc(arg, fail=False):
     return fail
 
 
+def backup_field():
+    """Name of the field the original nids are stored in or None"""
+    if not gc("nids: backup nids"):
+        return None
+    return gc("nids: backup field") or None
+
+
 def mpp(arg):
     pp(arg)
 
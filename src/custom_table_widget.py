@@ -9,78 +9,344 @@ License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.
 
 from aqt.qt import *
 
-class NoteTable(QTableWidget):
-    """Custom QTableWidget with drag-and-drop support"""
+from .no_consts import *
+from .row_rope import RowRope
+
+
+# row states
+ROW_NOTE = 0
+ROW_NEW = 1
+ROW_DUPE = 2
+ROW_DEL = 3
+
+
+class NoteRow:
+    """One row of the organizer table
+
+    - text: content of the first column, the nid or an action marker like
+            "New: Basic" which is passed to the Rearranger as it is
+    - state: ROW_NOTE, ROW_NEW, ROW_DUPE or ROW_DEL
+    - moved: row was moved by the user (shown in bold)
+    - item: id of the browser row (cid or nid) the cells are fetched from
+    - cells: browser column contents, None until the row is painted
+    """
+    __slots__ = ("text", "state", "moved", "item", "cells")
+
+    def __init__(self, text, state=ROW_NOTE, item=None, cells=None):
+        self.text = text
+        self.state = state
+        self.moved = False
+        self.item = item
+        self.cells = cells
+
+
+    def copy(self, text, state):
+        return NoteRow(text, state, self.item, self.cells)
+
+
+class NoteTableModel(QAbstractTableModel):
+    """Table model over NoteRow objects
+
+    The browser columns are only fetched (via fetcher(item)) and formatted when
+    a row is painted so that opening the organizer doesn't depend on the number
+    of rows. The row order is kept in a RowRope so that moving blocks of rows
+    doesn't shift the rest of the table.
+    """
+
+    colors = {
+        ROW_NEW: Qt.GlobalColor.darkGreen,
+        ROW_DUPE: Qt.GlobalColor.darkBlue,
+        ROW_DEL: Qt.GlobalColor.darkRed,
+    }
+
+    def __init__(self, parent=None):
+        QAbstractTableModel.__init__(self, parent)
+        self.headers = []
+        self.rows = RowRope()
+        self.fetcher = None
+        self._nid_nodes = None  # {nid text: [rope nodes]}, built on demand, see nidRow
+        self._node_nids = {}  # {rope node: its key in _nid_nodes}
+        self.bold = QFont()
+        self.bold.setBold(True)
+
+
+    def setRows(self, headers, rows, fetcher=None):
+        self.beginResetModel()
+        self.headers = headers
+        self.rows = RowRope(rows)
+        self.fetcher = fetcher
+        self._nid_nodes = None
+        self._node_nids = {}
+        self.endResetModel()
+
+
+    def rowCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.rows)
+
+
+    def columnCount(self, parent=QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.headers)
+
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role != Qt.ItemDataRole.DisplayRole:
+            return None
+        if orientation == Qt.Orientation.Horizontal:
+            if section < len(self.headers):
+                return self.headers[section]
+            return None
+        return str(section + 1)
+
+
+    def cells(self, row):
+        if row.cells is None:
+            if self.fetcher and row.item is not None:
+                row.cells = self.fetcher(row.item)
+            else:
+                row.cells = []
+        return row.cells
+
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        if role == Qt.ItemDataRole.DisplayRole:
+            col = index.column()
+            if col == 0:
+                return row.text
+            cells = self.cells(row)
+            if col - 1 >= len(cells):
+                return None
+            value = cells[col - 1]
+            if value is None:
+                return None
+            return str(value)
+        elif role == Qt.ItemDataRole.FontRole:
+            if row.moved or row.state != ROW_NOTE:
+                return self.bold
+        elif role == Qt.ItemDataRole.ForegroundRole:
+            color = self.colors.get(row.state)
+            if color is not None:
+                return QBrush(color)
+        return None
+
+
+    def flags(self, index):
+        flags = Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable | Qt.ItemFlag.ItemIsDragEnabled
+        if not index.isValid():
+            flags |= Qt.ItemFlag.ItemIsDropEnabled
+        return flags
+
+
+    def supportedDropActions(self):
+        return Qt.DropAction.MoveAction
+
+
+    def supportedDragActions(self):
+        return Qt.DropAction.MoveAction
+
+
+    def nidRow(self, nid):
+        """First row whose text ends with nid (e.g. "123" or "Del: 123") or None
+
+        The lookup table holds the rope nodes of the rows, whose positions are
+        found in O(log n), so it stays valid when rows are moved. It's built
+        on the first lookup and then updated with the inserted, removed and
+        changed rows.
+        """
+        if self._nid_nodes is None:
+            self._nid_nodes = {}
+            self._node_nids = {}
+            self.indexNodes(self.rows.nodes())
+        nodes = self._nid_nodes.get(str(nid))
+        if not nodes:
+            return None
+        return min(self.rows.position(node) for node in nodes)
+
+
+    def indexNodes(self, nodes):
+        """Add the rope nodes to the lookup table of nidRow"""
+        if self._nid_nodes is None:
+            return
+        for node in nodes:
+            key = node.row.text.rpartition(" ")[2]
+            self._nid_nodes.setdefault(key, []).append(node)
+            self._node_nids[node] = key
+
+
+    def unindexNodes(self, nodes):
+        """Remove the rope nodes from the lookup table of nidRow"""
+        if self._nid_nodes is None:
+            return
+        for node in nodes:
+            key = self._node_nids.pop(node, None)
+            same = self._nid_nodes.get(key)
+            if same is None:
+                continue
+            same.remove(node)
+            if not same:
+                del self._nid_nodes[key]
+
+
+    def rowChanged(self, row):
+        node = self.rows.node(row)
+        self.unindexNodes([node])
+        self.indexNodes([node])
+        self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+
+
+    def insertNoteRows(self, position, rows):
+        self.beginInsertRows(QModelIndex(), position, position + len(rows) - 1)
+        self.indexNodes(self.rows.insert(position, rows))
+        self.endInsertRows()
+
+
+    def removeRowsAt(self, positions):
+        """Remove rows, positions don't have to be contiguous
+
+        Contiguous positions are removed together, from the last block to the first.
+        """
+        positions = sorted(set(positions), reverse=True)
+        i = 0
+        while i < len(positions):
+            last = first = positions[i]
+            i += 1
+            while i < len(positions) and positions[i] == first - 1:
+                first = positions[i]
+                i += 1
+            self.beginRemoveRows(QModelIndex(), first, last)
+            self.unindexNodes(self.rows.delete(first, last + 1))
+            self.endRemoveRows()
+
+
+    def moveRowsTo(self, positions, target):
+        """Move the rows at positions in front of the row at target
+
+        Returns the new position of the first moved row. Each contiguous block
+        of positions is moved with one rope operation and one beginMoveRows.
+        """
+        blocks = []
+        for position in sorted(set(positions)):
+            # a block must not contain target, split it there
+            if blocks and blocks[-1][1] == position and position != target:
+                blocks[-1][1] = position + 1
+            else:
+                blocks.append([position, position + 1])
+        above = [b for b in blocks if b[0] < target]
+        below = [b for b in blocks if b[0] >= target]
+        # blocks above target, the nearest first, end up in front of the
+        # previously moved one. Rows in front of them don't shift.
+        destination = target
+        for start, stop in reversed(above):
+            self.moveBlock(start, stop, destination)
+            destination -= stop - start
+        new_first = destination
+        # blocks below target, the nearest first, end up behind the previously
+        # moved one. Rows behind them don't shift.
+        destination = target
+        for start, stop in below:
+            self.moveBlock(start, stop, destination)
+            destination += stop - start
+        return new_first
+
+
+    def moveBlock(self, start, stop, destination):
+        """Move rows start to stop (exclusive) in front of destination"""
+        if start <= destination <= stop:
+            return  # already there
+        self.beginMoveRows(QModelIndex(), start, stop - 1, QModelIndex(), destination)
+        self.rows.move(start, stop, destination)
+        self.endMoveRows()
+
+
+class NoteTable(QTableView):
+    """Custom QTableView with drag-and-drop support"""
     # adapted from http://stackoverflow.com/a/26311179
     def __init__(self, dialog):
-        QTableWidget.__init__(self)
+        QTableView.__init__(self)
 
         self.dialog = dialog
+        self.note_model = NoteTableModel(self)
+        self.setModel(self.note_model)
         self.setDragEnabled(True)
         self.setAcceptDrops(True)
         self.viewport().setAcceptDrops(True)
         self.setDragDropOverwriteMode(False)
         self.setDropIndicatorShown(True)
 
-        self.setSelectionMode(QAbstractItemView.ExtendedSelection) 
+        self.setSelectionMode(QAbstractItemView.ExtendedSelection)
         self.setSelectionBehavior(QAbstractItemView.SelectRows)
         self.setDragDropMode(QAbstractItemView.InternalMove)
 
         self.setEditTriggers(QAbstractItemView.NoEditTriggers)
 
-        self.moved = []
+        self.moved = {}  # texts of the moved rows in the order they were moved, used as ordered set
+
+
+    def rowCount(self):
+        return self.note_model.rowCount()
+
+
+    def columnCount(self):
+        return self.note_model.columnCount()
+
+
+    def noteRow(self, row):
+        return self.note_model.rows[row]
+
+
+    def nidText(self, row):
+        return self.note_model.rows[row].text
+
+
+    def moveRows(self, rows, target):
+        """Move rows in front of target, mark them as moved and select them"""
+        first = self.note_model.moveRowsTo(rows, target)
+        for row in range(first, first + len(rows)):
+            note_row = self.noteRow(row)
+            note_row.moved = True
+            self.moved.setdefault(note_row.text)
+        self.selectRange(first, first + len(rows) - 1)
+
+
+    def selectRange(self, first, last):
+        selection = QItemSelection(
+            self.note_model.index(first, 0),
+            self.note_model.index(last, self.columnCount() - 1))
+        self.selectionModel().select(selection,
+            QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
 
 
     def dropEvent(self, event):
-        if event.source() == self and (event.dropAction() == Qt.DropAction.MoveAction 
+        if event.source() == self and (event.dropAction() == Qt.DropAction.MoveAction
                         or self.dragDropMode() == QAbstractItemView.InternalMove):
             success, row, col, topIndex = self.dropOn(event)
-            if success:             
-                selRows = self.getSelectedRows()                        
-
-                top = selRows[0]
+            if success:
+                selRows = self.getSelectedRows()
                 dropRow = row
                 if dropRow == -1:
                     dropRow = self.rowCount()
-                offset = dropRow - top
-
-                for i, row in enumerate(selRows):
-                    r = row + offset
-                    if r > self.rowCount() or r < 0:
-                        r = 0
-                    self.insertRow(r)
-
-                selRows = self.getSelectedRows()
-
-                top = selRows[0]
-                offset = dropRow - top                
-                for i, row in enumerate(selRows):
-                    r = row + offset
-                    if r > self.rowCount() or r < 0:
-                        r = 0
-
-                    for col in range(self.columnCount()):
-                        dupe = QTableWidgetItem(self.item(row, col))
-                        font = dupe.font()
-                        font.setBold(True)
-                        dupe.setFont(font)
-                        self.setItem(r, col, dupe)
-                        if col == 0:
-                            value = dupe.text()
-                            if value not in self.moved:
-                                self.moved.append(value)
-
+                if selRows:
+                    self.moveRows(selRows, dropRow)
+                # the rows were moved by the model, don't let Qt remove the
+                # source rows as it does after a MoveAction
+                event.setDropAction(Qt.DropAction.CopyAction)
                 event.accept()
 
         else:
-            QTableView.dropEvent(event)                
+            QTableView.dropEvent(self, event)
 
 
     def getSelectedRows(self):
         sel = self.selectionModel().selectedRows()
         if not sel:
             return None
-        return [i.row() for i in sel]
+        return sorted(i.row() for i in sel)
 
 
     def droppingOnItself(self, event, index):
@@ -89,8 +355,8 @@ class NoteTable(QTableWidget):
         if self.dragDropMode() == QAbstractItemView.InternalMove:
             dropAction = Qt.DropAction.MoveAction
 
-        if (event.source() == self and 
-                event.possibleActions() & Qt.DropAction.MoveAction 
+        if (event.source() == self and
+                event.possibleActions() & Qt.DropAction.MoveAction
                 and dropAction == Qt.DropAction.MoveAction):
             selectedIndexes = self.selectedIndexes()
             child = index
@@ -139,11 +405,11 @@ class NoteTable(QTableWidget):
         if pos.y() - rect.top() < margin:
             r = QAbstractItemView.AboveItem
         elif rect.bottom() - pos.y() < margin:
-            r = QAbstractItemView.BelowItem 
+            r = QAbstractItemView.BelowItem
         elif rect.contains(pos, True):
             r = QAbstractItemView.OnItem
 
         if r == QAbstractItemView.OnItem and not (self.model().flags(index) & Qt.ItemFlag.ItemIsDropEnabled):
             r = QAbstractItemView.AboveItem if pos.y() < rect.center().y() else QAbstractItemView.BelowItem
 
-        return r
\ No newline at end of file
+        return r
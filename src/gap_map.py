@@ -0,0 +1,229 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Map of the unassigned nids of a collection as a list of gaps.
+
+Every gap is a run of consecutive free nids between two assigned ones (the last
+one is open-ended). The gaps are kept in a treap ordered by their first nid,
+each node knows the size of the biggest gap in its subtree, so that questions
+like "first run of at least k free nids after nid X" take O(log n) instead of
+probing nid by nid, which is slow after an import burst of thousands of notes
+within a few seconds. Assigning or freeing a nid splits or joins gaps, also
+in O(log n). See row_rope.py for the same structure ordered by position.
+"""
+
+import random
+
+
+MAX_NID = 2**63 - 1
+
+
+class _Gap:
+    __slots__ = ("start", "end", "priority", "best", "left", "right")
+
+    def __init__(self, start, end, priority):
+        self.start = start  # first free nid
+        self.end = end      # last free nid
+        self.priority = priority
+        self.best = end - start + 1
+        self.left = None
+        self.right = None
+
+
+def _best(node):
+    return node.best if node is not None else 0
+
+
+def _update(node):
+    node.best = max(node.end - node.start + 1, _best(node.left), _best(node.right))
+
+
+def _split(node, key):
+    """Split into the gaps that start before key and the rest"""
+    if node is None:
+        return None, None
+    if node.start < key:
+        left, right = _split(node.right, key)
+        node.right = left
+        _update(node)
+        return node, right
+    left, right = _split(node.left, key)
+    node.left = right
+    _update(node)
+    return left, node
+
+
+def _merge(left, right):
+    """Concatenate two trees, all gaps of left come first"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _first_fitting(node, size):
+    """Leftmost gap with at least size nids"""
+    while node is not None and node.best >= size:
+        if _best(node.left) >= size:
+            node = node.left
+        elif node.end - node.start + 1 >= size:
+            return node
+        else:
+            node = node.right
+    return None
+
+
+def _last_fitting(node, size):
+    """Rightmost gap with at least size nids"""
+    while node is not None and node.best >= size:
+        if _best(node.right) >= size:
+            node = node.right
+        elif node.end - node.start + 1 >= size:
+            return node
+        else:
+            node = node.left
+    return None
+
+
+class GapMap:
+    """Gaps of free nids between low and high (inclusive) around the sorted nids"""
+
+    def __init__(self, nids=(), low=1, high=MAX_NID):
+        self._random = random.Random()
+        gaps = []
+        previous = low - 1
+        for nid in nids:
+            if nid > previous + 1:
+                gaps.append((previous + 1, min(nid - 1, high)))
+            previous = max(previous, nid)
+        if previous < high:
+            gaps.append((previous + 1, high))
+        self.root = self._build(gaps)
+
+
+    def _build(self, gaps):
+        """Balanced tree with heap ordered priorities, like RowRope._build"""
+        if not gaps:
+            return None
+        priorities = sorted((self._random.random() for _ in gaps), reverse=True)
+        nodes = [None] * len(gaps)
+        queue = [(0, len(gaps))]
+        position = 0
+        while position < len(queue):
+            low, high = queue[position]
+            mid = (low + high) // 2
+            nodes[mid] = _Gap(gaps[mid][0], gaps[mid][1], priorities[position])
+            position += 1
+            if low < mid:
+                queue.append((low, mid))
+            if mid + 1 < high:
+                queue.append((mid + 1, high))
+        for low, high in reversed(queue):
+            mid = (low + high) // 2
+            node = nodes[mid]
+            node.left = nodes[(low + mid) // 2] if low < mid else None
+            node.right = nodes[(mid + 1 + high) // 2] if mid + 1 < high else None
+            _update(node)
+        return nodes[len(gaps) // 2]
+
+
+    def __iter__(self):
+        """(first, last) free nid of every gap in ascending order"""
+        stack = []
+        node = self.root
+        while stack or node is not None:
+            while node is not None:
+                stack.append(node)
+                node = node.left
+            node = stack.pop()
+            yield node.start, node.end
+            node = node.right
+
+
+    def containing(self, nid):
+        """(first, last) of the gap nid is in or None if nid is assigned"""
+        node = self.root
+        found = None
+        while node is not None:
+            if node.start <= nid:
+                found = node
+                node = node.right
+            else:
+                node = node.left
+        if found is not None and found.end >= nid:
+            return found.start, found.end
+        return None
+
+
+    def find(self, nid, size=1):
+        """Smallest nid >= nid that starts a run of size free nids, or None"""
+        gap = self.containing(nid)
+        if gap is not None and gap[1] - nid + 1 >= size:
+            return nid
+        left, right = _split(self.root, nid + 1)
+        node = _first_fitting(right, size)
+        self.root = _merge(left, right)
+        return node.start if node is not None else None
+
+
+    def find_before(self, nid, size=1):
+        """Largest nid <= nid that ends a run of size free nids, or None"""
+        gap = self.containing(nid)
+        if gap is not None and nid - gap[0] + 1 >= size:
+            return nid
+        left, right = _split(self.root, gap[0] if gap is not None else nid)
+        node = _last_fitting(left, size)
+        self.root = _merge(left, right)
+        return node.end if node is not None else None
+
+
+    def _remove(self, start):
+        left, rest = _split(self.root, start)
+        _, right = _split(rest, start + 1)
+        self.root = _merge(left, right)
+
+
+    def _insert(self, start, end):
+        left, right = _split(self.root, start)
+        self.root = _merge(_merge(left, _Gap(start, end, self._random.random())), right)
+
+
+    def occupy(self, nid):
+        """nid was assigned: split its gap"""
+        gap = self.containing(nid)
+        if gap is None:
+            return
+        start, end = gap
+        self._remove(start)
+        if start < nid:
+            self._insert(start, nid - 1)
+        if nid < end:
+            self._insert(nid + 1, end)
+
+
+    def release(self, nid):
+        """nid is free again: join it with the gaps around it"""
+        if self.containing(nid) is not None:
+            return
+        start = end = nid
+        before = self.containing(nid - 1)
+        if before is not None:
+            self._remove(before[0])
+            start = before[0]
+        after = self.containing(nid + 1)
+        if after is not None:
+            self._remove(after[0])
+            end = after[1]
+        self._insert(start, end)
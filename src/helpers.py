@@ -7,11 +7,17 @@ License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.
 """
 
 import collections
+import json
+import os
 from pprint import pprint as pp
 import re
+import threading
 
 from aqt import mw
 
+from .config import anki_21_version
+from .template_analysis import fields_to_fill_for_first_card
+
 
 # mod of clayout.py/CardLayout._fieldsOnTemplate 
 def myFieldsOnTemplate(fmt):
@@ -53,27 +59,107 @@ def myFieldsOnTemplate(fmt):
 #    - narrow down to notes with the fewest cards generated
 #    - narrow down to a note with the fewest fields filled
 #    - only fill these fields
+# Update: template_analysis.py now parses the front template of card 1 (including
+# conditional sections and cloze filters) and computes the minimal fields directly.
+# The workaround is only used for templates it can't handle.
 def fields_to_fill_for_nonempty_front_template(mid):
-    wco = mw.col.findCards("mid:%s card:1" %mid)
-    if not wco:  # no note of the note type exists
-        return False
-    totalcards = {}
-    for cid in wco:
-        card = mw.col.getCard(cid)
-        totalcards.setdefault(card.nid, 0)
-        totalcards[card.nid] += 1
-    nid_filled_map = {}
-    for nid, number_of_cards in totalcards.items():
-        if number_of_cards == 1:
-            othernote = mw.col.getNote(nid)
-            nid_filled_map[nid] = 0
-            for f in othernote.fields:
-                if f:
-                    nid_filled_map[nid] += 1
-    lowestnid = min(nid_filled_map, key=nid_filled_map.get)
-    othernote = mw.col.getNote(lowestnid)
-    tofill = []
-    for idx, cont in enumerate(othernote.fields):
-        if cont:
-            tofill.append(idx)
+    model = mw.col.models.get(mid)
+    tofill = fields_to_fill_for_first_card(model)
+    if tofill:
+        return tofill
+    cached = fields_cache_get(model)
+    if cached is not None:
+        return cached
+    tofill = scan_fields_to_fill(mid)
+    if tofill:  # don't cache "no note exists", that changes with the next note
+        fields_cache_set(model, tofill)
+        fields_cache_save()
     return tofill
+
+
+def scan_fields_to_fill(mid):
+    # one query for all notes of the note type that have a card 1, with their
+    # number of cards
+    rows = mw.col.db.all("""
+select n.flds, (select count() from cards c where c.nid = n.id) from notes n
+where n.mid = ? and exists (select 1 from cards c where c.nid = n.id and c.ord = 0)""", mid)
+    if not rows:  # no note of the note type exists
+        return False
+    lowest = None
+    for flds, number_of_cards in rows:
+        fields = flds.split("\x1f")
+        key = (number_of_cards, sum(1 for f in fields if f))
+        if lowest is None or key < lowest[0]:
+            lowest = (key, fields)
+    return [idx for idx, cont in enumerate(lowest[1]) if cont]
+
+
+# The result of the scan is cached per note type in user_files so that it survives
+# restarts. An entry is only valid as long as the "mod" of the note type doesn't
+# change (e.g. when a template is edited).
+fields_cache_path = os.path.join(os.path.dirname(__file__), "user_files", "fields_to_fill.json")
+fields_cache = None
+# the cache is filled from the main thread and from warm_fields_cache
+fields_cache_lock = threading.RLock()
+
+
+def fields_cache_load():
+    global fields_cache
+    with fields_cache_lock:
+        if fields_cache is None:
+            try:
+                with open(fields_cache_path, encoding="utf-8") as f:
+                    fields_cache = json.load(f)
+            except (OSError, ValueError):
+                fields_cache = {}
+        return fields_cache
+
+
+def fields_cache_get(model):
+    with fields_cache_lock:
+        entry = fields_cache_load().get(str(model["id"]))
+    if entry and entry.get("mod") == model["mod"]:
+        return entry["fields"]
+    return None
+
+
+def fields_cache_set(model, fields):
+    with fields_cache_lock:
+        fields_cache_load()[str(model["id"])] = {"mod": model["mod"], "fields": fields}
+
+
+def fields_cache_save():
+    with fields_cache_lock:
+        if fields_cache is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(fields_cache_path), exist_ok=True)
+            with open(fields_cache_path, "w", encoding="utf-8") as f:
+                json.dump(fields_cache, f)
+        except OSError:
+            pass
+
+
+def warm_fields_cache():
+    """Fill the cache for all note types with outdated entries in a background thread"""
+    if anki_21_version < 28 or not hasattr(mw, "taskman"):
+        return  # the db of older versions can't be used from other threads
+    stale = [m for m in mw.col.models.all()
+             if fields_to_fill_for_first_card(m) is None and fields_cache_get(m) is None]
+    if not stale:
+        return
+
+    def task():
+        return [(model, scan_fields_to_fill(model["id"])) for model in stale]
+
+    def on_done(future):
+        try:
+            results = future.result()
+        except Exception:
+            return
+        for model, fields in results:
+            if fields:
+                fields_cache_set(model, fields)
+        fields_cache_save()
+
+    mw.taskman.run_in_background(task, on_done)
@@ -0,0 +1,194 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Logging and timing of the phases of a reorganization.
+
+Everything goes to user_files/note_organizer.log (rotated at 1 MB, three old
+files are kept), which can be attached to bug reports. The level is set with
+"general: log level": DEBUG also logs every renumbered note, INFO the timings
+of each phase.
+
+Progress carries the current phase and the throughput of a run in the
+background to the GUI and the cancel request back.
+"""
+
+from contextlib import contextmanager
+import logging
+from logging.handlers import RotatingFileHandler
+import os
+import time
+
+from .config import gc
+
+
+log_path = os.path.join(os.path.dirname(__file__), "user_files", "note_organizer.log")
+
+log = logging.getLogger("note_organizer")
+log.propagate = False
+
+
+def setup_logging():
+    """Attach the rotating log file once, update the level on every call"""
+    level = getattr(logging, str(gc("general: log level", "INFO")).upper(), logging.INFO)
+    log.setLevel(level)
+    if log.handlers:
+        return
+    try:
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        handler = RotatingFileHandler(log_path, maxBytes=1024 * 1024, backupCount=3, encoding="utf-8")
+    except OSError:
+        handler = logging.NullHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    log.addHandler(handler)
+
+
+class CountingDB:
+    """Proxy for col.db that counts the statements run through it
+
+    Only the add-on's own code uses it, col.db stays as it is because the main
+    thread keeps using it while a reorganization runs in the background.
+    Statements that Anki runs in its backend (e.g. in remove_notes) aren't counted.
+    """
+
+    counted = ("execute", "executemany", "scalar", "first", "all", "list")
+
+    def __init__(self, db):
+        self._db = db
+        self.statements = 0
+
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if name not in self.counted:
+            return attr
+
+        def counting(*args, **kwargs):
+            self.statements += 1
+            return attr(*args, **kwargs)
+        return counting
+
+
+class PhaseTimer:
+    """Wall time, statement count and note count per phase of one run
+
+        with PhaseTimer("processNids", col.db) as timer:
+            with timer.phase("processActions") as phase:
+                timer.db.execute(...)
+                phase["notes"] = len(nids)
+
+    The statements run through timer.db (a CountingDB around db) are counted,
+    see Rearranger.db. At the end one line per phase and a total are logged
+    with level INFO. The name of each phase is passed on to progress (a
+    Progress) if given.
+    """
+
+    def __init__(self, name, db=None, progress=None):
+        self.name = name
+        self.db = CountingDB(db) if db is not None else None
+        self.progress = progress
+        self.phases = []
+
+
+    def __enter__(self):
+        setup_logging()
+        self.started = time.perf_counter()
+        return self
+
+
+    def __exit__(self, *exc):
+        total = time.perf_counter() - self.started
+        counted = self.db is not None
+        for phase in self.phases:
+            log.info("%s %-18s %8.3fs %6s statements %8s notes", self.name, phase["name"],
+                     phase["seconds"], phase["statements"] if counted else "-",
+                     phase.get("notes", "-"))
+        log.info("%s %-18s %8.3fs %6s statements%s", self.name, "total", total,
+                 self.statements() if counted else "-", " (aborted)" if exc[0] else "")
+        return False
+
+
+    def statements(self):
+        return self.db.statements if self.db is not None else 0
+
+
+    @contextmanager
+    def phase(self, name):
+        phase = {"name": name}
+        if self.progress is not None:
+            self.progress.phase(name)
+        statements = self.statements()
+        started = time.perf_counter()
+        try:
+            yield phase
+        finally:
+            phase["seconds"] = time.perf_counter() - started
+            phase["statements"] = self.statements() - statements
+            self.phases.append(phase)
+
+
+class Cancelled(Exception):
+    """The user cancelled a running reorganization, nothing was changed"""
+
+
+class Progress:
+    """Phase and number of processed notes of a reorganization
+
+    The worker calls phase and advance, callback(progress) is then called in
+    the worker thread at most every interval seconds and on every new phase.
+    The GUI sets cancelled, the worker checks it between chunks with check.
+    """
+
+    def __init__(self, total=0, callback=None, interval=0.1):
+        self.total = total
+        self.done = 0
+        self.name = ""
+        self.cancelled = False
+        self.callback = callback
+        self.interval = interval
+        self.started = time.perf_counter()
+        self.notified = 0
+
+
+    def phase(self, name):
+        self.name = name
+        self.notify(force=True)
+
+
+    def advance(self, count):
+        self.done += count
+        self.notify()
+
+
+    def notify(self, force=False):
+        now = time.perf_counter()
+        if self.callback is None or (not force and now - self.notified < self.interval):
+            return
+        self.notified = now
+        self.callback(self)
+
+
+    def rate(self):
+        """Processed notes per second"""
+        seconds = time.perf_counter() - self.started
+        return self.done / seconds if seconds > 0 else 0.0
+
+
+    def label(self):
+        return "{}: {} of {} notes ({:.0f} notes/s)".format(
+            self.name, min(self.done, self.total), self.total, self.rate())
+
+
+    def check(self):
+        if self.cancelled:
+            raise Cancelled()
+
+
+    def chunk_done(self, count):
+        """advance and check, called after every chunk"""
+        self.advance(count)
+        self.check()
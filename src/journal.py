@@ -0,0 +1,145 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Undo journal of the last reorganization.
+
+Instead of a checkpoint of the whole collection Rearranger.execute records
+only what it changes: the renumbered nids, the rows of the deleted notes and
+their cards, the fields it overwrote and the new card positions it replaced.
+The journal is kept in user_files/last_reorganization.json until the next
+reorganization, Rearranger.revert replays it backwards with a few set-based
+statements.
+"""
+
+import json
+import os
+
+from anki.utils import ids2str
+
+
+journal_path = os.path.join(os.path.dirname(__file__), "user_files", "last_reorganization.json")
+
+NOTE_COLUMNS = "id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data"
+CARD_COLUMNS = ("id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, reps, "
+                "lapses, left, odue, odid, flags, data")
+
+
+class StaleJournal(Exception):
+    """The collection changed since the journal was written, it can't be reverted"""
+
+
+class Journal:
+    """What one reorganization changed
+
+    - profile: name of the profile the collection belongs to
+    - nid_map: {old_nid: new_nid} of the renumbered existing notes
+    - created: nids of the created notes. Scheduling copied by "Dupe (sched)"
+            only went to their cards, so removing them reverts it.
+    - deleted_notes, deleted_cards: rows (NOTE_COLUMNS, CARD_COLUMNS) of the
+            deleted notes and their cards
+    - fields: {old_nid: flds} of the notes whose fields were changed
+    - flushed: old nids in fields where the sort field or first field changed
+    - positions: {cid: [due, odue]} of the new cards before repositioning
+    """
+
+    def __init__(self, profile=None):
+        self.profile = profile
+        self.nid_map = {}
+        self.created = []
+        self.deleted_notes = []
+        self.deleted_cards = []
+        self.fields = {}
+        self.flushed = []
+        self.positions = {}
+
+
+    def is_empty(self):
+        return not (self.nid_map or self.created or self.deleted_notes
+                    or self.fields or self.positions)
+
+
+    def record_deletions(self, db, nids):
+        if not nids:
+            return
+        self.deleted_notes = db.all(
+            "select {} from notes where id in {}".format(NOTE_COLUMNS, ids2str(nids)))
+        self.deleted_cards = db.all(
+            "select {} from cards where nid in {}".format(CARD_COLUMNS, ids2str(nids)))
+
+
+    def record_fields(self, db, nids, flushed=()):
+        if not nids:
+            return
+        self.fields.update(db.all("select id, flds from notes where id in " + ids2str(nids)))
+        self.flushed = list(flushed)
+
+
+    def record_positions(self, db, nids=None):
+        """Positions of the new cards of nids, of all new cards if nids is None"""
+        query = "select id, due, odue from cards where type = 0"
+        if nids is not None:
+            query += " and nid in " + ids2str(nids)
+        for cid, due, odue in db.all(query):
+            self.positions[cid] = [due, odue]
+
+
+    def to_json(self):
+        return {
+            "profile": self.profile,
+            "nid_map": list(self.nid_map.items()),
+            "created": self.created,
+            "deleted_notes": self.deleted_notes,
+            "deleted_cards": self.deleted_cards,
+            "fields": list(self.fields.items()),
+            "flushed": self.flushed,
+            "positions": [[cid] + pos for cid, pos in self.positions.items()],
+        }
+
+
+    @classmethod
+    def from_json(cls, data):
+        journal = cls(data.get("profile"))
+        journal.nid_map = {old: new for old, new in data.get("nid_map", [])}
+        journal.created = data.get("created", [])
+        journal.deleted_notes = data.get("deleted_notes", [])
+        journal.deleted_cards = data.get("deleted_cards", [])
+        journal.fields = {nid: flds for nid, flds in data.get("fields", [])}
+        journal.flushed = data.get("flushed", [])
+        journal.positions = {row[0]: row[1:] for row in data.get("positions", [])}
+        return journal
+
+
+    def save(self, path=None):
+        """Replace the journal of the previous run, an empty journal only removes it"""
+        path = path or journal_path
+        if self.is_empty():
+            discard(path)
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.to_json(), f)
+        os.replace(tmp, path)
+
+
+def load(path=None):
+    """Journal of the last reorganization or None"""
+    path = path or journal_path
+    try:
+        with open(path, encoding="utf-8") as f:
+            return Journal.from_json(json.load(f))
+    except (OSError, ValueError):
+        return None
+
+
+def discard(path=None):
+    path = path or journal_path
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -0,0 +1,191 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+"""
+
+from bisect import bisect_left, bisect_right, insort
+
+from .gap_map import GapMap
+
+
+class NidIndex:
+    """In-memory sorted index of the note ids of a collection
+
+    Loaded once per reorganization so that existence checks and "next free nid"
+    lookups don't need a database round trip. The Rearranger has to keep it in
+    sync whenever it creates, renumbers or deletes a note.
+
+    For questions about runs of free nids it also keeps a GapMap, which is
+    built from the sorted nids on first use (see gaps).
+    """
+
+    def __init__(self, nids=()):
+        self._sorted = sorted(set(nids))
+        self._set = set(self._sorted)
+        self._gaps = None
+
+
+    @classmethod
+    def from_db(cls, db, low=None, high=None):
+        """Build the index with one scan of the notes table
+
+        With low and high only the nids in this range (inclusive) are loaded.
+        """
+        index = cls()
+        if low is None and high is None:
+            index._sorted = db.list("select id from notes order by id")
+        else:
+            index._sorted = db.list(
+                "select id from notes where id between ? and ? order by id",
+                low if low is not None else 0,
+                high if high is not None else 2**63 - 1)
+        index._set = set(index._sorted)
+        return index
+
+
+    def __contains__(self, nid):
+        return nid in self._set
+
+
+    def __len__(self):
+        return len(self._sorted)
+
+
+    def __iter__(self):
+        return iter(self._sorted)
+
+
+    def add(self, nid):
+        if nid in self._set:
+            return
+        self._set.add(nid)
+        insort(self._sorted, nid)
+        if self._gaps is not None:
+            self._gaps.occupy(nid)
+
+
+    def remove(self, nid):
+        if nid not in self._set:
+            return
+        self._set.discard(nid)
+        del self._sorted[bisect_left(self._sorted, nid)]
+        if self._gaps is not None:
+            self._gaps.release(nid)
+
+
+    def rename(self, old_nid, new_nid):
+        self.remove(old_nid)
+        self.add(new_nid)
+
+
+    def update(self, added=(), removed=()):
+        """Remove the nids in removed, then add the ones in added
+
+        add and remove shift the sorted list, which is O(n) per nid. For many
+        nids at once (renumbering, deleting or creating thousands of notes)
+        this does one pass instead, O(n + k log k).
+        """
+        removed = set(removed) & self._set
+        self._set -= removed
+        added = sorted(set(added) - self._set)
+        self._set.update(added)
+        if removed:
+            self._sorted = [nid for nid in self._sorted if nid not in removed]
+        if added:
+            # two sorted runs, which sort merges in linear time
+            self._sorted = sorted(self._sorted + added)
+        if self._gaps is not None:
+            for nid in removed:
+                self._gaps.release(nid)
+            for nid in added:
+                self._gaps.occupy(nid)
+
+
+    def rename_many(self, nid_map):
+        """rename for every {old_nid: new_nid} at once, see update"""
+        self.update(added=nid_map.values(), removed=nid_map.keys())
+
+
+    def next_free(self, nid):
+        """Smallest nid >= nid that isn't assigned"""
+        if nid not in self._set:
+            return nid
+        # nids are unique ints, so "nid - position" never decreases. It stays the
+        # same inside a run of consecutive nids, so the end of the run that starts
+        # at nid can be found by bisection instead of probing one id at a time.
+        ids = self._sorted
+        pos = bisect_left(ids, nid)
+        offset = nid - pos
+        low, high = pos, len(ids)
+        while low < high:
+            mid = (low + high) // 2
+            if ids[mid] - mid == offset:
+                low = mid + 1
+            else:
+                high = mid
+        return ids[low - 1] + 1
+
+
+    def previous_free(self, nid):
+        """Largest nid <= nid that isn't assigned"""
+        if nid not in self._set:
+            return nid
+        ids = self._sorted
+        pos = bisect_left(ids, nid)
+        offset = nid - pos
+        low, high = 0, pos
+        while low < high:
+            mid = (low + high) // 2
+            if ids[mid] - mid == offset:
+                high = mid
+            else:
+                low = mid + 1
+        return ids[low] - 1
+
+
+    def gaps(self):
+        """GapMap of the unassigned nids, kept in sync from the first call on"""
+        if self._gaps is None:
+            self._gaps = GapMap(self._sorted)
+        return self._gaps
+
+
+    def find_gap(self, nid, size):
+        """Smallest nid >= nid that starts a run of size unassigned nids"""
+        return self.gaps().find(nid, size)
+
+
+    def find_gap_before(self, nid, size):
+        """Largest nid <= nid that ends a run of size unassigned nids or None"""
+        return self.gaps().find_before(nid, size)
+
+
+    def copy(self):
+        other = NidIndex()
+        other._sorted = list(self._sorted)
+        other._set = set(self._set)
+        return other
+
+
+    def next_used(self, nid):
+        """Smallest assigned nid > nid or None"""
+        pos = bisect_right(self._sorted, nid)
+        if pos < len(self._sorted):
+            return self._sorted[pos]
+        return None
+
+
+    def previous_used(self, nid):
+        """Largest assigned nid < nid or None"""
+        pos = bisect_left(self._sorted, nid)
+        if pos:
+            return self._sorted[pos - 1]
+        return None
+
+
+    def count_between(self, low, high):
+        """Number of assigned nids with low < nid < high"""
+        return max(0, bisect_left(self._sorted, high) - bisect_right(self._sorted, low))
@@ -12,13 +12,14 @@ from pprint import pprint as pp
 from aqt.qt import *
 from aqt import mw
 from aqt.browser import Browser
-from aqt.utils import askUser
+from aqt.utils import askUser, showWarning, tooltip
 
 from anki.hooks import addHook, wrap
 from anki.utils import pointVersion
 
 from .organizer_window import Organizer
 from .rearranger import Rearranger
+from . import journal
 from .config import anki_21_version, gc
 from .no_consts import *
 
@@ -75,6 +76,25 @@ def onReorganize(self):  # self is browser
     self.organizer.show()
 
 
+def onRevertLast(self):  # self is browser
+    """Undo the last reorganization with its journal"""
+    undo = journal.load()
+    if not undo:
+        tooltip("There is no reorganization to revert.", parent=self)
+        return
+    if not askUser("Revert the last reorganization? Changes to the reorganized notes "
+                   "since then might prevent this.", title="Note Organizer"):
+        return
+    if self.organizer:
+        self.organizer.close()
+    try:
+        Rearranger(browser=self).revert(undo)
+    except journal.StaleJournal as e:
+        showWarning("Can't revert the last reorganization: {}".format(e), title="Note Organizer")
+        return
+    self.search()
+
+
 def setupMenu(self):
     """Setup menu entries and hotkeys"""
     self.menuOrg = QMenu("&Organizer")
@@ -85,10 +105,13 @@ def setupMenu(self):
     a = menu.addAction('Reorganize Notes...')
     a.setShortcut(QKeySequence(gc("shortcut: Organizer")))
     a.triggered.connect(self.onReorganize)
+    a = menu.addAction('Revert Last Reorganization')
+    a.triggered.connect(self.onRevertLast)
 
 
 addHook("browser.setupMenus", setupMenu)
 Browser.onReorganize = onReorganize
+Browser.onRevertLast = onRevertLast
 Browser.organizer = None
 
 if pointVersion() < 45:
@@ -15,11 +15,12 @@ from .config import gc
 
 def onSetNote(self, note, hide=True, focus=False):
     """Hide BACKUP_Field if configured"""
-    if not self.note or gc("BACKUP_FIELD") not in self.note:
+    field = gc("nids: backup field")
+    if not self.note or not field or field not in self.note:
         return
     model = self.note.model()
     flds = self.mw.col.models.fieldNames(model)
-    idx = flds.index(gc("BACKUP_FIELD"))
+    idx = flds.index(field)
     self.web.eval("""
         // hide last fname, field, and snowflake (FrozenFields add-on)
             document.styleSheets[0].addRule(
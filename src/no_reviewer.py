@@ -14,6 +14,7 @@ from aqt import mw
 
 from .config import anki_21_version, gc
 from .no_consts import *
+from .planner import NoRoom
 from .rearranger import Rearranger
 
 menu_entries = [
@@ -27,6 +28,10 @@ menu_entries = [
         "cmd": DUPE_NOTE_SCHED, "offset": 1},
 ]
 
+# number of neighbouring notes on each side of the reviewed note that may be
+# renumbered to make room for the new note. Widened if they are too densely packed.
+WINDOW = 50
+
 
 def addNoteOrganizerActions(web, menu):
     """Add Note Organizer actions to Reviewer Context Menu"""
@@ -56,21 +61,57 @@ def onReviewerOrgMenu(command, offset):
     # Downside: other notes in other decks might have more recent nids than the prior note
     # in the same deck so that the new note is sorted before the other ones. This can't be useful,
     # especially if you view your notes independent of the deck or reorganize them later.
-    note_pool = mw.col.db.list("select id from notes") 
-    note_pool.sort()
-    try:
-        idx = note_pool.index(note.id)
-    except ValueError: # nid not in deck
-        return False
-    
-    # construct command string that imitates Organizer GUI output
+    # Inserting one note only touches the notes right around it, so instead of passing all
+    # nids of the collection to the Rearranger only a window around the note is used. The
+    # notes outside of it keep their nids because the planned nids have to stay in between.
     if command.startswith(NEW_NOTE):
         data = MODEL_SAME
     else:
         data = str(note.id)
     composite = command + ": " + data
-    note_pool.insert(idx + offset, composite)
-    
+
+    rearranger = Rearranger(card=card)
+    window = WINDOW
+    while True:
+        note_pool, bounds = notes_around(note.id, window)
+        note_pool.insert(note_pool.index(note.id) + offset, composite)
+        try:
+            plan = rearranger.plan(note_pool, first_timestamp(note_pool), [], bounds=bounds)
+        except NoRoom:
+            if bounds == (0, None):  # already the whole collection
+                raise
+            window *= 4
+        else:
+            break
+    res = rearranger.execute(plan)
+
+    # display result in browser
+    if gc("reviewer: Open Browser"):
+        browser = aqt.dialogs.open("Browser", mw)
+        browser.form.searchEdit.lineEdit().setText(search)
+        if anki_21_version <= 44:
+            browser._onSearchActivated()
+        else:
+            browser.onSearchActivated()
+        rearranger.selectNotes(browser, res)
+
+
+def notes_around(nid, window):
+    """nids of the note and up to window notes before and after it
+
+    Returns the sorted nids and the (floor, ceiling) the Rearranger must keep the
+    nids in: the nearest notes outside of the window aren't touched.
+    """
+    db = mw.col.db
+    before = db.list("select id from notes where id < ? order by id desc limit ?", nid, window)
+    after = db.list("select id from notes where id > ? order by id limit ?", nid, window)
+    before.reverse()
+    floor = before[0] - 1 if len(before) == window else 0
+    ceiling = after[-1] + 1 if len(after) == window else None
+    return before + [nid] + after, (floor, ceiling)
+
+
+def first_timestamp(note_pool):
     # "start = None" (from glutanimate's version from 2017) changes all nids to more or less
     # the current time when you insert a note before the first note in a deck.
     # This doesn't happen if I insert a new note in the gui at the first position.
@@ -81,31 +122,16 @@ def onReviewerOrgMenu(command, offset):
     # rearranger.adjust_nid_order can't be true ...
     # In the gui organizer.updateDate sets start to nid/1000 of the 
     # first = oldest nid so that the "elif ..." evaluates to True ...
-    # So here I need to set start to nid//1000 of the oldest nid of the deck instead of None
+    # So here I need to set start to nid//1000 of the oldest nid of the pool instead of None
     # Problem: The first element in the list might be 'New: Same note type as previous' so 
     # I have to iterate.
     for nid in note_pool:
         try:
-            timestamp = int(nid) // 1000
-        except:
+            return int(nid) // 1000
+        except ValueError:
             pass
-        else:
-            break
-    start = timestamp  # deck has at least one note (=the note creating the card reviewed)
-    moved = []
-
-    rearranger = Rearranger(card=card)
-    res = rearranger.processNids(note_pool, start, moved)
+    return None
 
-    # display result in browser
-    if gc("reviewer: Open Browser"):
-        browser = aqt.dialogs.open("Browser", mw)
-        browser.form.searchEdit.lineEdit().setText(search)
-        if anki_21_version <= 44:
-            browser._onSearchActivated()
-        else:
-            browser.onSearchActivated()
-        rearranger.selectNotes(browser, res)
 
 if gc("reviewer: Context Menu"):
     addHook("AnkiWebView.contextMenuEvent", addNoteOrganizerActions)
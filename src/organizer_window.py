@@ -7,10 +7,10 @@ Copyright: (c) 2017 Glutanimate
 License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
 """
 
-# from timeit import default_timer as timer
 from pprint import pprint as pp
 
 from anki.hooks import addHook, remHook
+from anki.utils import ids2str, pointVersion
 
 from aqt.qt import *
 from aqt.utils import (
@@ -27,9 +27,11 @@ if qtmajor == 5:
 else:
     from .forms6 import organizer  # type: ignore  # noqa
 
-from .custom_table_widget import NoteTable
+from .custom_table_widget import NoteTable, NoteRow, ROW_NOTE, ROW_NEW, ROW_DUPE, ROW_DEL
 from .rearranger import Rearranger
 from .config import anki_21_version, gc
+from .helpers import warm_fields_cache
+from .instrumentation import Cancelled, PhaseTimer, Progress, log
 from .no_consts import *
 
 
@@ -47,16 +49,15 @@ class Organizer(QDialog):
         self.oldnids = []
         self.clipboard = []
         self.modified = False
+        self.pending_changes = None  # set by the Rearranger, see onNotesChanged
+        self.busy = False  # a reorganization runs in the background, see runInBackground
         self.setupUi()
         addHook("reset", self.onReset)
+        addHook("noteOrganizer.changed", self.onNotesChanged)
 
 
     def setupUi(self):
-        # print("=====Performance benchmark=====")
-        # start = timer()
         self.fillTable()
-        # end = timer()
-        # print("total", end - start)    
         self.setupDate()
         self.updateDate()
         self.setupHeaders()
@@ -66,12 +67,17 @@ class Organizer(QDialog):
         # focus currently selected card:
         if self.browser.card:
             self.focusNid(str(self.browser.card.nid))
+        # new notes only need the fields that make card 1 non-empty
+        warm_fields_cache()
 
 
     def setupEvents(self):
         """Connect event signals to slots"""
         self.table.selectionModel().selectionChanged.connect(self.onRowChanged)
-        self.table.cellChanged.connect(self.onCellChanged)
+        model = self.table.note_model
+        for signal in (model.dataChanged, model.rowsInserted, model.rowsRemoved,
+                       model.rowsMoved, model.modelReset):
+            signal.connect(self.onCellChanged)
         self.dialog.buttonBox.rejected.connect(self.onReject)
         self.dialog.buttonBox.accepted.connect(self.onAccept)
 
@@ -149,30 +155,24 @@ class Organizer(QDialog):
 
 
     def fillTable(self):
-        if anki_21_version <= 44:
-            headers, row_contents_list_of_lists = self.gather_contents_old()
-        else:
-            headers, row_contents_list_of_lists = self.gather_contents_new()
-
-        self.oldnids = [i[0] for i in row_contents_list_of_lists]
-        
-        row_count = len(row_contents_list_of_lists)
-        self.table.setRowCount(row_count)
-        self.table.setColumnCount(len(headers))
-        self.table.setHorizontalHeaderLabels(headers)
-
-        for row, columns in enumerate(row_contents_list_of_lists):
-            for col, value in enumerate(columns):
-                if isinstance(value, int) and value > 2147483647:
-                    value = str(value)
-                item = QTableWidgetItem(value)
-                font = QFont()
-                # f.setFamily(browser.mw.fontFamily)
-                #f.setPixelSize(browser.mw.fontHeight)
-                item.setFont(font)
-                self.table.setItem(row,col,item)
-
-        self.setWindowTitle("Reorganize Notes ({} notes shown)".format(row_count))
+        with PhaseTimer("fillTable") as timer:  # the statements run in the browser code
+            with timer.phase("gather_contents") as phase:
+                if anki_21_version <= 44:
+                    headers, rows = self.gather_contents_old()
+                    fetcher = None
+                else:
+                    headers, rows = self.gather_contents_new()
+                    fetcher = self.fetch_browser_cells
+                phase["notes"] = len(rows)
+
+            with timer.phase("setRows") as phase:
+                self.oldnids = [row.text for row in rows]
+                self.first_nid_text = self.oldnids[0] if self.oldnids else None
+                self.table.note_model.setRows(headers, rows, fetcher)
+                self.table.moved = {}
+                phase["notes"] = len(rows)
+
+        self.setWindowTitle("Reorganize Notes ({} notes shown)".format(len(rows)))
 
 
     def gather_contents_old(self):
@@ -180,7 +180,7 @@ class Organizer(QDialog):
         browser = self.browser
         b_t_model = browser.model
 
-        row_contents_list_of_lists = []
+        rows = []
         b_t_m_active_cols = b_t_model.activeCols
 
         # either get selected cards or entire view
@@ -193,30 +193,27 @@ class Organizer(QDialog):
             idxs = None
 
         # eliminate duplicates, get data, and sort it by nid
-        nids_processed = []
+        cid_to_nid = self.nids_for_cids(sel_cids_in_b)
+        nids_processed = set()
         for row, cid in enumerate(sel_cids_in_b):
             if idxs:
                 row = idxs[row].row()
-            card = b_t_model.cardObjs.get(cid, None)
-            if not card:
-                card = b_t_model.col.getCard(cid)
-                b_t_model.cardObjs[cid] = card
-            nid = card.note().id
-            if nid in nids_processed:
+            nid = cid_to_nid.get(cid)
+            if nid is None or nid in nids_processed:
                 continue
-            contents_one_row = [str(nid)]
+            cells = []
             for col in range(len(b_t_m_active_cols)):
                 index = b_t_model.index(row, col)
-                contents_one_row.append(b_t_model.data(index, Qt.ItemDataRole.DisplayRole))
-            nids_processed.append(nid)
-            row_contents_list_of_lists.append(contents_one_row)
-        row_contents_list_of_lists.sort()
+                cells.append(b_t_model.data(index, Qt.ItemDataRole.DisplayRole))
+            nids_processed.add(nid)
+            rows.append(NoteRow(str(nid), item=cid, cells=cells))
+        rows.sort(key=lambda r: int(r.text))
         """
-        row_contents_list_of_lists could look like this if two notes are selcted in the browser table
+        rows could look like this if two notes are selcted in the browser table
         if in the browser there are three columns shown
             [
-                [nid1, content_cell_1, content_cell_2, content_cell_3],
-                [nid2, content_cell_1, content_cell_2, content_cell_3],
+                NoteRow(nid1, cells=[content_cell_1, content_cell_2, content_cell_3]),
+                NoteRow(nid2, cells=[content_cell_1, content_cell_2, content_cell_3]),
             ]
         """
 
@@ -225,48 +222,70 @@ class Organizer(QDialog):
         coldict = dict(browser.columns)
         headers = ["Note ID"] + [coldict.get(key, "Add-on") for key in b_t_m_active_cols]
 
-        return headers, row_contents_list_of_lists
+        return headers, rows
 
 
     def gather_contents_new(self):
         """Fill table rows with data"""
         browser = self.browser
 
-        row_contents_list_of_lists = []
-        # get contents of selected rows from browser table
-        for qmi in browser.table._selected():  # qmi = QModelIndex
-            # row_idx = qmi.row()
-            
-            # nid = browser.table._model.get_note_id(qmi)  # get_note_id is not in .45
-            nid = browser.table._model.get_note_ids([qmi])[0]  # get_note_id is not in .45
-            contents_one_row = [str(nid)]
-            row = browser.table._model.get_row(qmi)
-            for cell in row.cells:
-                contents_one_row.append(cell.text)
-            row_contents_list_of_lists.append(contents_one_row)
-        # pp(row_contents_list_of_lists, width=130)
+        model = browser.table._model
+
+        # the selected rows of the browser table
+        items = [model.get_item(qmi) for qmi in browser.table._selected()]  # qmi = QModelIndex
+
+        # eliminate duplicates and sort by nid. The contents of the rows are only
+        # fetched when they are shown, see fetch_browser_cells
+        if browser.table.is_notes_mode():
+            item_to_nid = {nid: nid for nid in items}
+        else:
+            item_to_nid = self.nids_for_cids(items)
+        rows = []
+        nids_processed = set()
+        for item in items:  # cid or nid
+            nid = item_to_nid.get(item)
+            if nid is None or nid in nids_processed:
+                continue
+            nids_processed.add(nid)
+            rows.append(NoteRow(str(nid), item=item))
+        rows.sort(key=lambda r: int(r.text))
 
         # headers = browser.table._model._state.active_columns  # not translated
-        headers = []
+        headers = ["Note ID"]
         for i in range(browser.table._model.len_columns()):
             headers.append(browser.table._model.headerData(i, Qt.Horizontal, Qt.DisplayRole))
 
-        return headers, row_contents_list_of_lists
+        return headers, rows
+
+
+    def nids_for_cids(self, cids):
+        """Map cids to nids with one query"""
+        return dict(self.mw.col.db.all(
+            "select id, nid from cards where id in " + ids2str(cids)))
+
 
+    def fetch_browser_cells(self, item):
+        """Contents of the browser columns for a cid or nid (2.1.45+)"""
+        row = self.browser.table._model._fetch_row_from_backend(item)
+        return [cell.text for cell in row.cells]
 
-    def onCellChanged(self, row, col):
+
+    def onCellChanged(self, *args):
         """Update datetime display when (0,0) changed"""
-        if row == col == 0 and not (self.mw.app.keyboardModifiers() & Qt.KeyboardModifier.ShiftModifier):
+        first = self.table.nidText(0) if self.table.rowCount() else None
+        if first == self.first_nid_text:
+            return
+        self.first_nid_text = first
+        if not (self.mw.app.keyboardModifiers() & Qt.KeyboardModifier.ShiftModifier):
             self.updateDate()
 
 
     def updateDate(self):
         """Update datetime based on (0,0) value"""
-        item = self.table.item(0, 0)
-        if not item:
+        if not self.table.rowCount():
             return False
         try:
-            nid = int(item.text())
+            nid = int(self.table.nidText(0))
         except ValueError:
             return False
         timestamp = nid // 1000
@@ -322,16 +341,10 @@ class Organizer(QDialog):
         if not rows:
             return
         row = rows[0] + 1
-        self.table.insertRow(row)
         if not model:
             model = MODEL_SAME
         data = "{}: {}".format(NEW_NOTE, model)
-        item = QTableWidgetItem(data)
-        font = item.font()
-        font.setBold(True)
-        item.setFont(font)
-        item.setForeground(Qt.GlobalColor.darkGreen)
-        self.table.setItem(row, 0, item)
+        self.table.note_model.insertNoteRows(row, [NoteRow(data, ROW_NEW, cells=[])])
         self.modified = True
 
 
@@ -341,25 +354,14 @@ class Organizer(QDialog):
         if not rows:
             return
         row = rows[0]
-        new_row = row+1
-        self.table.insertRow(new_row)
         marker = DUPE_NOTE if not sched else DUPE_NOTE_SCHED
-        for col in range(self.table.columnCount()):
-            if col == 0:
-                value = self.table.item(row, 0).text()
-                nid = ''.join(i for i in value if i.isdigit())
-                if value.startswith(DEL_NOTE) or not nid:
-                    self.table.removeRow(new_row)
-                    return
-                data = "{}: {}".format(marker, nid)
-                dupe = QTableWidgetItem(data)
-                font = dupe.font()
-                font.setBold(True)
-                dupe.setFont(font)
-                dupe.setForeground(Qt.GlobalColor.darkBlue)
-            else:
-                dupe = QTableWidgetItem(self.table.item(row, col))
-            self.table.setItem(new_row, col, dupe)
+        source = self.table.noteRow(row)
+        value = source.text
+        nid = ''.join(i for i in value if i.isdigit())
+        if value.startswith(DEL_NOTE) or not nid:
+            return
+        data = "{}: {}".format(marker, nid)
+        self.table.note_model.insertNoteRows(row + 1, [source.copy(data, ROW_DUPE)])
         self.modified = True
 
 
@@ -371,30 +373,21 @@ class Organizer(QDialog):
         to_remove = []
         delmark = "{}: ".format(DEL_NOTE)
         for row in rows:
-            item = self.table.item(row, 0)
-            if not item:
-                continue
-            value = item.text()
+            note_row = self.table.noteRow(row)
+            value = note_row.text
             # New notes:
             if value.startswith((NEW_NOTE, DUPE_NOTE)): # remove
                 to_remove.append(row)
                 continue
             # Existing notes:
             if value.startswith(delmark): # remove deletion mark
-                new = value.replace(delmark, "")
-                item.setText("{}".format(new))
-                font = item.font()
-                font.setBold(False)
-                item.setFont(font)
-                item.setForeground(QBrush())
+                note_row.text = value.replace(delmark, "")
+                note_row.state = ROW_NOTE
             else: # apply deletion mark
-                item.setText("{}: {}".format(DEL_NOTE, value))
-                font = item.font()
-                font.setBold(True)
-                item.setFont(font)
-                item.setForeground(Qt.GlobalColor.darkRed)
-        for row in to_remove[::-1]: # in reverse to avoid updating idxs
-            self.table.removeRow(row)
+                note_row.text = "{}: {}".format(DEL_NOTE, value)
+                note_row.state = ROW_DEL
+            self.table.note_model.rowChanged(row)
+        self.table.note_model.removeRowsAt(to_remove)
         self.modified = True
 
 
@@ -408,9 +401,6 @@ class Organizer(QDialog):
 
     def onPasteRow(self):
         """Paste current selection"""
-        # TODO: Needs some refactoring
-
-        t = self.table
         cut = self.clipboard
         if not self.clipboard:
             return
@@ -425,46 +415,8 @@ class Organizer(QDialog):
             # FIXME: support pasting back into the same range
             return False
 
-        # Insert new row and copy data over
-        offset = 0
-        cols = t.columnCount()
-        select = []
-        for cut_row in cut[::-1]:
-            t.insertRow(new_row)
-            if new_row < cut_row:
-                offset += 1
-            adj_row = cut_row + offset
-            # print("moving {} (actual: {}) to {}".format(
-            #         cut_row+1, adj_row+1, new_row+1))
-            for col in range(cols):
-                dupe = QTableWidgetItem(t.item(adj_row, col))
-                font = dupe.font()
-                font.setBold(True)
-                dupe.setFont(font)
-                t.setItem(new_row, col, dupe)
-                if col == 0:
-                    value = dupe.text()
-                    if value not in t.moved:
-                        t.moved.append(value)
-            t.clearSelection()
-
-        # Remove old row
-        for row in cut[::-1]:
-            # print("removing {}".format(row+offset))
-            t.removeRow(row+offset)
-
-        # reselect moved rows
-        selectionModel = t.selectionModel()
-        if new_row > cut[0]:
-            index1 = t.model().index(new_row-len(cut), 0)
-            index2 = t.model().index(new_row-1, 2)
-        else:
-            index1 = t.model().index(new_row, 0)
-            index2 = t.model().index(new_row+len(cut)-1, 0)
-        itemSelection = QItemSelection(index1, index2)
-        selectionModel.select(itemSelection, 
-            QItemSelectionModel.Rows | QItemSelectionModel.Select)
-
+        # move the rows in front of the selected row and reselect them
+        self.table.moveRows(cut, new_row)
         self.clipboard = None
 
 
@@ -476,17 +428,14 @@ class Organizer(QDialog):
         rows = self.table.getSelectedRows()
         if not rows:
             return
-        item = self.table.item(rows[0], 0)  # PyQt5.QtWidgets.QTableWidgetItem
-        if not item:
-            return
-        nid_str = item.text()
+        nid_str = self.table.nidText(rows[0])
         if ": " in nid_str: # ignore action markers
             nid_str = nid_str.split(": ")[1]
         
         try:
             nid_as_int = int(nid_str)
         except:
-            print(f"nid_str is: {nid_str}")  #  e.g. "Same note type as previous"
+            log.debug("nid_str is: %s", nid_str)  #  e.g. "Same note type as previous"
             return
 
         if anki_21_version <= 44:
@@ -510,34 +459,108 @@ class Organizer(QDialog):
             self.browser.table._select_rows(rows_to_select)
 
 
+    def findNidRow(self, nid):
+        """Row of the first entry whose first column ends with nid or None"""
+        return self.table.note_model.nidRow(nid)
+
+
     def deleteNids(self, nids):
         """Find and delete row by note ID"""
+        to_remove = []
         for nid in nids:
-            nid = str(nid)
-            cells = self.table.findItems(nid, Qt.MatchFlag.MatchEndsWith)
-            if cells:
-                row = cells[0].row()
-                self.table.removeRow(row)
+            row = self.findNidRow(nid)
+            if row is not None:
+                to_remove.append(row)
+        self.table.note_model.removeRowsAt(to_remove)
 
 
     def focusNid(self, nid):
         """Find and select row by note ID"""
-        nid = str(nid)
-        cells = self.table.findItems(nid, Qt.MatchFlag.MatchEndsWith)
-        if cells:
-            self.table.setCurrentItem(cells[0])
+        row = self.findNidRow(nid)
+        if row is not None:
+            self.table.selectRow(row)
+            self.table.scrollTo(self.table.note_model.index(row, 0))
+
+
+    def onNotesChanged(self, changes):
+        """Remember the changes of a Rearranger run (e.g. from the reviewer) for onReset"""
+        self.pending_changes = changes
 
 
     def onReset(self):
+        if self.busy:
+            return
         self.clipboard = []
-        self.fillTable()
+        changes, self.pending_changes = self.pending_changes, None
+        if changes is not None and anki_21_version > 44:
+            self.patchTable(changes)
+        else:
+            self.fillTable()
         self.updateDate()
         if self.browser.card:
             self.focusNid(str(self.browser.card.nid))
 
 
+    def patchTable(self, changes):
+        """Apply the changes of a Rearranger run to the shown rows
+
+        Instead of gathering all browser rows again like fillTable only the rows of
+        renumbered, deleted and created notes are touched, and only their cells
+        are fetched again when they are painted. Changes made in the dialog that
+        weren't accepted yet are kept.
+        """
+        model = self.table.note_model
+        notes_mode = self.browser.table.is_notes_mode()
+        renumbered = {str(old): str(new) for old, new in changes["renumbered"].items()}
+        deleted = {str(nid) for nid in changes["deleted"]}
+
+        def patched(text):
+            # "123", "Del: 123", "Dupe: 123" ...
+            prefix, sep, nid = text.rpartition(" ")
+            if nid in renumbered:
+                return prefix + sep + renumbered[nid]
+            return text
+
+        to_remove = []
+        for pos, row in enumerate(model.rows):
+            nid = row.text.rpartition(" ")[2]
+            if nid in deleted:  # also drops markers for dupes of deleted notes
+                to_remove.append(pos)
+            elif nid in renumbered:
+                row.text = patched(row.text)
+                if notes_mode and row.item is not None:
+                    row.item = int(renumbered[nid])
+                row.cells = None  # e.g. the creation date changed
+                model.rowChanged(pos)
+        model.removeRowsAt(to_remove)
+
+        self.oldnids = [patched(text) for text in self.oldnids
+                        if text.rpartition(" ")[2] not in deleted]
+        self.table.moved = dict.fromkeys(
+            patched(text) for text in self.table.moved if text not in deleted)
+
+        # new notes are shown if the note in front of them is
+        for nid, previous in changes["created"]:
+            if previous is None:
+                continue
+            row = self.findNidRow(previous)
+            if row is None:
+                continue
+            if notes_mode:
+                item = nid
+            else:
+                item = self.mw.col.db.scalar(
+                    "select id from cards where nid = ? order by ord limit 1", nid)
+            model.insertNoteRows(row + 1, [NoteRow(str(nid), item=item)])
+            if str(previous) in self.oldnids:
+                self.oldnids.insert(self.oldnids.index(str(previous)) + 1, str(nid))
+
+        self.setWindowTitle("Reorganize Notes ({} notes shown)".format(model.rowCount()))
+
+
     def cleanup(self):
         remHook("reset", self.onReset)
+        remHook("noteOrganizer.changed", self.onNotesChanged)
         self.browser.organizer = None
         saveGeom(self, "organizer")
         saveHeader(self.hh, "organizer")
@@ -556,12 +579,7 @@ class Organizer(QDialog):
 
     def onAccept(self):
         """Ask for confirmation, then call rearranger"""
-        newnids = []
-        for row in range(self.table.rowCount()):
-            item = self.table.item(row, 0)
-            if not item: # should not happen
-                continue
-            newnids.append(item.text())
+        newnids = [row.text for row in self.table.note_model.rows]
 
         if newnids == self.oldnids:
             self.close()
@@ -575,35 +593,95 @@ class Organizer(QDialog):
             except ValueError: # only add existing notes to moved
                 pass
 
-        nn = newnids
-        to_delete = len([i for i in nn if i.startswith(DEL_NOTE)])
-        to_add = len([i for i in nn if i.startswith((NEW_NOTE, DUPE_NOTE))])
-        to_move = len(moved)
+        start = self.getDate() # TODO: identify cases where only date modified
+        repos = self.dialog.cbRepos.isChecked()
+
+        rearranger = Rearranger(browser=self.browser)
+        self.runInBackground(
+            lambda: rearranger.plan(newnids, start, moved, repos=repos),
+            lambda plan: self.confirmAndExecute(rearranger, plan, repos),
+            "Planning reorganization...")
+
+
+    def confirmAndExecute(self, rearranger, plan, repos):
+        """Show the overview of plan and apply it in the background"""
+        if plan.is_empty() and not repos:
+            self.close()
+            tooltip("No changes performed")
+            return False
 
         if not gc("general: ask confirmation"):
             pass
         else:
             ret = askUser("Overview of <b>changes</b>:"
                 "<ul style='margin-left: 0'>"
-                "<li><b>Move</b> at least <b>{}</b> note(s)</li>"
+                "<li><b>Move {}</b> note(s)</li>"
+                "<li><b>Update {}</b> note(s) alongside</li>"
                 "<li><b>Remove {}</b> note(s)</li>"
-                "<li><b>Create {}</b> new note(s)</li></ul>"
-                "Additional notes might have to be updated "
-                "to allow for the changes above.<br><br>"
-                "Are you sure you want to <b>proceed</b>?".format(to_move, to_delete, to_add),
+                "<li><b>Create {}</b> new note(s)</li>"
+                "<li><b>Reposition {}</b> new card(s)</li></ul>"
+                "In total about <b>{}</b> notes and cards are written "
+                "({} renumbering(s) fewer than with the old method).<br><br>"
+                "Are you sure you want to <b>proceed</b>?".format(
+                    len(plan.moved), len(plan.alongside), len(plan.deletions),
+                    len(plan.creations), plan.cards.get("repositioned", 0),
+                    plan.estimated_writes, plan.nid_plan.saved_writes),
                 parent=self, defaultno=True, title="Please confirm action")
             if not ret:
                 return False
-          
-        start = self.getDate() # TODO: identify cases where only date modified
-        repos = self.dialog.cbRepos.isChecked()
 
-        rearranger = Rearranger(browser=self.browser)
-        rearranger.processNids(newnids, start, moved, repos=repos)
+        progress = Progress(callback=lambda p: self.mw.taskman.run_on_main(
+            lambda: self.showProgress(p)))
+        self.runInBackground(
+            lambda: rearranger.apply(plan, progress),
+            lambda applied: self.onApplied(rearranger, plan, applied),
+            "Reorganizing notes...")
 
+
+    def onApplied(self, rearranger, plan, applied):
+        # the dialog closes anyway, don't refresh its table on the reset in
+        # finish
         self.cleanup()
+        rearranger.finish(plan, applied)
         super(Organizer, self).accept()
 
 
+    def runInBackground(self, task, on_success, label):
+        """Run task as a background operation, then on_success(result) on the main thread
+
+        Anki's database can only be used from other threads since 2.1.28, before
+        that task runs right away. If the user cancels, the table keeps its
+        unsaved changes.
+        """
+        if pointVersion() < 28:
+            try:
+                on_success(task())
+            except Cancelled:
+                pass
+            return
+
+        def on_done(future):
+            try:
+                result = future.result()
+            except Cancelled:
+                self.mw.reset()  # still busy: onReset doesn't refill the table
+                tooltip("Reorganization cancelled, nothing was changed", parent=self)
+                return
+            finally:
+                self.busy = False
+            on_success(result)
+
+        self.busy = True
+        self.mw.taskman.with_progress(task, on_done, parent=self, label=label, immediate=True)
+
+
+    def showProgress(self, progress):
+        """Show phase and throughput of a running reorganization, pass on cancel requests"""
+        if hasattr(self.mw.progress, "want_cancel") and self.mw.progress.want_cancel():
+            progress.cancelled = True
+        self.mw.progress.update(label=progress.label(), value=progress.done,
+                                max=max(progress.total, 1))
+
+
     def onReject(self):
         self.close()
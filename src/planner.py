@@ -0,0 +1,458 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Minimal-move planning of new nids for a list of notes in the desired order.
+
+The greedy pass in older versions walked the rows and renumbered every note that
+wasn't bigger than its predecessor. A single note that was moved to an earlier
+position could thus cascade over all the following notes. Here the longest
+increasing subsequence (LIS) of the existing nids is kept as it is and only the
+notes outside of it get new nids, which are taken from the gaps between their
+fixed neighbours. Only if a gap is too small the neighbouring fixed notes on the
+cheaper side are given up and renumbered too ("shifting").
+
+A run of notes between two fixed neighbours is spread evenly over the gap
+(spread_nids) instead of being packed behind the first neighbour, so that the
+next note moved into the same gap still finds room.
+
+This module doesn't touch the collection, it only needs a NidIndex.
+"""
+
+from bisect import bisect_left
+from heapq import heappop, heappush
+
+
+# room that the greedy pass tried to leave after each renumbered note, see
+# Rearranger.updateNidSafely
+GREEDY_ROOM = 20
+
+
+class NidPlan:
+    """Result of plan_nid_order
+
+    - nidlist: the nids of all rows in the desired order after renumbering
+    - moves: {old_nid: new_nid} in row order, only for existing notes that get a
+             new nid. The nids of notes that are created later are in nidlist.
+    - fixed: number of notes that keep their nid
+    - greedy_writes: number of existing notes the greedy pass would have renumbered
+    """
+
+    def __init__(self, nidlist, moves, fixed, greedy_writes):
+        self.nidlist = nidlist
+        self.moves = moves
+        self.fixed = fixed
+        self.greedy_writes = greedy_writes
+
+
+    @property
+    def saved_writes(self):
+        return max(0, self.greedy_writes - len(self.moves))
+
+
+def longest_increasing_subsequence(values):
+    """Return the positions of a longest strictly increasing subsequence
+
+    O(n log n) patience sorting with back pointers.
+    """
+    tails = []        # tails[k]: smallest last value of an increasing run of length k+1
+    tails_pos = []    # position of tails[k] in values
+    previous = [-1] * len(values)
+    for pos, value in enumerate(values):
+        k = bisect_left(tails, value)
+        if k == len(tails):
+            tails.append(value)
+            tails_pos.append(pos)
+        else:
+            tails[k] = value
+            tails_pos[k] = pos
+        previous[pos] = tails_pos[k - 1] if k else -1
+    result = []
+    pos = tails_pos[-1] if tails_pos else -1
+    while pos != -1:
+        result.append(pos)
+        pos = previous[pos]
+    return result[::-1]
+
+
+def free_nids_after(index, low, count, high=None, headroom=0):
+    """count unassigned nids > low (and < high), or None if they don't fit
+
+    On both sides of each of them at least headroom nids stay unassigned, also
+    towards low and high.
+    """
+    out = []
+    nid = low
+    for _ in range(count):
+        if headroom:
+            nid = index.find_gap(nid + 1, 2 * headroom + 1)
+            if nid is None:
+                return None
+            nid += headroom
+        else:
+            nid = index.next_free(nid + 1)
+        if high is not None and nid + headroom >= high:
+            return None
+        out.append(nid)
+    return out
+
+
+def free_nids_before(index, high, count, low=0, headroom=0):
+    """count unassigned nids < high (and > low) in ascending order, or None
+
+    On both sides of each of them at least headroom nids stay unassigned, also
+    towards low and high.
+    """
+    out = []
+    nid = high
+    for _ in range(count):
+        if headroom:
+            nid = index.find_gap_before(nid - 1, 2 * headroom + 1)
+            if nid is None:
+                return None
+            nid -= headroom
+        else:
+            nid = index.previous_free(nid - 1)
+        if nid - headroom <= low:
+            return None
+        out.append(nid)
+    return out[::-1]
+
+
+def spread_nids(index, low, high, count, headroom=0):
+    """count unassigned nids between low and high (exclusive) at even distances
+
+    All of them are placed in one step: the gap is divided into count + 1 equal
+    parts, each nid is taken from the first run of free nids from its share on
+    that keeps at least headroom unused nids on both sides (towards other
+    notes, low, high and the nid before it). If other notes in the gap get in
+    the way, the nids are packed behind low. Returns None if they don't fit.
+    """
+    if count <= 0:
+        return []
+    if high - low < (count + 1) * (headroom + 1):
+        return None
+    out = []
+    previous = low
+    for i in range(1, count + 1):
+        share = low + (high - low) * i // (count + 1)
+        nid = index.find_gap(max(share - headroom, previous + 1), 2 * headroom + 1)
+        if nid is None or nid + 2 * headroom >= high:
+            return free_nids_after(index, low, count, high, headroom)
+        nid += headroom
+        out.append(nid)
+        previous = nid
+    return out
+
+
+def greedy_write_count(nids, start, altered, index):
+    """Number of existing notes the old greedy pass of adjust_nid_order would renumber
+
+    Simulated without writing anything and without copying the index. Notes
+    that are yet to be created (None) get the nid Anki would give them, i.e.
+    one after the biggest nid. They are renumbered by both passes and so
+    aren't counted.
+
+    The pass only ever looks for free nids after the last nid it handed out,
+    and that one only grows. So the nids it assigns never get in the way
+    again, only the nids it frees have to be tracked: a heap for the next
+    free one, a set (with shortcuts past runs of them) for the next used one.
+    """
+    altered = set(altered)
+    newest = max(index, default=0)
+    first_created = newest + 1
+    nids = list(nids)
+    created = set()
+    for pos, nid in enumerate(nids):
+        if nid is None:
+            created.add(pos)
+            newest += 1
+            nids[pos] = newest
+            altered.add(newest)
+
+    def next_free(nid):
+        """Smallest nid >= nid that wasn't assigned before the pass"""
+        nid = index.next_free(nid)
+        if first_created <= nid <= newest:
+            nid = newest + 1
+        return nid
+
+    def next_used(nid):
+        """Smallest nid > nid that was assigned before the pass or None"""
+        following = index.next_used(nid)
+        if following is None and nid < newest:
+            following = max(nid + 1, first_created)
+        return following
+
+    freed = set()
+    freed_heap = []  # the freed nids not behind the last assigned nid
+    skip = {}  # freed nid: next nid after it that is still in use
+    writes = 0
+    last = 0
+    for idx, nid in enumerate(nids):
+        nxt = nids[idx + 1] if idx + 1 < len(nids) else nid + 1
+        if last != 0 and last < nid < nxt and not (nid in altered and nxt in altered):
+            last = nid
+            continue
+        if last != 0:
+            new_nid = last + 1
+        elif start and start != (nid // 1000):
+            new_nid = start * 1000
+        else:
+            last = nid
+            continue
+        while freed_heap and freed_heap[0] < new_nid:
+            heappop(freed_heap)
+        new_nid = next_free(new_nid)
+        if freed_heap and freed_heap[0] < new_nid:
+            new_nid = heappop(freed_heap)
+        following = next_used(new_nid)
+        passed = []
+        while following in freed:
+            passed.append(following)
+            following = skip[following] if following in skip else next_used(following)
+        for freed_nid in passed:
+            skip[freed_nid] = following
+        new_nid += GREEDY_ROOM if following is None else min(GREEDY_ROOM, following - new_nid - 1)
+        freed.add(nid)
+        heappush(freed_heap, nid)
+        if idx not in created:
+            writes += 1
+        last = new_nid
+    return writes
+
+
+def move_count(nids, targets):
+    """Number of existing notes whose nid changes"""
+    return sum(1 for old, new in zip(nids, targets) if old is not None and old != new)
+
+
+def walk_nids(nids, index, first=None, floor=0, ceiling=None, headroom=0):
+    """Plan nids row by row: keep a nid if it's bigger than its predecessor
+
+    Every other note gets the next free nid after its predecessor. first is the
+    nid the first row is pinned to. Returns the planned nids or None if they
+    don't fit below ceiling or the first row is a new note.
+    """
+    targets = []
+    last = floor
+    room = 0  # the headroom is only kept after planned nids
+    for pos, nid in enumerate(nids):
+        if pos == 0 and first is not None:
+            new = first
+        elif nid is not None and nid > last + room and (ceiling is None or nid < ceiling):
+            new = nid
+        elif pos == 0:
+            return None  # no predecessor to follow
+        else:
+            placed = free_nids_after(index, last, 1, ceiling, headroom)
+            if placed is None:
+                return None
+            new = placed[0]
+        room = headroom if new != nid else 0
+        targets.append(new)
+        last = new
+    return targets
+
+
+class NoRoom(Exception):
+    """The notes don't fit between floor and ceiling"""
+
+
+def plan_nid_order(nids, index, start=None, altered=(), floor=0, ceiling=None, headroom=0):
+    """Plan new nids so that nids ends up strictly increasing
+
+    Arguments:
+
+    - nids: list of existing nids (ints) in the desired order. Notes that will
+            only be created later are None, they always get a planned nid.
+    - index: NidIndex of the collection
+    - start: int, UNIX timestamp the first note should be created at. It's only
+             enforced if it differs from the date of the first nid, i.e. if the
+             user changed the date in the dialog.
+    - altered: nids moved or created by the user, only used for the comparison
+               with the greedy pass
+    - floor, ceiling: planned nids must be bigger than floor and smaller than
+               ceiling. Used if index only covers part of the collection, e.g.
+               for the window around a note in the reviewer. Raises NoRoom if
+               the notes can't be placed.
+    - headroom: minimal number of unused nids around each planned nid, a gap
+               that is too small for this is treated like a full one
+    """
+    count = len(nids)
+    targets = list(nids)
+    fixed_flags = [False] * count
+    low = floor  # all planned nids must be bigger than this
+    anchored = False
+
+    candidates = [pos for pos in range(count) if nids[pos] is not None]
+    if count and start and nids[0] is not None and start != nids[0] // 1000:
+        # the date of the first note was changed in the dialog
+        first = index.next_free(start * 1000)
+        if first <= floor or (ceiling is not None and first >= ceiling):
+            raise NoRoom("the first note can't start at {} with nids between {} and {}".format(
+                first, floor, ceiling))
+        targets[0] = first
+        fixed_flags[0] = True
+        low = first
+        anchored = True
+        candidates = [pos for pos in candidates[1:] if nids[pos] > low]
+
+    for k in longest_increasing_subsequence([nids[pos] for pos in candidates]):
+        fixed_flags[candidates[k]] = True
+
+    def place(pos, end):
+        before = targets[pos - 1] if pos else None
+        after = targets[end] if end < count else ceiling
+        if before is None and after is not None and not anchored:
+            return free_nids_before(index, after, end - pos, floor, headroom)
+        if before is None:
+            before = low
+        if after is None:  # after the last row there's room without limit
+            return free_nids_after(index, before, end - pos, None, headroom)
+        return spread_nids(index, before, after, end - pos, headroom)
+
+    def grow_right(end):
+        end += 1
+        while end < count and not fixed_flags[end]:
+            end += 1
+        return end
+
+    def grow_left(pos):
+        pos -= 1
+        while pos > 0 and not fixed_flags[pos - 1]:
+            pos -= 1
+        return pos
+
+    def place_runs():
+        pos = 0
+        while pos < count:
+            if fixed_flags[pos]:
+                pos += 1
+                continue
+            # collect the run of notes without a fixed nid
+            end = grow_right(pos - 1)
+            placed = place(pos, end)
+            if placed is None:
+                # gap too small: give up neighbouring fixed notes and shift them as
+                # well. Try both directions and take the one that renumbers less.
+                right_end = end
+                right = None
+                while right is None and right_end < count:
+                    right_end = grow_right(right_end)
+                    right = place(pos, right_end)
+                right_cost = right_end - pos if right is not None else count + 1
+                left_pos = pos
+                left = None
+                first_movable = 1 if anchored else 0  # the first row is pinned to start
+                while left is None and left_pos > first_movable and end - left_pos < right_cost:
+                    left_pos = grow_left(left_pos)
+                    left = place(left_pos, end)
+                if left is not None and end - left_pos < right_cost:
+                    for i in range(left_pos, pos):
+                        fixed_flags[i] = False
+                    pos, placed = left_pos, left
+                elif right is not None:
+                    for i in range(end, right_end):
+                        fixed_flags[i] = False
+                    end, placed = right_end, right
+                else:
+                    raise NoRoom("no room for {} note(s) between {} and {}".format(
+                        end - pos, floor, ceiling))
+            targets[pos:end] = placed
+            pos = end
+        return targets
+
+    # keeping the LIS can cost more than walking the rows and giving each note
+    # that's out of order the next free nid after its predecessor, e.g. for
+    # swapped neighbours among densely numbered notes: take the cheaper plan
+    no_room = None
+    try:
+        planned = place_runs()
+    except NoRoom as e:
+        planned, no_room = None, e
+    walked = walk_nids(nids, index, targets[0] if anchored else None, floor, ceiling, headroom)
+    if walked is not None and (planned is None or move_count(nids, walked) < move_count(nids, planned)):
+        planned = walked
+    if planned is None:
+        raise no_room
+    targets = planned
+
+    moves = {}
+    for old, new in zip(nids, targets):
+        if old is not None and old != new:
+            moves[old] = new
+    greedy = greedy_write_count(nids, start, altered, index)
+    return NidPlan(targets, moves, count - len(moves), greedy)
+
+
+class Creation:
+    """A note that is created from a "New: ..." or "Dupe: ..." row"""
+
+    def __init__(self, action, source_nid, ntype=None, sched=False):
+        self.action = action
+        self.source_nid = source_nid  # note the new note inherits deck, tags etc. from
+        self.ntype = ntype            # None for dupes
+        self.sched = sched
+        self.source_did = None        # deck of the new note, set by Rearranger.plan
+        self.nid = None               # planned nid
+        self.created_nid = None       # nid Anki gave the note when it was created
+
+
+class ReorganizationPlan:
+    """Everything processNids would do, computed without touching the collection
+
+    - rows: the notes in the desired order: nids (int) or Creation objects
+    - deletions: nids of notes to delete
+    - creations: Creation objects in row order
+    - moved: nids that were interactively moved by the user
+    - nid_plan: NidPlan for rows
+    - reposition: whether new cards are repositioned
+    - cards: {"renumbered": .., "deleted": .., "repositioned": ..} card counts
+    - field_updates: {old_nid: flds} of renumbered notes whose original nid is
+            stored in the backup field, written together with the renumbering
+    - field_flushes: {old_nid: [fields]} like field_updates for notes where the
+            backup field is the sort field or the first field, which are saved
+            as notes so that Anki updates its caches
+    """
+
+    def __init__(self, rows, deletions, creations, moved, nid_plan, start, reposition):
+        self.rows = rows
+        self.deletions = deletions
+        self.creations = creations
+        self.moved = moved
+        self.nid_plan = nid_plan
+        self.start = start
+        self.reposition = reposition
+        self.cards = {}
+        self.field_updates = {}
+        self.field_flushes = {}
+
+
+    @property
+    def renumbered(self):
+        """existing notes that get a new nid"""
+        return list(self.nid_plan.moves)
+
+
+    @property
+    def alongside(self):
+        """renumbered notes the user didn't move"""
+        moved = set(self.moved)
+        return [nid for nid in self.nid_plan.moves if nid not in moved]
+
+
+    @property
+    def estimated_writes(self):
+        """Rough number of note and card rows that are written"""
+        return (len(self.nid_plan.moves) + self.cards.get("renumbered", 0)
+                + len(self.deletions) + self.cards.get("deleted", 0)
+                + len(self.creations) + self.cards.get("repositioned", 0))
+
+
+    def is_empty(self):
+        return not (self.nid_plan.moves or self.deletions or self.creations)
@@ -8,17 +8,49 @@ Copyright: (c) 2017 Glutanimate
 License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
 """
 
-from pprint import pprint as pp
+from contextlib import contextmanager
+import logging
 
-from anki.errors import AnkiError
-from anki.utils import guid64, intTime, ids2str, pointVersion
+from anki.hooks import runHook
+from anki.utils import intTime, ids2str, pointVersion
 
 from aqt import mw
 from aqt.utils import tooltip
 
-from .config import anki_21_version, gc, mpp
+from .config import anki_21_version, backup_field, gc
 from .no_consts import *
 from .helpers import fields_to_fill_for_nonempty_front_template
+from .template_analysis import CLOZE_VALUE, MODEL_CLOZE, cloze_field_indexes
+from .nid_index import NidIndex
+from .planner import Creation, ReorganizationPlan, plan_nid_order
+from .bulk import (
+    REM_NOTE,
+    chunked,
+    renumber_notes,
+    reposition_new_cards,
+    restore_notes,
+    savepoint,
+    set_positions,
+)
+from . import journal
+from .instrumentation import PhaseTimer, Progress, log
+
+def planned_note_fields(model, fields, nid=None):
+    """fields of a new note of model with the backup field cleared (a new note
+    has no original nid) and the planned nid in "nids: nid field overwrite"
+
+    Shared with tools/reorganize_collection.py, which writes notes without Anki.
+    """
+    fields = list(fields)
+    names = [f["name"] for f in model["flds"]]
+    field = backup_field()
+    if field and field in names:
+        fields[names.index(field)] = ""
+    id_field = gc("nids: nid field overwrite")
+    if nid and id_field and id_field in names:  # add nid to note id field
+        fields[names.index(id_field)] = str(nid)
+    return fields
+
 
 class Rearranger:
     """Performs the actual database reorganization"""
@@ -29,9 +61,36 @@ class Rearranger:
         self.card = card  # card is not None only when called from the reviewer 
                           # context menu - onReviewerOrgMenu
         self.nid_map = {}  # in rearrange: self.nid_map[nid] = new_nid
+        self.nid_index = None  # NidIndex, loaded once per processNids run
+        self.progress = None  # instrumentation.Progress of the running apply
+        self.timer = None  # PhaseTimer of the running step, see db
+        self.browser_cids = self.browserCards(browser)
+
+
+    @property
+    def db(self):
+        """col.db, while a step runs the statements through it are counted
+
+        col.db itself is never replaced, the main thread keeps using it while
+        execute runs in the background.
+        """
+        if self.timer is not None:
+            return self.timer.db
+        return self.mw.col.db
+
+
+    @contextmanager
+    def timed(self, name, progress=None):
+        """PhaseTimer of one step that counts the statements run through self.db"""
+        with PhaseTimer(name, self.mw.col.db, progress) as timer:
+            self.timer = timer
+            try:
+                yield timer
+            finally:
+                self.timer = None
 
 
-    def processNids(self, all_rows_nids_raw, start, moved_nids, repos=False):
+    def processNids(self, all_rows_nids_raw, start, moved_nids, repos=False, bounds=None):
         """
         Main function
 
@@ -43,8 +102,120 @@ class Rearranger:
         - start: int, creation date of first note (first row in dialog) as UNIX timestamp
         - moved_nids: list, nids that were interactively moved by the user
         - repos: boolean, whether to reposition due dates or not
+        - bounds: None or tuple (floor, ceiling), the rows are only a window of
+                 the collection and all nids must stay between floor and
+                 ceiling (exclusive, ceiling may be None). Raises
+                 planner.NoRoom if they don't fit.
+        """
+        plan = self.plan(all_rows_nids_raw, start, moved_nids, repos=repos, bounds=bounds)
+        return self.execute(plan)
+
+
+    def plan(self, all_rows_nids_raw, start, moved_nids, repos=False, bounds=None):
+        """Compute what processNids would do without modifying the collection
+
+        Same arguments as processNids, returns a ReorganizationPlan.
+        """
+        with self.timed("plan") as timer:
+            floor, ceiling = bounds or (0, None)
+            with timer.phase("load index") as phase:
+                if bounds:
+                    # only the nids in the window matter, don't load the whole collection
+                    self.nid_index = NidIndex.from_db(self.db, floor, ceiling)
+                else:
+                    self.nid_index = NidIndex.from_db(self.db)
+                phase["notes"] = len(self.nid_index)
+
+            with timer.phase("parseActions") as phase:
+                rows, deletions, creations = self.parseActions(all_rows_nids_raw)
+                phase["notes"] = len(rows)
+            with timer.phase("source decks") as phase:
+                for creation in creations:
+                    creation.source_did = self.sourceDeck(creation.source_nid)
+                phase["notes"] = len(creations)
+            with timer.phase("plan_nid_order") as phase:
+                nid_plan = plan_nid_order(
+                    [None if isinstance(row, Creation) else row for row in rows],
+                    self.nid_index, start, moved_nids, floor, ceiling,
+                    gc("nids: minimum headroom", 0))
+                phase["notes"] = len(nid_plan.moves)
+            for row, new_nid in zip(rows, nid_plan.nidlist):
+                if isinstance(row, Creation):
+                    row.nid = new_nid
+            log.info("planned %s nid changes, %s notes unchanged, the greedy pass would have needed %s",
+                     len(nid_plan.moves), nid_plan.fixed, nid_plan.greedy_writes)
+
+            plan = ReorganizationPlan(rows, deletions, creations, moved_nids, nid_plan, start, repos)
+            with timer.phase("backup fields") as phase:
+                plan.field_updates, plan.field_flushes = self.backupFieldUpdates(nid_plan.moves)
+                phase["notes"] = len(plan.field_updates) + len(plan.field_flushes)
+            with timer.phase("count cards"):
+                db = self.db
+                plan.cards["renumbered"] = db.scalar(
+                    "select count() from cards where nid in " + ids2str(nid_plan.moves)) or 0
+                plan.cards["deleted"] = db.scalar(
+                    "select count() from cards where nid in " + ids2str(deletions)) or 0
+                if repos:
+                    existing = [row for row in rows if not isinstance(row, Creation)]
+                    plan.cards["repositioned"] = (db.scalar(
+                        "select count() from cards where type = 0 and nid in " + ids2str(existing)) or 0
+                        ) + len(creations)
+        return plan
+
+
+    def backupFieldUpdates(self, moves):
+        """Fields of the notes in moves with their original nid in the backup field
+
+        Notes whose backup field is already filled keep it and are left out. Only
+        reads the fields with one query, no note is loaded. Returns the
+        field_updates and field_flushes of ReorganizationPlan.
+        """
+        field = backup_field()
+        updates = {}
+        flushes = {}
+        if not field or not moves:
+            return updates, flushes
+        models = {}  # mid: (index of the backup field or None, needs flush)
+        for nid, mid, flds in self.db.all(
+                "select id, mid, flds from notes where id in " + ids2str(moves)):
+            if mid not in models:
+                model = self.mw.col.models.get(mid)
+                names = [f["name"] for f in model["flds"]] if model else []
+                idx = names.index(field) if field in names else None
+                models[mid] = (idx, idx in (0, model.get("sortf", 0)) if model else False)
+            idx, flush = models[mid]
+            if idx is None:
+                continue
+            values = flds.split("\x1f")
+            if idx >= len(values) or values[idx]:
+                continue
+            values[idx] = str(nid)
+            if flush:
+                flushes[nid] = values
+            else:
+                updates[nid] = "\x1f".join(values)
+        return updates, flushes
+
+
+    def execute(self, plan, progress=None):
+        """Apply a ReorganizationPlan, returns the nids to select in the browser
+
+        Same as apply followed by finish, on the main thread.
         """
-        
+        return self.finish(plan, self.apply(plan, progress))
+
+
+    def apply(self, plan, progress=None):
+        """The database part of execute, doesn't touch the GUI
+
+        Can run in a background thread (2.1.28+). Everything happens in one
+        savepoint, with nested savepoints per chunk of "general: chunk size"
+        notes, so that any exception rolls back the whole run. progress is an
+        instrumentation.Progress that is updated per phase and per chunk. If
+        it's cancelled, the run stops after the current chunk, is rolled back
+        and Cancelled is raised. Returns what finish needs.
+        """
+
         # glutanimate's code from 2017 had
             # Full database sync required:
             # try:
@@ -53,35 +224,186 @@ class Rearranger:
             #     tooltip("Reorganization aborted.")
             #     return False
         # in 2020 Arthur extended Advanced Browser with a nid-change function that doesn't require
-        # a full database upload, see my comments below in updateNidSafely and see
+        # a full database upload, see my comments below in changeNid and see
         # https://github.com/hssm/advanced-browser/commit/7fba8f30f0ebd12b2f458f8a56ec7c6c068ddf24
 
-        # Create checkpoint
-        self.mw.checkpoint("Reorganize notes")
+        progress = progress or Progress()
+        progress.total = (len(plan.deletions) + len(plan.creations) + len(plan.nid_plan.moves)
+                          + (len(plan.rows) if plan.reposition else 0))
+        progress.check()
+        self.progress = progress
+        with self.timed("processNids", progress) as timer:
+            # instead of a checkpoint of the whole collection only what changes is
+            # recorded, see revert
+            with timer.phase("journal") as phase:
+                db = self.db
+                undo = journal.Journal(self.mw.pm.name)
+                undo.record_deletions(db, plan.deletions)
+                undo.record_fields(db, list(plan.field_updates) + list(plan.field_flushes),
+                                   plan.field_flushes)
+                phase["notes"] = len(undo.fields) + len(undo.deleted_notes)
+            try:
+                with savepoint(self.db, "note_organizer"):
+                    applied = self._apply(plan, timer, progress, undo)
+            except BaseException:
+                # the database is back where it was, forget what this run did
+                self.nid_index = None
+                self.nid_map = {}
+                for creation in plan.creations:
+                    creation.created_nid = None
+                raise
+            finally:
+                self.progress = None
+            undo.save()
+            return applied
+
+
+    def _apply(self, plan, timer, progress, undo):
+        if self.nid_index is None:
+            self.nid_index = NidIndex.from_db(self.db)
+
+        with timer.phase("processActions") as phase:
+            deleted_nids, created_nids = self.processActions(plan, progress)
+            phase["notes"] = len(deleted_nids) + len(created_nids)
+        progress.advance(len(deleted_nids))
+        progress.check()
+        with timer.phase("adjust_nid_order") as phase:
+            modified, nidlist = self.adjust_nid_order(plan, created_nids)
+            undo.nid_map = dict(plan.nid_plan.moves)
+            undo.created = [c.nid for c in plan.creations if c.created_nid]
+            phase["notes"] = len(modified) + len(created_nids)
+        progress.check()
+
+        if plan.reposition:
+            with timer.phase("reposition") as phase:
+                targeted = gc("general: reposition mode", "targeted") != "collection"
+                undo.record_positions(self.db, nidlist if targeted else None)
+                self.reposition(nidlist, undo.created)
+                phase["notes"] = len(nidlist)
+            progress.advance(len(plan.rows))
+            progress.check()
+        return deleted_nids, created_nids, modified
+
+
+    def finish(self, plan, applied):
+        """The GUI part of execute, on the main thread after apply"""
+        deleted_nids, created_nids, modified = applied
+        moved_nids = plan.moved
+
+        # an open Organizer patches its rows with this instead of rebuilding
+        # its table on the following reset
+        runHook("noteOrganizer.changed", self.changes(plan, deleted_nids))
+
+        with self.timed("finish") as timer:
+            with timer.phase("reset"):
+                self.mw.col.reset()
+                self.mw.reset()
+
+            tooltip("Reorganization complete:<br>"
+                "<b>{}</b> note(s) <b>moved</b><br>"
+                "<b>{}</b> note(s) <b>deleted</b><br>"
+                "<b>{}</b> note(s) <b>created</b><br>"
+                "<b>{}</b> note(s) <b>updated alongside</b><br>"
+                "<b>{}</b> renumbering(s) <b>avoided</b><br>".format(
+                    len(moved_nids), len(deleted_nids), len(created_nids), 
+                    len([nid for nid in modified if nid not in moved_nids]),
+                    plan.nid_plan.saved_writes),
+                parent=self.browser)
+
+            to_select = moved_nids + [c.nid for c in plan.creations if c.created_nid]
+            if self.browser:
+                with timer.phase("selectNotes") as phase:
+                    self.selectNotes(self.browser, to_select)
+                    phase["notes"] = len(to_select)
 
-        processed_nids, deleted_nids, created_nids = self.processActions(all_rows_nids_raw)
-        modified, nidlist = self.adjust_nid_order(processed_nids, start, moved_nids, created_nids)
+        return(to_select)
 
-        if repos:
-            self.reposition(nidlist)
 
-        self.mw.col.reset()
-        self.mw.reset()
+    def revert(self, undo):
+        """Undo the reorganization recorded in a journal.Journal
 
-        tooltip("Reorganization complete:<br>"
-            "<b>{}</b> note(s) <b>moved</b><br>"
-            "<b>{}</b> note(s) <b>deleted</b><br>"
-            "<b>{}</b> note(s) <b>created</b><br>"
-            "<b>{}</b> note(s) <b>updated alongside</b><br>".format(
-                len(moved_nids), len(deleted_nids), len(created_nids), 
-                len(modified)-len(moved_nids)),
+        Raises journal.StaleJournal if the collection changed in a way that
+        conflicts with this, see rollback.
+        """
+        back = {new: old for old, new in undo.nid_map.items()}
+        if undo.profile != self.mw.pm.name:
+            raise journal.StaleJournal("The last reorganization was done in another profile.")
+        existing = set(self.db.list("select id from notes where id in " + ids2str(
+            list(back) + list(back.values()) + [row[0] for row in undo.deleted_notes])))
+        if len(existing & set(back)) != len(back):
+            raise journal.StaleJournal("Some of the reorganized notes were deleted or changed since.")
+        if existing - set(back) - set(undo.created):
+            raise journal.StaleJournal("Some of the old note ids are in use again.")
+
+        with self.timed("revert") as timer:
+            with timer.phase("rollback") as phase:
+                with savepoint(self.db, "note_organizer"):
+                    removed = self.rollback(undo)
+                phase["notes"] = len(back) + removed + len(undo.deleted_notes)
+            journal.discard()
+            with timer.phase("reset"):
+                self.mw.col.reset()
+                self.mw.reset()
+        tooltip("Reorganization reverted:<br>"
+            "<b>{}</b> note(s) <b>renumbered back</b><br>"
+            "<b>{}</b> note(s) <b>removed</b><br>"
+            "<b>{}</b> note(s) <b>restored</b><br>".format(
+                len(back), removed, len(undo.deleted_notes)),
             parent=self.browser)
 
-        to_select = moved_nids + created_nids
-        if self.browser:
-            self.selectNotes(self.browser, to_select)
 
-        return(to_select)
+    def rollback(self, undo):
+        """Database part of revert
+
+        Removes the created notes, gives the renumbered notes their old nids and
+        fields back, inserts the deleted notes again and restores the positions
+        of the repositioned cards, each with a few set-based statements.
+        Returns the number of removed notes.
+        """
+        db = self.db
+        back = {new: old for old, new in undo.nid_map.items()}
+        usn = self.mw.col.usn()
+        mod = intTime()
+        removed = db.list("select id from notes where id in " + ids2str(undo.created))
+        if removed:
+            if pointVersion() < 28:
+                self.mw.col.remNotes(removed)
+            else:
+                self.mw.col.remove_notes(removed)
+        flds = {undo.nid_map[old]: fields for old, fields in undo.fields.items()
+                if old in undo.nid_map}
+        renumber_notes(db, back, usn, mod, flds)
+        # the graves of the old nids weren't synced yet, the notes are back
+        db.execute("delete from graves where usn = -1 and type = ? and oid in " + ids2str(back.values()),
+                   REM_NOTE)
+        self.writeFields({old: undo.fields[old].split("\x1f")
+                          for old in undo.flushed if old in undo.nid_map})
+        restore_notes(db, undo.deleted_notes, undo.deleted_cards, usn, mod)
+        set_positions(db, undo.positions, usn, mod)
+        return len(removed)
+
+
+    def changes(self, plan, deleted_nids):
+        """What execute changed, passed to the "noteOrganizer.changed" hook
+
+        - renumbered: {old_nid: new_nid} of the existing notes
+        - deleted: nids of the deleted notes
+        - created: [(nid, previous_nid)] of the new notes, previous_nid is the
+                   nid of the note in front of it or None
+        """
+        created = []
+        previous = None
+        for row, nid in zip(plan.rows, plan.nid_plan.nidlist):
+            if isinstance(row, Creation):
+                if not row.created_nid:
+                    continue
+                created.append((nid, previous))
+            previous = nid
+        return {
+            "renumbered": dict(plan.nid_plan.moves),
+            "deleted": list(deleted_nids),
+            "created": created,
+        }
 
 
     def first_valid_nid_in_nids_list(self, nids):
@@ -98,23 +420,26 @@ class Rearranger:
         return curr
 
 
-    def processActions(self, all_rows_nids_raw):
+    def parseActions(self, all_rows_nids_raw):
         """
-        Parse and execute actions in nid list (e.g. note creation)
+        Parse the actions in the nid list (e.g. note creation) without executing them
         Also converts nids to ints
+
+        Returns rows (nids and Creation objects in the desired order), the nids
+        to delete and the Creation objects
         TODO: Find a more elegant solution to pass commands from
               the Organizer to the Rearranger
         """
-        processed = []
-        deleted = []
-        created = []
+        rows = []
+        deletions = []
+        creations = []
 
         for idx, nid in enumerate(all_rows_nids_raw):
             # if I insert a new note in the gui from the browser nid is e.g. 
             # "New: Same note type as previous"
             try:
                 # Regular NID, no action
-                processed.append(int(nid))
+                rows.append(int(nid))
                 continue
             except ValueError:
                 vals = nid.split(": ")
@@ -140,11 +465,7 @@ class Rearranger:
                 nnid = int(data[0])
                 if not nnid or not self.noteExists(nnid):
                     continue
-                if pointVersion() < 28:
-                    self.mw.col.remNotes([nnid])
-                else:  # not needed because internally remove_notes calls remNotes (at the moment)
-                    self.mw.col.remove_notes([nnid])
-                deleted.append(nnid)
+                deletions.append(nnid)
                 continue
             elif action.startswith((NEW_NOTE, DUPE_NOTE)):
                 # Actions: New, Dupe, Dupe with Scheduling
@@ -161,89 +482,178 @@ class Rearranger:
                     neighboring_nid = nxt or self.first_valid_nid_in_nids_list(all_rows_nids_raw)
                 if not neighboring_nid or not self.noteExists(neighboring_nid):
                     continue
-                nid = self.addNote(neighboring_nid, ntype=ntype, sched=sched)
-                if not nid:
-                    continue
-                created.append(int(nid))
-                processed.append(int(nid))
+                creation = Creation(action, neighboring_nid, ntype=ntype, sched=sched)
+                creations.append(creation)
+                rows.append(creation)
+
+        # sources that are deleted in the same run can't be used
+        deleted = set(deletions)
+        for creation in [c for c in creations if c.source_nid in deleted]:
+            creations.remove(creation)
+            rows.remove(creation)
+        return rows, deletions, creations
+
+
+    def processActions(self, plan, progress=None):
+        """
+        Execute the deletions and creations of a ReorganizationPlan
+
+        Returns the deleted nids and the nids of the created notes. These nids
+        are only temporary, adjust_nid_order moves the new notes to their planned
+        nids. progress: see addNotes
+        """
+        deleted = []
+        created = []
+
+        # one existence check and one deletion pass for all notes instead of
+        # running Anki's deletion (cards, graves, undo) once per note
+        if plan.deletions:
+            deleted = self.db.list(
+                "select id from notes where id in " + ids2str(plan.deletions))
+        if deleted:
+            if pointVersion() < 28:
+                self.mw.col.remNotes(deleted)
+            else:  # not needed because internally remove_notes calls remNotes (at the moment)
+                self.mw.col.remove_notes(deleted)
+            self.nid_index.update(removed=deleted)
+
+        created = self.addNotes(plan.creations, progress)
+
+        return deleted, created
+
+
+    def addNotes(self, creations, progress=None):
+        """
+        Create the notes for a list of Creation objects and set their created_nid
+
+        The creations are grouped by note type and deck so that the note type and
+        deck are looked up, selected and saved once per group instead of once per
+        note, and all notes of a group are added in one call where Anki supports
+        it (2.1.55+). Returns the nids of the created notes in row order.
+
+        Groups with more than "general: chunk size" notes are added in chunks,
+        each in its own savepoint. progress (instrumentation.Progress) advances
+        after every chunk, once it's cancelled Cancelled is raised.
+        """
+        models = {}  # mid: note type, filled on demand
+        groups = {}  # (mid, did): [(creation, source note)]
+        for creation in creations:
+            if not self.noteExists(creation.source_nid):
+                continue
+            if creation.source_did is None:
+                continue
+            neighbNid = self.nid_map.get(creation.source_nid, creation.source_nid)
+            sourceNote = self.mw.col.getNote(neighbNid)
+            model = self.modelFor(creation.ntype, sourceNote, models)
+            if model is None:
+                continue
+            groups.setdefault((model["id"], creation.source_did), []).append((creation, sourceNote))
+
+        sched_pairs = []  # (source nid, new nid) of dupes with scheduling
+        for (mid, did), group in groups.items():
+            model = models[mid]
+            self.selectModelAndDeck(model, did)
+            for members in chunked(group, gc("general: chunk size", 2000)):
+                with savepoint(self.db, "no_add_chunk"):
+                    new_notes = [self.newNote(model, sourceNote, creation.ntype, creation.nid)
+                                 for creation, sourceNote in members]
+                    self.addNotesToCollection(new_notes, did)
+                if self.nid_index is not None:
+                    self.nid_index.update(added=[n.id for n in new_notes if n.id])
+                for (creation, sourceNote), new_note in zip(members, new_notes):
+                    if not new_note.id:
+                        continue
+                    if creation.sched:
+                        sched_pairs.append((sourceNote.id, new_note.id))
+                    creation.created_nid = int(new_note.id)
+                if progress is not None:
+                    progress.chunk_done(len(members))
 
-        return processed, deleted, created
+        # Copy over scheduling from old cards for dupes
+        self.copyScheduling(sched_pairs)
+
+        return [c.created_nid for c in creations if c.created_nid]
+
+
+    def browserCards(self, browser):
+        """Ids of the cards shown in browser, None in notes mode or without a browser
 
+        Read once on the main thread, sourceDeck can then run in the background
+        without touching the browser's table.
+        """
+        if browser is None:
+            return None
+        if anki_21_version <= 44:
+            return set(browser.model.cards)
+        if browser.table.is_notes_mode():
+            return None
+        return set(browser.table._model._items)
 
-    def addNote(self, neighbNid, ntype=None, sched=False):
+
+    def sourceDeck(self, nid):
         """
-        Create new note based on a neighboring nid: This is used as the source note from which
-        the new note will inherit: 
+        Deck of the note a new note is based on, the new note is added to it:
            - For empty new notes it seems to be the following note
            - for dupes it seems to be the preceeding note
+        Prefers a card that is shown in the browser. None if the note has no cards.
         """
-        neighbNid = self.nid_map.get(neighbNid, neighbNid)
-        sourceNote = self.mw.col.getNote(neighbNid)
-        
-        if not self.card:   # self.card only if called from the reviewer - so this condition is True if called from the browser
-            if anki_21_version <= 44:
-                sourceCids = self.mw.col.db.list(
-                        "select id from cards where nid = ? order by ord", neighbNid)
-                try:
-                    visible_source_cid = sourceCids[0]
-                except IndexError:
-                    # invalid state: note has no cards
-                    return None
-                
-                # try to use visible card if available
-                if self.browser:
-                    for cid in sourceCids:
-                        if cid in self.browser.model.cards:
-                            visible_source_cid = cid
-                            break
-                source_card = self.mw.col.getCard(visible_source_cid)
-            else:
-                #cids_in_browser = self.browser.table._model.get_card_ids([self.browser.table._model.len_rows()])
-                # self.browser.table._model._items all nids or cids
-                if self.browser.table.is_notes_mode():
-                    source_card = sourceNote.cards()[0]
-                    
-                else:  # really useful?
-                    all_cids_in_browser = self.browser.table._model._items
-
-                    note = self.mw.col.get_note(neighbNid)
-                    sourceCids = note.card_ids()
-                    try:
-                        visible_source_cid = sourceCids[0]
-                    except IndexError:
-                        # invalid state: note has no cards
-                        return None
-                    
-                    # try to use visible card if available
-                    if self.browser:
-                        for cid in sourceCids:
-                            if cid in all_cids_in_browser:
-                                visible_source_cid = cid
-                                break
-                    source_card = self.mw.col.getCard(visible_source_cid)
-        else:
-            source_card = self.card
-        
-        # gather model/deck information
-        source_did = source_card.odid or source_card.did # account for dyn decks
-        source_deck = self.mw.col.decks.get(source_did)
+        if self.card:  # self.card only if called from the reviewer
+            return self.card.odid or self.card.did  # account for dyn decks
+        source_cards = self.db.all(
+            "select id, odid, did from cards where nid = ? order by ord", nid)
+        if not source_cards:
+            # invalid state: note has no cards
+            return None
+        visible = source_cards[0]
+        if self.browser_cids:
+            for card in source_cards:
+                if card[0] in self.browser_cids:
+                    visible = card
+                    break
+        return visible[1] or visible[2]  # account for dyn decks
 
+
+    def modelFor(self, ntype, sourceNote, models):
+        """Note type of a new note, models caches them by id"""
         if not ntype or ntype == MODEL_SAME:
-            model = sourceNote.model()
-        else:
-            model = self.mw.col.models.byName(ntype)
-        
+            mid = sourceNote.mid
+            if mid not in models:
+                models[mid] = sourceNote.model()
+            return models[mid]
+        for model in models.values():
+            if model["name"] == ntype:
+                return model
+        model = self.mw.col.models.byName(ntype)
+        if model is not None:
+            models[model["id"]] = model
+        return model
+
+
+    def selectModelAndDeck(self, model, did):
+        """Make the note type and the deck the defaults for each other, saves only changes"""
+        source_deck = self.mw.col.decks.get(did)
         # Assign model to deck
-        self.mw.col.decks.select(source_did)
-        source_deck['mid'] = model['id']
-        self.mw.col.decks.save(source_deck)
+        self.mw.col.decks.select(did)
+        if source_deck.get('mid') != model['id']:
+            source_deck['mid'] = model['id']
+            self.mw.col.decks.save(source_deck)
         # Assign deck to model
         self.mw.col.models.setCurrent(model)
-        model['did'] = source_did
-        self.mw.col.models.save(model)
-        
-        # Create new note
-        new_note = self.mw.col.newNote()
+        if model.get('did') != did:
+            model['did'] = did
+            self.mw.col.models.save(model)
+
+
+    def newNote(self, model, sourceNote, ntype, nid=None):
+        """Note (not added yet) with the tags of sourceNote and either its fields (dupes)
+        or only the fields needed to generate the first card
+
+        nid is the planned nid, it's written to the "nids: nid field overwrite" field.
+        """
+        if hasattr(self.mw.col, "new_note"):
+            new_note = self.mw.col.new_note(model)
+        else:
+            new_note = self.mw.col.newNote()  # uses the current note type, see selectModelAndDeck
         new_note.tags = sourceNote.tags
         if not ntype: # dupe
             fields = sourceNote.fields
@@ -259,124 +669,147 @@ class Rearranger:
             else:
                 for i in tofill:
                     fields[i] = "."
-        new_note.fields = fields
-        if gc("BACKUP_FIELD") in new_note: # skip onid field
-            new_note[gc("BACKUP_FIELD")] = ""
-        
-        # Refresh note and add to database
-        if pointVersion() < 28:
-            new_note.flush()
-            self.mw.col.addNote(new_note)
-        else:  # 2.1.28+
-            mw.col.add_note(new_note, source_did)
-        # Copy over scheduling from old cards for dupes
-        if sched:
-            scards = sourceNote.cards()
-            ncards = new_note.cards()
-            for orig, copy in zip(scards, ncards):
-                self.copyCardScheduling(orig, copy)
+            if model["type"] == MODEL_CLOZE:  # "." doesn't create a cloze card
+                for i in cloze_field_indexes(model):
+                    fields[i] = CLOZE_VALUE
+        new_note.fields = planned_note_fields(model, fields, nid)
+        return new_note
 
-        return new_note.id
+
+    def addNotesToCollection(self, new_notes, did):
+        """Add new notes to the deck did, sets their ids"""
+        if pointVersion() < 28:
+            for new_note in new_notes:
+                new_note.flush()
+                self.mw.col.addNote(new_note)
+            return
+        try:
+            from anki.collection import AddNoteRequest  # 2.1.55+
+        except ImportError:
+            AddNoteRequest = None
+        if AddNoteRequest is not None and hasattr(self.mw.col, "add_notes"):
+            self.mw.col.add_notes([AddNoteRequest(note=n, deck_id=did) for n in new_notes])
+        else:
+            for new_note in new_notes:
+                self.mw.col.add_note(new_note, did)
 
 
-    def adjust_nid_order(self, processed_nids, start, moved_nids, created_nids):
+    def adjust_nid_order(self, plan, created_nids):
         """
         original name: rearrange
-        only called from self.processNids
+        only called from self.execute
 
-        unchanged passed through in processNids
-        - start: int, creation date of first note (first row in dialog) as UNIX timestamp
-        - moved_nids: list, nids that were interactively moved by the user
+        Applies the nid changes of plan.nid_plan (see planner.plan_nid_order which
+        keeps the longest increasing subsequence of nids and only renumbers the
+        other notes) and moves the notes created by processActions to their
+        planned nids.
 
+        Returns the old nids of the renumbered existing notes and the final nids
+        of all rows.
         """
         modified = []
-        nidlist = []
-        altered_nids = moved_nids + created_nids
-        last = 0
+        moves = dict(plan.nid_plan.moves)
+        created_moves = {}
+        for creation in plan.creations:
+            if creation.created_nid and creation.created_nid != creation.nid:
+                created_moves[creation.created_nid] = creation.nid
+        # a new note might have gotten a nid that is planned for another note:
+        # move it out of the way first
+        targets = set(moves.values()) | set(created_moves.values())
+        detour = {}
+        for nid in list(created_moves):
+            if nid in targets:
+                free = self.nid_index.next_free(nid)
+                while free in targets:
+                    free = self.nid_index.next_free(free + 1)
+                detour[nid] = free
+                created_moves[free] = created_moves.pop(nid)
+        if detour:
+            self.applyMoves(detour)
+        moves.update(created_moves)
+
+        # the backup fields are written with the renumbering, see backupFieldUpdates
+        self.applyMoves(moves, plan.field_updates)
+        self.writeFields({moves[nid]: values for nid, values in plan.field_flushes.items()})
+
+        debug = log.isEnabledFor(logging.DEBUG)
+        for nid, new_nid in moves.items():
+            if debug:
+                log.debug("modifying %s -> %s", nid, new_nid)
+            if nid in plan.nid_plan.moves:
+                modified.append(nid)
 
-        for idx, nid in enumerate(processed_nids):
-            try:
-                nxt = int(processed_nids[idx+1])
-            except (IndexError, ValueError):
-                nxt = nid + 1
+            # keep track of moved nids (e.g. for dupes)
+            self.nid_map[nid] = new_nid
+        for nid, free in detour.items():
+            self.nid_map[nid] = self.nid_map.get(free, free)
 
-            if not self.noteExists(nid): # note deleted
-                continue
- 
-            nmvd = "{}".format(nxt in moved_nids).ljust(5)
-            xpctd = "{}".format(last < nid < nxt).ljust(5)
-            print(f"___last:{last}, nid:{nid}, next:{nxt}, nextmoved:{nmvd}, expected:{xpctd}")
-            # check if order as expected
-            if last != 0 and last < nid < nxt:
-                if nid in altered_nids and nxt in altered_nids:
-                    print("moved block")  # pass
-                else:
-                    print("skipping")
-                    last = nid
-                    nidlist.append(nid)
-                    continue
+        nidlist = [nid for nid in plan.nid_plan.nidlist if self.noteExists(nid)]
+        return modified, nidlist
 
-            if last != 0:
-                new_nid = last + 1 # regular nids
-            elif start and start != (nid // 1000):
-                new_nid = start * 1000 # first nid, date changed
-            else:
-                print("skipping first nid")
-                last = nid # first nid, date unmodified
-                nidlist.append(nid)
-                continue
 
-            print("modifying")
-            
-            
-            new_nid = self.updateNidSafely(nid, new_nid)
+    def applyMoves(self, moves, field_updates=None):
+        """Change nids according to {old_nid: new_nid}
 
-            if nid not in created_nids:
-                modified.append(new_nid)
-                idnote = False
-            else:
-                idnote = True
+        field_updates: {old_nid: flds}, see ReorganizationPlan.field_updates
+        """
+        field_updates = field_updates or {}
+        if pointVersion() >= 28:
+            self.renumberNotes(moves, field_updates)
+        else:
+            for nid, new_nid in moves.items():
+                self.changeNid(nid, new_nid)
+            self.writeFields({moves[nid]: flds.split("\x1f")
+                              for nid, flds in field_updates.items() if nid in moves})
 
-            self.setNidFields(new_nid, nid, idnote=idnote)
 
-            # keep track of moved nids (e.g. for dupes)
-            self.nid_map[nid] = new_nid
-            
-            print(("new_nid", new_nid))
-            nidlist.append(new_nid)
-            last = new_nid
+    def writeFields(self, fields):
+        """Save {nid: [fields]} note by note so that Anki updates sort field and checksum"""
+        for nid, values in fields.items():
+            note = self.mw.col.getNote(nid)
+            note.fields = values
+            note.flush()
 
-        return modified, nidlist
 
+    def copyScheduling(self, pairs):
+        """Copy scheduling data from the cards of the original notes to the cards
+        with the same ord of their dupes
 
-    def copyCardScheduling(self, o, c):
-        """Copy scheduling data over from original card"""
-        self.mw.col.db.execute(
+        pairs: list of (original nid, dupe nid). Two queries and one executemany
+        for all dupes of a run.
+        """
+        if not pairs:
+            return
+        db = self.db
+        sources = {}
+        for row in db.all(
+                "select nid, ord, type, queue, due, ivl, factor, reps, lapses, left "
+                "from cards where nid in " + ids2str({source for source, _ in pairs})):
+            sources[(row[0], row[1])] = row[2:]
+        source_of = {dupe: source for source, dupe in pairs}
+        updates = []
+        for cid, nid, ord in db.all(
+                "select id, nid, ord from cards where nid in " + ids2str(source_of)):
+            sched = sources.get((source_of[nid], ord))
+            if sched is not None:
+                updates.append(tuple(sched) + (cid,))
+        db.executemany(
             "update cards set type=?, queue=?, due=?, ivl=?, "
-            "factor=?, reps=?, lapses=?, left=? where id = ?",
-            o.type, o.queue, o.due, o.ivl,
-            o.factor, o.reps, o.lapses, o.left, c.id)
+            "factor=?, reps=?, lapses=?, left=? where id = ?", updates)
 
 
     def noteExists(self, nid):
-        """Checks the database to see whether the nid is actually assigned"""
-        return self.mw.col.db.scalar(
+        """Checks whether the nid is actually assigned"""
+        if self.nid_index is not None:
+            return nid in self.nid_index
+        return self.db.scalar(
             """select id from notes where id = ?""", nid)
 
 
-    def updateNidSafely(self, old_nid, new_nid):
-        """Update nid while ensuring that timestamp doesn't already exist"""
-        while self.noteExists(new_nid):
-            new_nid += 1
-
-        # Leave some room for future changes when possible
-        for i in range(20):
-            new_nid += 1
-            if self.noteExists(new_nid):
-                new_nid -= 1
-                break
-
-        
+    def changeNid(self, old_nid, new_nid):
+        """Change the nid of a note to new_nid, which must not be assigned (before 2.1.28,
+        newer versions use renumberNotes)"""
+        self.nid_index.rename(old_nid, new_nid)
         # Glutanimate had this:
         # # Update note row
         # self.mw.col.db.execute("""update notes set id=? where id = ?""", new_nid, old_nid)
@@ -402,49 +835,44 @@ class Rearranger:
         """
         note = self.mw.col.getNote(old_nid)
         cards = note.cards()
-        if pointVersion() < 28:
-            note.id = new_nid
-            note.flush()
-            for card in cards:
-                card.nid = new_nid
-                card.flush()
-            self.mw.col._remNotes([old_nid])
-            return new_nid
-        else:  # 2.1.28+
-            note.id = 0
-            note.guid = guid64()
-            mw.col.add_note(note, 0)
-            mw.col.db.execute(f"DELETE FROM cards WHERE nid = {note.id}")  # needed?
-            mw.col.db.execute(f"update notes set id={new_nid} WHERE id = {note.id}")
-            mw.col.db.execute(f"update cards set nid={new_nid} WHERE nid = {old_nid}")
-            mw.col.remove_notes([old_nid])
-
-            # Mark notes and cards as modified and set for sync - copied from "Duplicate and reorder"
-            note = mw.col.getNote(new_nid)
-            note.usn = mw.col.usn()
-            for card in note.cards():
-                card.usn = mw.col.usn()
-                card.flush()
-            note.flush()
-            return new_nid
-
-    def setNidFields(self, nid, onid, idnote=False):
-        """Store original NID in a predefined field (if available)"""
-        note = self.mw.col.getNote(nid)
-        if gc("BACKUP_FIELD") in note and not note[gc("BACKUP_FIELD")]:
-            note[gc("BACKUP_FIELD")] = str(onid)
-        if idnote and gc("nids: nid field overwrite") in note: # add nid to note id field
-            note["Note ID"] = str(nid)
+        note.id = new_nid
         note.flush()
+        for card in cards:
+            card.nid = new_nid
+            card.flush()
+        self.mw.col._remNotes([old_nid])
+        return new_nid
 
 
-    def reposition(self, nidlist):
-        cids = self.mw.col.db.list(
+    def renumberNotes(self, nid_map, field_updates=None):
+        """Apply {old_nid: new_nid} with a few set-based statements (2.1.28+)
+
+        Replaces one changeNid call per note, see bulk.renumber_notes.
+        field_updates ({old_nid: flds}) are written in the same statement.
+        """
+        renumber_notes(self.db, nid_map, self.mw.col.usn(), intTime(), field_updates,
+                       chunk_size=gc("general: chunk size", 2000),
+                       on_chunk=self.progress.chunk_done if self.progress else None)
+        self.nid_index.rename_many(nid_map)
+
+
+    def reposition(self, nidlist, created=()):
+        """Sort the new cards of nidlist (in row order), created are the nids of new notes
+
+        "general: reposition mode": "targeted" only reuses the positions these
+        cards already have (see bulk.reposition_new_cards), "collection" moves
+        them to the start of the new queue and shifts all other new cards.
+        """
+        if gc("general: reposition mode", "targeted") != "collection":
+            return reposition_new_cards(
+                self.db, nidlist, self.mw.col.usn(), intTime(), created)
+        cids = self.db.list(
             "select id from cards where type = 0 and nid in " + ids2str(nidlist))
         if not cids:
-            return
+            return 0
         self.mw.col.sched.sortCards(
             cids, start=0, step=1, shuffle=False, shift=True)
+        return len(cids)
 
 
     def selectNotes(self, browser, nids):
@@ -454,7 +882,7 @@ class Rearranger:
             cids = []
             for nid in nids:
                 nid = self.nid_map.get(nid, nid)
-                cids += self.mw.col.db.list(
+                cids += self.db.list(
                     "select id from cards where nid = ? order by ord", nid)
             browser.model.selectedCards = {cid: True for cid in cids}
             browser.model.restoreSelection()
@@ -0,0 +1,213 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Row order of the organizer table as an implicit treap (a rope of rows).
+
+Nodes are ordered by position only, each one knows the size of its subtree, so
+that looking up, inserting, removing and moving a block of rows costs O(log n)
+instead of shifting the rest of a Python list. Nodes keep their parent, so the
+current position of a row can be found from its node (see position), which
+stays valid while rows are moved around.
+"""
+
+import random
+
+
+class _Node:
+    __slots__ = ("row", "priority", "size", "left", "right", "parent")
+
+    def __init__(self, row, priority):
+        self.row = row
+        self.priority = priority
+        self.size = 1
+        self.left = None
+        self.right = None
+        self.parent = None
+
+
+def _size(node):
+    return node.size if node is not None else 0
+
+
+def _update(node):
+    node.size = 1 + _size(node.left) + _size(node.right)
+    if node.left is not None:
+        node.left.parent = node
+    if node.right is not None:
+        node.right.parent = node
+
+
+def _split(node, count):
+    """Split into the first count nodes and the rest"""
+    if node is None:
+        return None, None
+    node.parent = None
+    if _size(node.left) < count:
+        left, right = _split(node.right, count - _size(node.left) - 1)
+        node.right = left
+        _update(node)
+        return node, right
+    left, right = _split(node.left, count)
+    node.left = right
+    _update(node)
+    return left, node
+
+
+def _merge(left, right):
+    """Concatenate two trees, all nodes of left come first"""
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _in_order(node):
+    """Nodes of the tree in row order"""
+    stack = []
+    while stack or node is not None:
+        while node is not None:
+            stack.append(node)
+            node = node.left
+        node = stack.pop()
+        yield node
+        node = node.right
+
+
+class RowRope:
+    """Sequence of rows with O(log n) access, insertion, removal and block moves"""
+
+    def __init__(self, rows=()):
+        self._random = random.Random()
+        self.root = self._build(list(rows))
+
+
+    def _build(self, rows):
+        """Balanced tree with heap ordered priorities in O(n log n)"""
+        if not rows:
+            return None
+        priorities = sorted((self._random.random() for _ in rows), reverse=True)
+        nodes = [None] * len(rows)
+        # assign the priorities level by level so that parents get bigger ones
+        queue = [(0, len(rows))]
+        position = 0
+        while position < len(queue):
+            low, high = queue[position]
+            mid = (low + high) // 2
+            nodes[mid] = _Node(rows[mid], priorities[position])
+            position += 1
+            if low < mid:
+                queue.append((low, mid))
+            if mid + 1 < high:
+                queue.append((mid + 1, high))
+        for low, high in reversed(queue):
+            mid = (low + high) // 2
+            node = nodes[mid]
+            node.left = nodes[(low + mid) // 2] if low < mid else None
+            node.right = nodes[(mid + 1 + high) // 2] if mid + 1 < high else None
+            _update(node)
+        root = nodes[len(rows) // 2]
+        root.parent = None
+        return root
+
+
+    def __len__(self):
+        return _size(self.root)
+
+
+    def nodes(self):
+        """All nodes in row order"""
+        return _in_order(self.root)
+
+
+    def __iter__(self):
+        for node in self.nodes():
+            yield node.row
+
+
+    def node(self, position):
+        if position < 0:
+            position += len(self)
+        if not 0 <= position < len(self):
+            raise IndexError("row index out of range")
+        node = self.root
+        while True:
+            left = _size(node.left)
+            if position < left:
+                node = node.left
+            elif position == left:
+                return node
+            else:
+                position -= left + 1
+                node = node.right
+
+
+    def __getitem__(self, position):
+        return self.node(position).row
+
+
+    def position(self, node):
+        """Current position of node"""
+        position = _size(node.left)
+        while node.parent is not None:
+            if node is node.parent.right:
+                position += _size(node.parent.left) + 1
+            node = node.parent
+        return position
+
+
+    def insert(self, position, rows):
+        """Insert rows in front of position, returns their nodes"""
+        nodes = [_Node(row, self._random.random()) for row in rows]
+        middle = None
+        for node in nodes:
+            middle = _merge(middle, node)
+        left, right = _split(self.root, position)
+        self.root = _merge(_merge(left, middle), right)
+        self.root.parent = None
+        return nodes
+
+
+    def delete(self, start, stop):
+        """Remove the rows from start to stop (exclusive), returns their nodes"""
+        left, rest = _split(self.root, start)
+        middle, right = _split(rest, stop - start)
+        self.root = _merge(left, right)
+        if self.root is not None:
+            self.root.parent = None
+        return list(_in_order(middle))
+
+
+    def move(self, start, stop, destination):
+        """Move the rows from start to stop (exclusive) in front of destination
+
+        destination is a position before the move and must not be inside the
+        block, i.e. destination <= start or destination >= stop.
+        """
+        if start < destination < stop:
+            raise ValueError("destination inside the moved rows")
+        if destination >= stop:
+            # a block c d -> a c b d
+            a, rest = _split(self.root, start)
+            b, rest = _split(rest, stop - start)
+            c, d = _split(rest, destination - stop)
+            self.root = _merge(_merge(a, c), _merge(b, d))
+        else:
+            # a c b d -> a b c d
+            a, rest = _split(self.root, destination)
+            c, rest = _split(rest, start - destination)
+            b, d = _split(rest, stop - start)
+            self.root = _merge(_merge(a, b), _merge(c, d))
+        if self.root is not None:
+            self.root.parent = None
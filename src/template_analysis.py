@@ -0,0 +1,177 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Small mustache parser for card templates that finds out which fields must be
+filled so that card 1 of a note type is generated.
+
+Anki generates a card if its front template contains at least one reference to
+a non-empty field once the conditional sections ({{#Field}}...{{/Field}} and
+{{^Field}}...{{/Field}}) are resolved. Cloze note types instead need a cloze
+deletion with the card number in a field that is used with the cloze filter.
+"""
+
+from itertools import combinations
+import re
+
+
+MODEL_CLOZE = 1
+
+# fields that are always available and don't make a card non-empty
+SPECIAL_FIELDS = {"FrontSide", "Tags", "Type", "Deck", "Subdeck", "Card", "CardFlag", "CardID"}
+
+# don't try all combinations for templates with very many fields
+MAX_CANDIDATES = 12
+
+CLOZE_VALUE = "{{c1::.}}"
+
+tag_re = re.compile(r"{{(.*?)}}", re.DOTALL)
+
+
+class TemplateError(Exception):
+    pass
+
+
+def parse_template(text):
+    """Return the template as nested nodes
+
+    - ("text", str)
+    - ("field", name, [filters])
+    - ("section", name, inverted, [nodes])
+    """
+    root = []
+    stack = [(None, root)]
+    pos = 0
+    for match in tag_re.finditer(text):
+        if match.start() > pos:
+            stack[-1][1].append(("text", text[pos:match.start()]))
+        pos = match.end()
+        tag = match.group(1).strip()
+        if not tag or tag.startswith("!"):
+            continue
+        if tag[0] in "#^":
+            children = []
+            name = tag[1:].strip()
+            stack[-1][1].append(("section", name, tag[0] == "^", children))
+            stack.append((name, children))
+        elif tag[0] == "/":
+            name = tag[1:].strip()
+            if len(stack) == 1 or stack[-1][0] != name:
+                raise TemplateError("unbalanced section {}".format(name))
+            stack.pop()
+        else:
+            parts = [p.strip() for p in tag.split(":")]
+            stack[-1][1].append(("field", parts[-1], parts[:-1]))
+    if len(stack) != 1:
+        raise TemplateError("unclosed section {}".format(stack[-1][0]))
+    if pos < len(text):
+        root.append(("text", text[pos:]))
+    return root
+
+
+def referenced_fields(nodes, out=None):
+    """Names of all fields used in nodes, including conditions"""
+    if out is None:
+        out = []
+    for node in nodes:
+        if node[0] == "field":
+            name = node[1]
+        elif node[0] == "section":
+            name = node[1]
+            referenced_fields(node[3], out)
+        else:
+            continue
+        if name not in out and name not in SPECIAL_FIELDS:
+            out.append(name)
+    return out
+
+
+def renders_nonempty(nodes, filled):
+    """Whether a note with only the fields in filled produces this template"""
+    for node in nodes:
+        if node[0] == "field":
+            if node[1] in filled and node[1] not in SPECIAL_FIELDS:
+                return True
+        elif node[0] == "section":
+            name, inverted, children = node[1], node[2], node[3]
+            if (name in filled) != inverted and renders_nonempty(children, filled):
+                return True
+    return False
+
+
+def cloze_fields(nodes, out=None):
+    """Names of the fields used with the cloze filter outside of {{^...}} sections"""
+    if out is None:
+        out = []
+    for node in nodes:
+        if node[0] == "field" and "cloze" in node[2] and node[1] not in out:
+            out.append(node[1])
+        elif node[0] == "section" and not node[2]:
+            cloze_fields(node[3], out)
+    return out
+
+
+def minimal_fields(nodes, field_names):
+    """Smallest set of field names that makes the template non-empty
+
+    Returns None if there is none or if there are too many candidates.
+    """
+    candidates = [name for name in referenced_fields(nodes) if name in field_names]
+    if len(candidates) > MAX_CANDIDATES:
+        return None
+    for size in range(1, len(candidates) + 1):
+        for combo in combinations(candidates, size):
+            if renders_nonempty(nodes, set(combo)):
+                return list(combo)
+    return None
+
+
+def fields_to_fill_for_first_card(model):
+    """Field indexes to fill so that card 1 is generated, or None if unknown
+
+    For cloze note types this is the field that needs a cloze deletion (see
+    CLOZE_VALUE) and the fields of the conditions around it.
+    """
+    field_names = [f["name"] for f in model["flds"]]
+    try:
+        nodes = parse_template(model["tmpls"][0]["qfmt"])
+    except (TemplateError, IndexError, KeyError):
+        return None
+    if model.get("type") == MODEL_CLOZE:
+        for name in cloze_fields(nodes):
+            if name not in field_names:
+                continue
+            # the conditions the cloze field is nested in must be filled as well
+            names = section_path(nodes, name) + [name]
+            return sorted({field_names.index(n) for n in names if n in field_names})
+        return None
+    names = minimal_fields(nodes, field_names)
+    if names is None:
+        return None
+    return sorted(field_names.index(n) for n in names)
+
+
+def cloze_field_indexes(model):
+    """Indexes of the fields used with the cloze filter on the front of card 1"""
+    field_names = [f["name"] for f in model["flds"]]
+    try:
+        nodes = parse_template(model["tmpls"][0]["qfmt"])
+    except (TemplateError, IndexError, KeyError):
+        return []
+    return [field_names.index(n) for n in cloze_fields(nodes) if n in field_names]
+
+
+def section_path(nodes, field):
+    """Names of the {{#...}} sections around the first use of field or None"""
+    for node in nodes:
+        if node[0] == "field" and node[1] == field:
+            return []
+        if node[0] == "section" and not node[2]:
+            found = section_path(node[3], field)
+            if found is not None:
+                return [node[1]] + found
+    return None
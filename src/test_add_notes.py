@@ -0,0 +1,62 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of the notes the Rearranger creates for "New:" and "Dupe:" rows.
+"""
+
+import _shim
+
+from .rearranger import Rearranger
+
+
+def test_new_notes_grouped_by_note_type_and_deck(mw):
+    nids = _shim.populate(mw.col, 6)
+    mw.col.decks.save({"id": 2, "name": "Other", "dyn": 0, "mid": _shim.BASIC_MID})
+    mw.col.db.execute("update cards set did = 2 where nid >= ?", nids[3])
+    rows = []
+    for nid in nids:
+        rows += ["New: Same note type as previous", "New: Cloze", str(nid)]
+    mw.col.save_count = 0
+
+    rearranger = Rearranger()
+    plan = rearranger.plan(rows, None, [])
+    rearranger.execute(plan)
+
+    assert all(creation.created_nid for creation in plan.creations)
+    # the groups (Basic, 1), (Cloze, 1) and (Basic, 2) each save at most the
+    # deck and the note type, however many notes they have
+    assert mw.col.save_count <= 2 * 3
+    for creation in plan.creations:
+        mid, did = mw.col.db.first(
+            "select n.mid, c.did from notes n join cards c on c.nid = n.id where n.id = ?",
+            creation.nid)  # moved to the planned nid after adding
+        assert mid == (_shim.CLOZE_MID if creation.ntype == "Cloze" else _shim.BASIC_MID)
+        assert did == mw.col.db.scalar("select did from cards where nid = ?", creation.source_nid)
+    assert mw.col.db.scalar("select count() from notes") == 18
+
+
+def test_dupes_copy_the_scheduling_by_ord(mw):
+    model = mw.col.models.get(_shim.BASIC_MID)
+    model["tmpls"].append({"name": "Card 2", "ord": 1, "qfmt": "{{Back}}", "afmt": "{{Front}}"})
+    mw.col.models.save(model)
+    nids = _shim.populate(mw.col, 4, cards_per_note=2)
+    mw.col.db.execute(
+        "update cards set type = 2, queue = 2, due = 100 + ord, ivl = 10 + ord, factor = 2500, "
+        "reps = 3, lapses = ord, left = 0 where nid in (?, ?)", nids[1], nids[2])
+    rows = [str(nids[0]), str(nids[1]), "Dupe (sched): {}".format(nids[1]), str(nids[2]),
+            "Dupe (sched): {}".format(nids[2]), "Dupe: {}".format(nids[2]), str(nids[3])]
+
+    rearranger = Rearranger()
+    plan = rearranger.plan(rows, None, [])
+    rearranger.execute(plan)
+
+    sched = "select ord, type, queue, due, ivl, factor, reps, lapses, left from cards where nid = ? order by ord"
+    first, second, plain = plan.creations
+    assert mw.col.db.all(sched, first.nid) == mw.col.db.all(sched, nids[1])
+    assert mw.col.db.all(sched, second.nid) == mw.col.db.all(sched, nids[2])
+    assert [row[:3] for row in mw.col.db.all(sched, plain.nid)] == [(0, 0, 0), (1, 0, 0)]
@@ -0,0 +1,84 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of Rearranger.apply against a shim collection.
+
+Not test_rearranger.py: the add-on imports that one on start, where neither
+pytest nor the shim exist.
+"""
+
+import pytest
+
+import _shim
+
+from . import journal
+from .instrumentation import Cancelled, Progress
+from .rearranger import Rearranger
+
+
+def test_apply(mw, plan_for):
+    nids = _shim.populate(mw.col, 20)
+    rearranger, plan = plan_for(nids)
+    rearranger.apply(plan)
+    planned = [row if isinstance(row, int) else row.nid for row in plan.rows]
+    final = [rearranger.nid_map.get(nid, nid) for nid in planned]
+    assert all(a < b for a, b in zip(final, final[1:]))
+    assert set(mw.col.db.list("select id from notes")) == set(final)
+    assert journal.load() is not None
+
+
+@pytest.mark.parametrize("phase", ["processActions", "adjust_nid_order", "reposition"])
+def test_cancel_rolls_back_everything(mw, plan_for, snapshot, phase):
+    mw.addonManager.config["general: chunk size"] = 2
+    nids = _shim.populate(mw.col, 20)
+    rearranger, plan = plan_for(nids)
+    before = snapshot(mw.col.db)
+
+    def cancel_in_phase(progress):
+        if progress.name == phase:
+            progress.cancelled = True
+
+    with pytest.raises(Cancelled):
+        rearranger.apply(plan, Progress(callback=cancel_in_phase, interval=0))
+    assert snapshot(mw.col.db) == before
+    assert journal.load() is None
+    assert rearranger.nid_index is None and rearranger.nid_map == {}
+    assert not any(creation.created_nid for creation in plan.creations)
+
+    # the same plan can be applied afterwards
+    rearranger.apply(plan)
+    assert len(mw.col.db.list("select id from notes")) == 20 + len(plan.creations) - 1
+
+
+@pytest.mark.parametrize("sortf", [0, 2])
+def test_backup_field(mw, sortf):
+    model = mw.col.models.get(_shim.BASIC_MID)
+    model["sortf"] = sortf
+    mw.col.models.save(model)
+    nids = _shim.populate(mw.col, 6)
+    mw.col.db.execute("update notes set flds = ? where id = ?", "front 4\x1fback\x1f1234", nids[4])
+    rows = [str(nid) for nid in reversed(nids)]
+
+    rearranger = Rearranger()
+    plan = rearranger.plan(rows, None, [])
+    moved = set(plan.nid_plan.moves) - {nids[4]}
+    # onid is the sort field with sortf 2, those notes are saved one by one
+    assert set(plan.field_flushes if sortf else plan.field_updates) == moved
+    assert not (plan.field_updates if sortf else plan.field_flushes)
+    rearranger.execute(plan)
+
+    for old_nid, new_nid in plan.nid_plan.moves.items():
+        flds, sfld = mw.col.db.first("select flds, sfld from notes where id = ?", new_nid)
+        onid = flds.split("\x1f")[2]
+        assert onid == ("1234" if old_nid == nids[4] else str(old_nid))
+        if old_nid in plan.field_flushes:
+            assert sfld == onid
+    # notes that keep their nid keep an empty backup field
+    for flds in mw.col.db.list("select flds from notes where id in ({})".format(
+            ",".join(str(nid) for nid in set(nids) - set(plan.nid_plan.moves)))):
+        assert flds.split("\x1f")[2] == ""
@@ -0,0 +1,129 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of the set-based statements in bulk.py against a shim collection.
+"""
+
+import pytest
+
+import _shim
+
+from .bulk import REM_CARD, REM_NOTE, delete_notes, renumber_notes, reposition_new_cards
+
+
+class Stop(Exception):
+    pass
+
+
+def notes(db):
+    return {nid: (guid, flds) for nid, guid, flds in db.all("select id, guid, flds from notes")}
+
+
+def cards(db):
+    return dict(db.all("select id, nid from cards"))
+
+
+def graves(db, kind):
+    return set(db.list("select oid from graves where type = ?", kind))
+
+
+def test_renumber_notes(mw):
+    db = mw.col.db
+    nids = _shim.populate(mw.col, 10, cards_per_note=2)
+    before_notes, before_cards = notes(db), cards(db)
+    nid_map = {nids[2]: nids[2] + 1, nids[5]: nids[9] + 1000, nids[7]: nids[0] - 5}
+    flds = {nids[5]: "front 5\x1fback\x1f" + str(nids[5])}
+    assert renumber_notes(db, nid_map, -1, 123, flds, chunk_size=2) == 3
+
+    after_notes, after_cards = notes(db), cards(db)
+    assert set(after_notes) == set(nids) - set(nid_map) | set(nid_map.values())
+    for old, new in nid_map.items():
+        assert after_notes[new][0] != before_notes[old][0]  # fresh guid
+        assert after_notes[new][1] == flds.get(old, before_notes[old][1])
+    for cid, nid in before_cards.items():
+        assert after_cards[cid] == nid_map.get(nid, nid)
+    assert graves(db, REM_NOTE) == set(nid_map)
+    assert db.scalar("select count() from notes where mod = 123 and usn = -1") == 3
+
+
+def test_renumber_notes_stopped_in_a_chunk(mw):
+    db = mw.col.db
+    nids = _shim.populate(mw.col, 10)
+    before_notes, before_cards = notes(db), cards(db)
+    nid_map = {nid: nid + 1 for nid in nids[:6]}
+    done = []
+
+    def on_chunk(count):
+        done.append(count)
+        if len(done) == 2:
+            raise Stop()
+
+    with pytest.raises(Stop):
+        renumber_notes(db, nid_map, -1, 123, chunk_size=2, on_chunk=on_chunk)
+    assert done == [2, 2]
+    assert notes(db) == before_notes
+    assert cards(db) == before_cards
+    assert not graves(db, REM_NOTE)
+
+
+def test_delete_notes(mw):
+    db = mw.col.db
+    nids = _shim.populate(mw.col, 5, cards_per_note=2)
+    before_cards = cards(db)
+    assert delete_notes(db, [nids[1], nids[3], 42], -1) == 2
+    assert set(notes(db)) == {nids[0], nids[2], nids[4]}
+    deleted_cards = {cid for cid, nid in before_cards.items() if nid in (nids[1], nids[3])}
+    assert set(cards(db)) == set(before_cards) - deleted_cards
+    assert graves(db, REM_NOTE) == {nids[1], nids[3]}
+    assert graves(db, REM_CARD) == deleted_cards
+    assert delete_notes(db, [], -1) == 0
+
+
+def positions(db):
+    return dict(db.all("select nid, case when odid then odue else due end from cards"))
+
+
+def test_reposition_new_cards(mw):
+    db = mw.col.db
+    a, b, c, d, e = _shim.populate(mw.col, 5)  # positions 1 to 5
+    # a review card and a card in a filtered deck
+    db.execute("update cards set type = 2, due = 700 where nid = ?", e)
+    db.execute("update cards set odid = 5, odue = due, due = -100 where nid = ?", b)
+    changed = reposition_new_cards(db, [c, a, e, d, b], -1, 123)
+    assert positions(db) == {c: 1, a: 2, d: 3, b: 4, e: 700}
+    assert db.scalar("select due from cards where nid = ?", b) == -100
+    assert changed == 4
+    assert reposition_new_cards(db, [c, a, d, b], -1, 123) == 0
+
+
+def test_reposition_keeps_the_rest_of_the_queue(mw):
+    db = mw.col.db
+    a, b, c, d = _shim.populate(mw.col, 4)
+    reposition_new_cards(db, [c, b], -1, 123)
+    assert positions(db) == {a: 1, c: 2, b: 3, d: 4}
+
+
+def test_reposition_created_notes(mw):
+    db = mw.col.db
+    a, b, c = _shim.populate(mw.col, 3)
+    new = c + 500
+    db.execute("insert into notes (id, guid, mid, mod, usn, tags, flds, sfld, csum) "
+               "select ?, 'x', mid, mod, usn, tags, flds, sfld, csum from notes where id = ?", new, a)
+    db.execute("insert into cards values (?, ?, 1, 0, 0, -1, 0, 0, 4, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+               new * 10, new)
+    reposition_new_cards(db, [b, new, a, c], -1, 123, created=[new])
+    assert positions(db) == {b: 1, new: 1, a: 2, c: 3}
+
+
+def test_reposition_keeps_the_distance_of_sibling_cards(mw):
+    db = mw.col.db
+    a, b = _shim.populate(mw.col, 2, cards_per_note=2)
+    db.execute("update cards set due = due + 10 where nid = ? and ord = 1", a)
+    reposition_new_cards(db, [b, a], -1, 123)
+    assert db.list("select due from cards where nid = ? order by ord", b) == [1, 1]
+    assert db.list("select due from cards where nid = ? order by ord", a) == [2, 12]
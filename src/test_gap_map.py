@@ -0,0 +1,119 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of GapMap and NidIndex against brute force over a small range of nids.
+"""
+
+import random
+
+from .gap_map import GapMap
+from .nid_index import NidIndex
+
+
+HIGH = 120
+
+
+def free_runs(used, low, high):
+    runs = []
+    nid = low
+    while nid <= high:
+        if nid in used:
+            nid += 1
+            continue
+        start = nid
+        while nid <= high and nid not in used:
+            nid += 1
+        runs.append((start, nid - 1))
+    return runs
+
+
+def brute_find(used, nid, size, high):
+    for start in range(max(nid, 1), high - size + 2):
+        if all(n not in used for n in range(start, start + size)):
+            return start
+    return None
+
+
+def brute_find_before(used, nid, size, low=1):
+    for end in range(nid, low + size - 2, -1):
+        if all(n not in used for n in range(end - size + 1, end + 1)):
+            return end
+    return None
+
+
+def test_gap_map_matches_brute_force():
+    rng = random.Random(1)
+    for _ in range(100):
+        used = set(rng.sample(range(1, HIGH + 1), rng.randrange(HIGH)))
+        gaps = GapMap(sorted(used), 1, HIGH)
+        for _ in range(30):
+            nid = rng.randrange(1, HIGH + 1)
+            if rng.random() < 0.5:
+                gaps.occupy(nid)
+                used.add(nid)
+            else:
+                gaps.release(nid)
+                used.discard(nid)
+            assert list(gaps) == free_runs(used, 1, HIGH)
+            probe = rng.randrange(1, HIGH + 1)
+            size = rng.randrange(1, 8)
+            assert gaps.find(probe, size) == brute_find(used, probe, size, HIGH)
+            assert gaps.find_before(probe, size) == brute_find_before(used, probe, size)
+            run = gaps.containing(probe)
+            if probe in used:
+                assert run is None
+            else:
+                assert run in free_runs(used, 1, HIGH)
+                assert run[0] <= probe <= run[1]
+
+
+def test_nid_index_matches_brute_force():
+    rng = random.Random(2)
+    for _ in range(100):
+        used = set(rng.sample(range(1, HIGH + 1), rng.randrange(HIGH)))
+        index = NidIndex(used)
+        for _ in range(30):
+            nid = rng.randrange(1, HIGH + 1)
+            op = rng.random()
+            if op < 0.4:
+                index.add(nid)
+                used.add(nid)
+            elif op < 0.8:
+                index.remove(nid)
+                used.discard(nid)
+            elif op < 0.9:
+                new = rng.randrange(1, HIGH + 1)
+                if new not in used:
+                    index.rename(nid, new)
+                    used.discard(nid)
+                    used.add(new)
+            else:
+                removed = rng.sample(range(1, HIGH + 1), 5)
+                added = rng.sample(range(1, HIGH + 1), 5)
+                index.update(added, removed)
+                used = used - set(removed) | set(added)
+            assert list(index) == sorted(used)
+            probe = rng.randrange(1, HIGH + 1)
+            size = rng.randrange(1, 8)
+            assert index.next_free(probe) == brute_find(used, probe, 1, HIGH + 2)
+            assert index.previous_free(probe) == brute_find_before(used, probe, 1, 0)
+            assert index.find_gap(probe, size) == brute_find(used, probe, size, HIGH + size + 1)
+            assert index.find_gap_before(probe, size) == brute_find_before(used, probe, size)
+            assert index.next_used(probe) == min((n for n in used if n > probe), default=None)
+            assert index.previous_used(probe) == max((n for n in used if n < probe), default=None)
+            other = rng.randrange(1, HIGH + 1)
+            assert index.count_between(probe, other) == sum(1 for n in used if probe < n < other)
+
+
+def test_copy_rebuilds_the_gaps():
+    index = NidIndex([1, 2, 3, 10])
+    assert index.find_gap(1, 3) == 4
+    other = index.copy()
+    other.add(5)
+    assert other.find_gap(1, 3) == 6
+    assert index.find_gap(1, 3) == 4
@@ -0,0 +1,64 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of the undo journal: a reorganization followed by Rearranger.revert
+leaves the collection as it was.
+"""
+
+import pytest
+
+import _shim
+
+from . import journal
+from .rearranger import Rearranger
+
+
+def test_journal_round_trip():
+    undo = journal.Journal("profile")
+    undo.nid_map = {1: 2}
+    undo.created = [5]
+    undo.fields = {1: "a\x1fb"}
+    undo.flushed = [1]
+    undo.positions = {7: [3, 0]}
+    again = journal.Journal.from_json(undo.to_json())
+    assert vars(again) == vars(undo)
+
+
+def test_revert(mw, plan_for, snapshot):
+    nids = _shim.populate(mw.col, 12, cards_per_note=2)
+    before = snapshot(mw.col.db)
+    rearranger, plan = plan_for(nids)
+    rearranger.execute(plan)
+    assert plan.nid_plan.moves and plan.deletions
+    assert all(creation.created_nid for creation in plan.creations)
+    assert snapshot(mw.col.db) != before
+
+    undo = journal.load()
+    assert undo is not None and not undo.is_empty()
+    Rearranger().revert(undo)
+    assert snapshot(mw.col.db) == before
+    assert journal.load() is None
+
+
+def test_stale_journal(mw, plan_for):
+    nids = _shim.populate(mw.col, 12)
+    rearranger, plan = plan_for(nids)
+    rearranger.execute(plan)
+    # a renumbered note was deleted since
+    mw.col.remove_notes([next(iter(plan.nid_plan.moves.values()))])
+    with pytest.raises(journal.StaleJournal):
+        Rearranger().revert(journal.load())
+
+
+def test_empty_journal_removes_the_old_one(mw):
+    undo = journal.Journal("shim")
+    undo.created = [1]
+    undo.save()
+    assert journal.load() is not None
+    journal.Journal("shim").save()
+    assert journal.load() is None
@@ -0,0 +1,141 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of the nid planner, run with python -m pytest (see conftest.py).
+"""
+
+from itertools import combinations
+import random
+
+import pytest
+
+from .nid_index import NidIndex
+from .planner import (
+    NoRoom,
+    longest_increasing_subsequence,
+    move_count,
+    plan_nid_order,
+    walk_nids,
+)
+
+
+def shuffled(nids, rng, moves):
+    order = list(nids)
+    for _ in range(moves):
+        order.insert(rng.randrange(len(order)), order.pop(rng.randrange(len(order))))
+    return order
+
+
+def check_plan(nids, existing, plan, floor=0, ceiling=None, headroom=0):
+    """The planned order is valid: increasing, inside the bounds, no collisions"""
+    targets = plan.nidlist
+    assert len(targets) == len(nids)
+    assert all(a < b for a, b in zip(targets, targets[1:]))
+    assert all(t > floor for t in targets)
+    if ceiling is not None:
+        assert all(t < ceiling for t in targets)
+    kept = {old for old in nids if old is not None} - set(plan.moves)
+    planned = [new for old, new in zip(nids, targets) if old != new]
+    for new in planned:
+        assert new not in existing
+        assert all(abs(new - other) > headroom for other in kept | set(targets) if other != new)
+    assert plan.fixed == len(nids) - len(plan.moves)
+
+
+def test_lis_matches_brute_force():
+    rng = random.Random(1)
+    for _ in range(300):
+        values = [rng.randrange(12) for _ in range(rng.randrange(9))]
+        positions = longest_increasing_subsequence(values)
+        picked = [values[pos] for pos in positions]
+        assert positions == sorted(positions)
+        assert all(a < b for a, b in zip(picked, picked[1:]))
+        best = max((len(c) for n in range(len(values) + 1) for c in combinations(values, n)
+                    if all(a < b for a, b in zip(c, c[1:]))), default=0)
+        assert len(positions) == best
+
+
+def test_sorted_nids_stay():
+    nids = list(range(1000, 1010))
+    plan = plan_nid_order(nids, NidIndex(nids))
+    assert plan.nidlist == nids
+    assert plan.moves == {}
+
+
+def test_random_orders():
+    rng = random.Random(2)
+    for _ in range(300):
+        existing = sorted(rng.sample(range(1000, 1300), 40))
+        nids = shuffled(existing, rng, rng.randrange(1, 6))
+        for _ in range(rng.randrange(3)):
+            nids.insert(rng.randrange(1, len(nids)), None)  # created notes
+        plan = plan_nid_order(nids, NidIndex(existing))
+        check_plan(nids, set(existing), plan)
+
+
+def test_never_worse_than_walking_the_rows():
+    # swapped neighbours among densely numbered notes
+    existing = list(range(1000, 1040))
+    rng = random.Random(3)
+    for _ in range(200):
+        nids = list(existing)
+        for _ in range(rng.randrange(1, 4)):
+            pos = rng.randrange(len(nids) - 1)
+            nids[pos], nids[pos + 1] = nids[pos + 1], nids[pos]
+        index = NidIndex(existing)
+        plan = plan_nid_order(nids, index)
+        check_plan(nids, set(existing), plan)
+        walked = walk_nids(nids, index)
+        assert len(plan.moves) <= move_count(nids, walked)
+
+
+def test_floor_and_ceiling():
+    rng = random.Random(4)
+    for _ in range(200):
+        existing = sorted(rng.sample(range(1000, 1400), 30))
+        nids = shuffled(existing, rng, 3)
+        floor, ceiling = 900, 1500
+        plan = plan_nid_order(nids, NidIndex(existing), floor=floor, ceiling=ceiling)
+        check_plan(nids, set(existing), plan, floor, ceiling)
+
+
+def test_no_room():
+    existing = [10, 11, 12]
+    with pytest.raises(NoRoom):
+        plan_nid_order([12, 11, 10], NidIndex([9] + existing + [13]), floor=9, ceiling=13)
+
+
+def test_start_outside_floor_and_ceiling():
+    nids = [1600000000002]
+    with pytest.raises(NoRoom):
+        plan_nid_order(nids, NidIndex(nids), start=1600000003, ceiling=1600000000003)
+    with pytest.raises(NoRoom):
+        plan_nid_order(nids, NidIndex(nids), start=1500000000, floor=1600000000000)
+
+
+def test_headroom():
+    rng = random.Random(5)
+    for _ in range(300):
+        existing = sorted(rng.sample(range(1000, 1400), 40))
+        nids = shuffled(existing, rng, rng.randrange(1, 6))
+        headroom = rng.randrange(1, 4)
+        plan = plan_nid_order(nids, NidIndex(existing), headroom=headroom)
+        check_plan(nids, set(existing), plan, headroom=headroom)
+
+
+def test_headroom_between_spread_nids():
+    nids = [113, 120, 116, 123]
+    plan = plan_nid_order(nids, NidIndex(nids), headroom=2)
+    check_plan(nids, set(nids), plan, headroom=2)
+
+
+def test_start_pins_the_first_note():
+    existing = [1500000000000, 1500000001000, 1500000002000]
+    plan = plan_nid_order(existing, NidIndex(existing), start=1400000000)
+    assert plan.nidlist[0] == 1400000000000
+    check_plan(existing, set(existing), plan)
@@ -0,0 +1,75 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of tools/reorganize_collection.py on a closed shim collection.
+"""
+
+import sqlite3
+
+import pytest
+
+import _shim
+
+
+@pytest.fixture
+def offline(tmp_path, monkeypatch):
+    """The tool's module, its copy of the add-on logs to tmp_path"""
+    import reorganize_collection
+    from note_organizer import instrumentation
+    monkeypatch.setattr(instrumentation, "log_path", str(tmp_path / "note_organizer.log"))
+    monkeypatch.setattr(instrumentation.log, "handlers", [])
+    yield reorganize_collection
+    for handler in instrumentation.log.handlers:
+        handler.close()
+
+
+def test_reorganize_closed_collection(offline, tmp_path):
+    path = str(tmp_path / "collection.anki2")
+    col = _shim.ShimCollection(path)
+    nids = _shim.populate(col, 8)
+    col.db.execute("update notes set flds = flds || ? where id = ?", "1234", nids[5])  # stale onid
+    col.close()
+    order = tmp_path / "order.txt"
+    order.write_text("\n".join(
+        [str(nids[2]), str(nids[0]), str(nids[1]), "New: Same note type as previous"]
+        + [str(nid) for nid in nids[3:7]]
+        + ["Dupe: {}".format(nids[5]), "Del: {}".format(nids[7])]))
+
+    assert offline.main([path, str(order), "--reposition"]) == 0
+
+    db = sqlite3.connect(path)
+    fields = [flds.split("\x1f") for flds, in db.execute("select flds from notes order by id")]
+    assert [f[0] for f in fields] == ["front 2", "front 0", "front 1", ".",
+                                      "front 3", "front 4", "front 5", "front 6", "front 5"]
+    # the moved note keeps its original nid, the dupe doesn't inherit one
+    assert fields[0][2] == str(nids[2])
+    assert fields[6][2] == "1234" and fields[8][2] == ""
+    assert db.execute("select count() from cards").fetchone()[0] == 9
+    assert db.execute("select count() from notes where id = ?", (nids[7],)).fetchone()[0] == 0
+    assert db.execute("select count() from graves where oid = ?", (nids[7],)).fetchone()[0] == 1
+    # the new cards are due in row order
+    dues = [due for due, in db.execute(
+        "select c.due from cards c join notes n on c.nid = n.id order by n.id")]
+    assert dues == sorted(dues)
+    db.close()
+
+
+def test_dry_run_changes_nothing(offline, tmp_path, capsys):
+    path = str(tmp_path / "collection.anki2")
+    col = _shim.ShimCollection(path)
+    nids = _shim.populate(col, 4)
+    col.close()
+    order = tmp_path / "order.txt"
+    order.write_text("\n".join(str(nid) for nid in reversed(nids)))
+    with open(path, "rb") as f:
+        before = f.read()
+
+    assert offline.main([path, str(order), "--dry-run"]) == 0
+    assert "[dry run]" in capsys.readouterr().out
+    with open(path, "rb") as f:
+        assert f.read() == before
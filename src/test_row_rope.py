@@ -0,0 +1,73 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of RowRope against a plain list.
+"""
+
+import random
+
+import pytest
+
+from .row_rope import RowRope
+
+
+def check(rope, rows, nodes):
+    assert len(rope) == len(rows)
+    assert list(rope) == rows
+    assert [rope[pos] for pos in range(len(rows))] == rows
+    for row in rows:
+        assert rope.position(nodes[row]) == rows.index(row)
+
+
+def test_matches_a_list():
+    rng = random.Random(1)
+    for _ in range(200):
+        rows = list(range(rng.randrange(40)))
+        rope = RowRope(rows)
+        nodes = {node.row: node for node in rope.nodes()}
+        fresh = len(rows)
+        check(rope, rows, nodes)
+        for _ in range(15):
+            op = rng.random()
+            if op < 0.3:
+                position = rng.randrange(len(rows) + 1)
+                new = list(range(fresh, fresh + rng.randrange(1, 4)))
+                fresh += len(new)
+                for node in rope.insert(position, new):
+                    nodes[node.row] = node
+                rows[position:position] = new
+            elif op < 0.5 and rows:
+                start = rng.randrange(len(rows))
+                stop = rng.randrange(start + 1, len(rows) + 1)
+                removed = rope.delete(start, stop)
+                assert [node.row for node in removed] == rows[start:stop]
+                for row in rows[start:stop]:
+                    del nodes[row]
+                del rows[start:stop]
+            elif rows:
+                start = rng.randrange(len(rows))
+                stop = rng.randrange(start + 1, len(rows) + 1)
+                destination = rng.choice([rng.randrange(start + 1), rng.randrange(stop, len(rows) + 1)])
+                rope.move(start, stop, destination)
+                block = rows[start:stop]
+                if destination >= stop:
+                    rows[destination:destination] = block
+                    del rows[start:stop]
+                else:
+                    del rows[start:stop]
+                    rows[destination:destination] = block
+            check(rope, rows, nodes)
+
+
+def test_negative_index_and_errors():
+    rope = RowRope("abc")
+    assert rope[-1] == "c"
+    with pytest.raises(IndexError):
+        rope[3]
+    with pytest.raises(ValueError):
+        rope.move(0, 2, 1)
@@ -0,0 +1,69 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Tests of the fields new notes need so that card 1 is generated.
+"""
+
+import pytest
+
+from .template_analysis import (
+    MODEL_CLOZE,
+    TemplateError,
+    cloze_field_indexes,
+    fields_to_fill_for_first_card,
+    parse_template,
+)
+
+
+def model(qfmt, fields=("Front", "Back", "Extra"), type=0):
+    return {"type": type, "flds": [{"name": name} for name in fields], "tmpls": [{"qfmt": qfmt}]}
+
+
+def test_plain_fields():
+    assert fields_to_fill_for_first_card(model("{{Front}}")) == [0]
+    assert fields_to_fill_for_first_card(model("<b>{{Back}}</b><br>{{Extra}}")) == [1]
+    assert fields_to_fill_for_first_card(model("no fields")) is None
+    assert fields_to_fill_for_first_card(model("{{Missing}}")) is None
+
+
+def test_sections():
+    # the field is only shown if Extra is filled as well
+    assert fields_to_fill_for_first_card(model("{{#Extra}}{{Back}}{{/Extra}}")) == [1, 2]
+    # shown while Extra is empty
+    assert fields_to_fill_for_first_card(model("{{^Extra}}{{Back}}{{/Extra}}")) == [1]
+    # a section on its own renders nothing
+    assert fields_to_fill_for_first_card(model("{{#Front}}text{{/Front}}{{Back}}")) == [1]
+    assert fields_to_fill_for_first_card(model("{{#Front}}{{Back}}")) is None
+
+
+def test_filters_and_special_fields():
+    assert fields_to_fill_for_first_card(model("{{text:hint:Extra}}")) == [2]
+    assert fields_to_fill_for_first_card(model("{{Tags}}{{Deck}}{{Card}}")) is None
+    assert fields_to_fill_for_first_card(model("{{Tags}}{{#Tags}}{{Back}}{{/Tags}}")) is None
+    assert fields_to_fill_for_first_card(model("{{FrontSide}} {{ Back }} {{! Front }}")) == [1]
+
+
+def test_cloze():
+    cloze = model("{{cloze:Text}}{{#Extra}}{{cloze:Back}}{{/Extra}}",
+                  fields=("Text", "Back", "Extra"), type=MODEL_CLOZE)
+    assert fields_to_fill_for_first_card(cloze) == [0]
+    assert cloze_field_indexes(cloze) == [0, 1]
+    nested = model("{{#Extra}}{{cloze:Back}}{{/Extra}}{{^Text}}{{cloze:Text}}{{/Text}}",
+                   fields=("Text", "Back", "Extra"), type=MODEL_CLOZE)
+    assert fields_to_fill_for_first_card(nested) == [1, 2]
+    assert cloze_field_indexes(nested) == [1]
+    assert fields_to_fill_for_first_card(model("{{Text}}", fields=("Text",), type=MODEL_CLOZE)) is None
+
+
+def test_broken_templates():
+    with pytest.raises(TemplateError):
+        parse_template("{{#Front}}{{/Back}}")
+    with pytest.raises(TemplateError):
+        parse_template("{{#Front}}")
+    assert fields_to_fill_for_first_card(model("{{/Front}}")) is None
+    assert cloze_field_indexes({"flds": [], "tmpls": []}) == []
@@ -0,0 +1,561 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Headless stand-in for the parts of Anki the Rearranger talks to.
+
+The collection is a plain SQLite database with the notes/cards/graves schema,
+wrapped by a thin `col` object that implements just the methods the add-on
+calls. Fake `anki`/`aqt` modules are only installed when the real ones can't
+be imported, so the add-on code can be loaded outside of Anki without its
+package __init__ (which sets up the GUI hooks).
+"""
+
+import importlib.util
+import json
+import os
+import random
+import re
+import sqlite3
+import string
+import sys
+import time
+import types
+
+
+SRC = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+PACKAGE = "note_organizer"
+POINT_VERSION = 50
+
+SCHEMA = """
+create table if not exists notes (
+    id integer primary key, guid text not null, mid integer not null,
+    mod integer not null, usn integer not null, tags text not null,
+    flds text not null, sfld text not null, csum integer not null,
+    flags integer not null default 0, data text not null default ''
+);
+create table if not exists cards (
+    id integer primary key, nid integer not null, did integer not null,
+    ord integer not null, mod integer not null, usn integer not null,
+    type integer not null, queue integer not null, due integer not null,
+    ivl integer not null, factor integer not null, reps integer not null,
+    lapses integer not null, left integer not null,
+    odue integer not null default 0, odid integer not null default 0,
+    flags integer not null default 0, data text not null default ''
+);
+create table if not exists graves (usn integer not null, oid integer not null, type integer not null);
+create table if not exists col (
+    id integer primary key, crt integer not null, mod integer not null,
+    scm integer not null default 0, ver integer not null default 11,
+    dty integer not null default 0, usn integer not null, ls integer not null default 0,
+    conf text not null, models text not null, decks text not null,
+    dconf text not null default '{}', tags text not null default '{}'
+);
+create index if not exists ix_cards_nid on cards (nid);
+"""
+
+BASIC_MID = 1342697561419
+CLOZE_MID = 1342697561420
+DEFAULT_DID = 1
+
+
+def default_models():
+    return {
+        str(BASIC_MID): {
+            "id": BASIC_MID, "name": "Basic", "type": 0, "mod": 1, "sortf": 0, "did": DEFAULT_DID,
+            "flds": [{"name": "Front", "ord": 0}, {"name": "Back", "ord": 1}, {"name": "onid", "ord": 2}],
+            "tmpls": [{"name": "Card 1", "ord": 0, "qfmt": "{{Front}}", "afmt": "{{FrontSide}}<hr id=answer>{{Back}}"}],
+        },
+        str(CLOZE_MID): {
+            "id": CLOZE_MID, "name": "Cloze", "type": 1, "mod": 1, "sortf": 0, "did": DEFAULT_DID,
+            "flds": [{"name": "Text", "ord": 0}, {"name": "Extra", "ord": 1}],
+            "tmpls": [{"name": "Cloze", "ord": 0, "qfmt": "{{cloze:Text}}", "afmt": "{{cloze:Text}}<br>{{Extra}}"}],
+        },
+    }
+
+
+def default_decks():
+    return {str(DEFAULT_DID): {"id": DEFAULT_DID, "name": "Default", "dyn": 0, "mid": BASIC_MID}}
+
+
+class CountingDB:
+    """sqlite3 connection with the DBProxy call style and a statement counter"""
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, isolation_level=None)
+        self.statements = 0
+
+    def _run(self, sql, args):
+        self.statements += 1
+        if len(args) == 1 and isinstance(args[0], (list, tuple)):
+            args = args[0]
+        return self.conn.execute(sql, args)
+
+    def execute(self, sql, *args):
+        return self._run(sql, args).fetchall()
+
+    def executemany(self, sql, rows):
+        self.statements += 1
+        self.conn.executemany(sql, rows)
+
+    def scalar(self, sql, *args):
+        row = self._run(sql, args).fetchone()
+        return row[0] if row else None
+
+    def first(self, sql, *args):
+        return self._run(sql, args).fetchone()
+
+    def all(self, sql, *args):
+        return self._run(sql, args).fetchall()
+
+    def list(self, sql, *args):
+        return [r[0] for r in self._run(sql, args).fetchall()]
+
+    def close(self):
+        self.conn.close()
+
+
+def field_names_in(fmt):
+    return [m.split(":")[-1].strip() for m in re.findall(r"{{([^#^/}]+?)}}", fmt)]
+
+
+class ShimNote:
+    def __init__(self, col, model=None, id=None):
+        self.col = col
+        if id:
+            self.load(id)
+        else:
+            self.id = 0
+            self.guid = guid64()
+            self.mid = model["id"]
+            self.tags = []
+            self.fields = [""] * len(model["flds"])
+            self.usn = col.usn()
+            self.mod = intTime()
+
+    def load(self, id):
+        row = self.col.db.first("select id, guid, mid, mod, usn, tags, flds from notes where id = ?", id)
+        if not row:
+            raise KeyError(id)
+        self.id, self.guid, self.mid, self.mod, self.usn, tags, flds = row
+        self.tags = tags.split()
+        self.fields = flds.split("\x1f")
+
+    def model(self):
+        return self.col.models.get(self.mid)
+
+    note_type = model
+
+    @property
+    def _fmap(self):
+        return {f["name"]: (i, f) for i, f in enumerate(self.model()["flds"])}
+
+    def __contains__(self, key):
+        return key in self._fmap
+
+    def __getitem__(self, key):
+        return self.fields[self._fmap[key][0]]
+
+    def __setitem__(self, key, value):
+        self.fields[self._fmap[key][0]] = value
+
+    def keys(self):
+        return list(self._fmap)
+
+    def flush(self):
+        self.mod = intTime()
+        self.col.db.execute(
+            "insert or replace into notes (id, guid, mid, mod, usn, tags, flds, sfld, csum) "
+            "values (?, ?, ?, ?, ?, ?, ?, ?, 0)",
+            self.id, self.guid, self.mid, self.mod, self.usn, " ".join(self.tags),
+            "\x1f".join(self.fields), self.fields[self.model().get("sortf", 0)])
+
+    def card_ids(self):
+        return self.col.db.list("select id from cards where nid = ? order by ord", self.id)
+
+    def cards(self):
+        return [self.col.getCard(cid) for cid in self.card_ids()]
+
+
+CARD_COLS = ("id", "nid", "did", "ord", "mod", "usn", "type", "queue", "due", "ivl",
+             "factor", "reps", "lapses", "left", "odue", "odid")
+
+
+class ShimCard:
+    def __init__(self, col, id):
+        self.col = col
+        row = col.db.first("select {} from cards where id = ?".format(", ".join(CARD_COLS)), id)
+        if not row:
+            raise KeyError(id)
+        for k, v in zip(CARD_COLS, row):
+            setattr(self, k, v)
+
+    def note(self):
+        return self.col.getNote(self.nid)
+
+    def flush(self):
+        self.mod = intTime()
+        self.col.db.execute(
+            "insert or replace into cards ({}) values ({})".format(
+                ", ".join(CARD_COLS), ", ".join("?" * len(CARD_COLS))),
+            *[getattr(self, k) for k in CARD_COLS])
+
+
+class ShimModels:
+    def __init__(self, col):
+        self.col = col
+
+    def _all(self):
+        return json.loads(self.col.db.scalar("select models from col"))
+
+    def _store(self, models):
+        self.col.db.execute("update col set models = ?", json.dumps(models))
+
+    def all(self):
+        return list(self._all().values())
+
+    def get(self, mid):
+        return self._all().get(str(mid))
+
+    def byName(self, name):
+        for m in self._all().values():
+            if m["name"] == name:
+                return m
+        return None
+
+    by_name = byName
+
+    def current(self):
+        conf = self.col.conf
+        return self.get(conf.get("curModel", BASIC_MID))
+
+    def setCurrent(self, model):
+        conf = self.col.conf
+        conf["curModel"] = model["id"]
+        self.col.conf = conf
+
+    def save(self, model, templates=False):
+        self.col.save_count += 1
+        models = self._all()
+        model["mod"] = intTime()
+        models[str(model["id"])] = model
+        self._store(models)
+
+    def fieldNames(self, model):
+        return [f["name"] for f in model["flds"]]
+
+
+class ShimDecks:
+    def __init__(self, col):
+        self.col = col
+
+    def _all(self):
+        return json.loads(self.col.db.scalar("select decks from col"))
+
+    def get(self, did, default=True):
+        return self._all().get(str(did))
+
+    def select(self, did):
+        conf = self.col.conf
+        conf["curDeck"] = did
+        self.col.conf = conf
+
+    def save(self, deck):
+        self.col.save_count += 1
+        decks = self._all()
+        decks[str(deck["id"])] = deck
+        self.col.db.execute("update col set decks = ?", json.dumps(decks))
+
+    def nameOrNone(self, did):
+        deck = self.get(did)
+        return deck["name"] if deck else None
+
+
+class ShimSched:
+    def __init__(self, col):
+        self.col = col
+
+    def sortCards(self, cids, start=1, step=1, shuffle=False, shift=False):
+        cids = list(cids)
+        if shift:
+            low = self.col.db.scalar(
+                "select min(due) from cards where due >= ? and type = 0 and id not in " + ids2str(cids), start)
+            if low is not None:
+                self.col.db.execute(
+                    "update cards set due = due + ?, mod = ?, usn = ? where id not in {} and due >= ? and queue = 0".format(
+                        ids2str(cids)), len(cids) * step, intTime(), self.col.usn(), low)
+        rows = []
+        for idx, cid in enumerate(cids):
+            rows.append((start + idx * step, intTime(), self.col.usn(), cid))
+        self.col.db.executemany("update cards set due = ?, mod = ?, usn = ? where id = ?", rows)
+
+
+class ShimCollection:
+    """Thin `col` shim over a plain SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = CountingDB(path)
+        self.db.conn.executescript(SCHEMA)
+        if not self.db.scalar("select count() from col"):
+            self.db.execute(
+                "insert into col (id, crt, mod, usn, conf, models, decks) values (1, ?, ?, 0, ?, ?, ?)",
+                intTime(), intTime(),
+                json.dumps({"nextPos": 1, "curModel": BASIC_MID, "curDeck": DEFAULT_DID}),
+                json.dumps(default_models()), json.dumps(default_decks()))
+        self.models = ShimModels(self)
+        self.decks = ShimDecks(self)
+        self.sched = ShimSched(self)
+        self.save_count = 0
+
+    @property
+    def conf(self):
+        return json.loads(self.db.scalar("select conf from col"))
+
+    @conf.setter
+    def conf(self, value):
+        self.db.execute("update col set conf = ?", json.dumps(value))
+
+    def usn(self):
+        return -1
+
+    def reset(self):
+        pass
+
+    def save(self, **kwargs):
+        pass
+
+    def close(self):
+        self.db.close()
+
+    def getNote(self, nid):
+        return ShimNote(self, id=nid)
+
+    get_note = getNote
+
+    def getCard(self, cid):
+        return ShimCard(self, cid)
+
+    get_card = getCard
+
+    def newNote(self, forDeck=True):
+        return ShimNote(self, self.models.current())
+
+    def new_note(self, notetype):
+        return ShimNote(self, notetype)
+
+    def findCards(self, query):
+        mid = re.search(r"mid:(\d+)", query).group(1)
+        return self.db.list(
+            "select c.id from cards c, notes n where c.nid = n.id and n.mid = ? and c.ord = 0", int(mid))
+
+    find_cards = findCards
+
+    def _card_ords(self, note):
+        model = note.model()
+        if model["type"] == 1:
+            ords = sorted({int(n) - 1 for n in re.findall(r"{{c(\d+)::", " ".join(note.fields))})
+            return ords or [0]
+        names = [f["name"] for f in model["flds"]]
+        ords = []
+        for t in model["tmpls"]:
+            for name in field_names_in(t["qfmt"]):
+                if name in names and note.fields[names.index(name)]:
+                    ords.append(t["ord"])
+                    break
+        return ords
+
+    def add_note(self, note, deck_id):
+        ords = self._card_ords(note)
+        if not ords:
+            raise Exception("note would have no cards")
+        if not note.id:
+            note.id = self._next_id("notes")
+        note.usn = self.usn()
+        note.flush()
+        did = deck_id or self.conf.get("curDeck", DEFAULT_DID)
+        conf = self.conf
+        pos = conf["nextPos"]
+        conf["nextPos"] = pos + 1
+        self.conf = conf
+        for o in ords:
+            self.db.execute(
+                "insert into cards values (?, ?, ?, ?, ?, -1, 0, 0, ?, 0, 0, 0, 0, 0, 0, 0, 0, '')",
+                self._next_id("cards"), note.id, did, o, intTime(), pos)
+
+    def addNote(self, note):
+        self.add_note(note, 0)
+
+    def _next_id(self, table):
+        nid = int(time.time() * 1000)
+        highest = self.db.scalar("select max(id) from {}".format(table)) or 0
+        return max(nid, highest + 1)
+
+    def remove_notes(self, nids):
+        nids = list(nids)
+        cids = self.db.list("select id from cards where nid in " + ids2str(nids))
+        self.db.executemany("insert into graves values (-1, ?, 0)", [(c,) for c in cids])
+        self.db.executemany("insert into graves values (-1, ?, 1)", [(n,) for n in nids])
+        self.db.execute("delete from cards where nid in " + ids2str(nids))
+        self.db.execute("delete from notes where id in " + ids2str(nids))
+
+    remNotes = remove_notes
+    _remNotes = remove_notes
+
+
+def populate(col, count, disorder=0.0, cards_per_note=1, seed=0, start=1500000000000, step=1000):
+    """Fill an empty shim collection with `count` Basic notes
+
+    Notes get nids `step` ms apart. Returns the nids in ascending order.
+    """
+    rng = random.Random(seed)
+    nids = [start + i * step for i in range(count)]
+    mod = intTime()
+    notes = []
+    cards = []
+    cid = start
+    for pos, nid in enumerate(nids):
+        notes.append((nid, guid64(), BASIC_MID, mod, 0, "", "front {}\x1fback\x1f".format(pos), "front", 0))
+        for o in range(cards_per_note):
+            cid += 1
+            cards.append((cid, nid, DEFAULT_DID, o, mod, 0, 0, 0, pos + 1, 0, 0, 0, 0, 0, 0, 0, 0, ""))
+    col.db.executemany(
+        "insert into notes (id, guid, mid, mod, usn, tags, flds, sfld, csum) values (?,?,?,?,?,?,?,?,?)", notes)
+    col.db.executemany("insert into cards values ({})".format(",".join("?" * 18)), cards)
+    conf = col.conf
+    conf["nextPos"] = count + 1
+    col.conf = conf
+    return nids
+
+
+def shuffled_order(nids, disorder, seed=0):
+    """Return nids with roughly `disorder` * len(nids) notes moved to random positions"""
+    rng = random.Random(seed)
+    order = list(nids)
+    for _ in range(int(len(order) * disorder)):
+        item = order.pop(rng.randrange(len(order)))
+        order.insert(rng.randrange(len(order) + 1), item)
+    return order
+
+
+# --- fake modules -------------------------------------------------------------
+
+BASE91 = string.ascii_letters + string.digits + "!#$%&()*+,-./:;<=>?@[]^_`{|}~"
+
+
+def guid64():
+    """Like anki.utils.guid64: random 64 bit number in base 91"""
+    num = random.randint(0, 2**64 - 1)
+    out = ""
+    while num:
+        num, i = divmod(num, len(BASE91))
+        out = BASE91[i] + out
+    return out
+
+
+def intTime(scale=1):
+    return int(time.time() * scale)
+
+
+def ids2str(ids):
+    return "(%s)" % ",".join(str(i) for i in ids)
+
+
+class FakeAddonManager:
+    def __init__(self, config):
+        self.config = config
+
+    def getConfig(self, module):
+        return self.config
+
+    def addonFromModule(self, module):
+        return PACKAGE
+
+
+class FakeMW:
+    def __init__(self, col, config):
+        self.col = col
+        self.addonManager = FakeAddonManager(config)
+        self.pm = types.SimpleNamespace(name="shim", addonFolder=lambda: os.path.dirname(col.path))
+
+    def checkpoint(self, name):
+        pass
+
+    def reset(self):
+        pass
+
+
+def install_fake_modules():
+    """Make `anki` and `aqt` importable; only fakes what isn't installed"""
+    try:
+        import anki.utils  # noqa
+    except ImportError:
+        anki = types.ModuleType("anki")
+        anki.__path__ = []
+        errors = types.ModuleType("anki.errors")
+        errors.AnkiError = Exception
+        utils = types.ModuleType("anki.utils")
+        utils.guid64 = guid64
+        utils.intTime = intTime
+        utils.int_time = intTime
+        utils.ids2str = ids2str
+        utils.pointVersion = lambda: POINT_VERSION
+        utils.point_version = lambda: POINT_VERSION
+        hooks = types.ModuleType("anki.hooks")
+        hooks.addHook = hooks.remHook = hooks.runHook = lambda *a, **k: None
+        hooks.wrap = lambda old, new, pos="after": old
+        anki.errors, anki.utils, anki.hooks = errors, utils, hooks
+        sys.modules.update({"anki": anki, "anki.errors": errors, "anki.utils": utils, "anki.hooks": hooks})
+    try:
+        import aqt  # noqa
+    except ImportError:
+        aqt = types.ModuleType("aqt")
+        aqt.__path__ = []
+        aqt.mw = None
+        utils = types.ModuleType("aqt.utils")
+        utils.tooltip = lambda *a, **k: None
+        aqt.utils = utils
+        sys.modules.update({"aqt": aqt, "aqt.utils": utils})
+
+
+def load_package(name=PACKAGE):
+    """Import the add-on's source folder as a package without running its __init__"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(SRC, "__init__.py"), submodule_search_locations=[SRC])
+    pkg = importlib.util.module_from_spec(spec)
+    sys.modules[name] = pkg
+    return pkg
+
+
+def setup(path, config=None, package=PACKAGE):
+    """Open (or create) a shim collection at path and point aqt.mw at it"""
+    install_fake_modules()
+    return attach(ShimCollection(path), config, package)
+
+
+def attach(col, config=None, package=PACKAGE):
+    """Point aqt.mw and the mw of the loaded add-on modules at a FakeMW for col
+
+    package is the name the source folder was loaded as, see load_package.
+    """
+    install_fake_modules()
+    if config is None:
+        with open(os.path.join(SRC, "config.json")) as f:
+            config = json.load(f)
+    mw = FakeMW(col, config)
+    import aqt
+    aqt.mw = mw
+    load_package(package)
+    for mod in list(sys.modules):
+        if mod.startswith(package + "."):
+            m = sys.modules[mod]
+            if hasattr(m, "mw"):
+                m.mw = mw
+    return mw
@@ -0,0 +1,202 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Headless benchmark of the Rearranger against synthetic collections.
+
+Runs without Anki: the collection is a plain SQLite file behind the thin `col`
+shim from _shim.py. For every collection size the phases of
+Rearranger.execute are timed separately, together with the number of SQL
+statements and the peak of the memory allocated by Python.
+
+    python tools/bench_rearranger.py
+    python tools/bench_rearranger.py --sizes 1000 10000 --disorder 0.2 --json result.json
+    python tools/bench_rearranger.py --compare result.json   # exit code 1 on regressions
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import _shim
+
+
+PHASES = ("plan", "processActions", "adjust_nid_order", "reposition")
+
+
+class Measure:
+    """Time, statement count and (with trace) memory peak of a block
+
+    tracemalloc slows down allocations a lot, so times are only meaningful
+    from a run without trace.
+    """
+
+    def __init__(self, db, trace=False):
+        self.db = db
+        self.trace = trace
+        self.peak = 0
+
+    def __enter__(self):
+        self.statements = self.db.statements
+        if self.trace:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        # one transaction like in Anki, the shim connection would commit every statement
+        self.db.execute("begin")
+        return self
+
+    def __exit__(self, *exc):
+        self.db.execute("rollback" if exc[0] is not None else "commit")
+        self.seconds = time.perf_counter() - self.started
+        if self.trace:
+            self.peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        self.statements = self.db.statements - self.statements
+        return False
+
+    def result(self):
+        return {"seconds": round(self.seconds, 4), "statements": self.statements,
+                "peak_kib": self.peak // 1024}
+
+
+def make_rows(nids, disorder, creations, deletions, seed):
+    """Organizer rows: nids in a shuffled order plus New/Dupe/Del actions"""
+    rng = random.Random(seed)
+    order = _shim.shuffled_order(nids, disorder, seed)
+    # like NoteTable.moved: notes that aren't where they were
+    moved = [nid for nid, old in zip(order, nids) if nid != old][:int(len(nids) * disorder)]
+    rows = [str(nid) for nid in order]
+    for _ in range(deletions):
+        pos = rng.randrange(len(rows))
+        if rows[pos].isdigit():
+            rows[pos] = "Del: " + rows[pos]
+    for i in range(creations):
+        pos = rng.randrange(1, len(rows))
+        if i % 2:
+            source = rows[pos - 1]
+            if source.isdigit():
+                rows.insert(pos, "Dupe: " + source)
+                continue
+        rows.insert(pos, "New: Basic")
+    return rows, moved
+
+
+def bench_size(size, args):
+    """Times and statements of a run without tracemalloc, memory peaks of a second run"""
+    result = run_phases(size, args, trace=False)
+    traced = run_phases(size, args, trace=True)
+    for phase in PHASES:
+        result[phase]["peak_kib"] = traced[phase]["peak_kib"]
+    return result
+
+
+def run_phases(size, args, trace):
+    result = {"size": size}
+    with tempfile.TemporaryDirectory() as tmp:
+        mw = _shim.setup(os.path.join(tmp, "collection.anki2"))
+        col = mw.col
+        nids = _shim.populate(col, size, cards_per_note=args.cards, seed=args.seed)
+        rows, moved = make_rows(nids, args.disorder, args.creations, args.deletions, args.seed)
+
+        from note_organizer.rearranger import Rearranger
+        card = col.getCard(col.db.scalar("select id from cards order by id limit 1"))
+        rearranger = Rearranger(card=card)
+
+        with Measure(col.db, trace) as m:
+            plan = rearranger.plan(rows, None, moved, repos=True)
+        result["plan"] = m.result()
+        result["renumbered"] = len(plan.renumbered)
+
+        with Measure(col.db, trace) as m:
+            deleted, created = rearranger.processActions(plan)
+        result["processActions"] = m.result()
+
+        with Measure(col.db, trace) as m:
+            modified, nidlist = rearranger.adjust_nid_order(plan, created)
+        result["adjust_nid_order"] = m.result()
+
+        with Measure(col.db, trace) as m:
+            rearranger.reposition(nidlist)
+        result["reposition"] = m.result()
+
+        ordered = col.db.list("select id from notes order by id")
+        result["notes_after"] = len(ordered)
+        col.close()
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Messages for phases that got slower or need more statements than in baseline"""
+    old = {r["size"]: r for r in baseline}
+    problems = []
+    for result in results:
+        before = old.get(result["size"])
+        if not before:
+            continue
+        for phase in PHASES:
+            if phase not in before:
+                continue
+            if result[phase]["statements"] > before[phase]["statements"]:
+                problems.append("{} notes, {}: {} statements instead of {}".format(
+                    result["size"], phase, result[phase]["statements"], before[phase]["statements"]))
+            # ignore noise in very short phases
+            if result[phase]["seconds"] > max(0.25, before[phase]["seconds"] * tolerance):
+                problems.append("{} notes, {}: {:.3f}s instead of {:.3f}s".format(
+                    result["size"], phase, result[phase]["seconds"], before[phase]["seconds"]))
+            if result[phase]["peak_kib"] > max(1024, before[phase]["peak_kib"] * tolerance):
+                problems.append("{} notes, {}: peak {} KiB instead of {} KiB".format(
+                    result["size"], phase, result[phase]["peak_kib"], before[phase]["peak_kib"]))
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[3].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--disorder", type=float, default=0.05,
+                        help="share of the notes moved to a random position")
+    parser.add_argument("--creations", type=int, default=20, help="New/Dupe rows")
+    parser.add_argument("--deletions", type=int, default=20, help="Del rows")
+    parser.add_argument("--cards", type=int, default=1, help="cards per note")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run (--json) to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="allowed factor for time and memory in --compare")
+    args = parser.parse_args(argv)
+
+    results = []
+    print("{:>8} {:<18} {:>9} {:>10} {:>10}".format("notes", "phase", "seconds", "statements", "peak KiB"))
+    for size in args.sizes:
+        result = bench_size(size, args)
+        results.append(result)
+        for phase in PHASES:
+            r = result[phase]
+            print("{:>8} {:<18} {:>9.3f} {:>10} {:>10}".format(
+                size, phase, r["seconds"], r["statements"], r["peak_kib"]))
+        print("{:>8} {} notes renumbered".format("", result["renumbered"]))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            problems = compare(results, json.load(f), args.tolerance)
+        for problem in problems:
+            print("REGRESSION", problem)
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
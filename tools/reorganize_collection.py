@@ -0,0 +1,363 @@
+"""
+This file is part of the Note Organizer add-on for Anki
+
+Copyright:  (c) 2020- ijgnd
+
+License: GNU AGPL, version 3 or later; https://www.gnu.org/licenses/agpl-3.0.en.html
+
+
+Reorganize a collection file without Anki, e.g. for very large shared decks.
+
+The desired order is read line by line in the format of the first column of the
+Organizer, i.e. what the Rearranger parses:
+
+    1580064801573
+    New: Same note type as previous
+    New: Cloze
+    Dupe: 1580064801573
+    Dupe (sched): 1580064801594
+    Del: 1580064837640
+
+The nids are planned with the same code the add-on uses (Rearranger.plan) and
+then applied in one transaction with a few set-based statements. Close Anki
+(or at least the profile) first and keep a backup of the collection.
+
+    python tools/reorganize_collection.py collection.anki2 order.txt
+    some_script | python tools/reorganize_collection.py collection.anki2 - --dry-run
+
+"New" rows need a collection with schema 11 (note types stored as JSON in the
+col table), "Dupe" and "Del" rows work with every schema.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+
+import _shim
+
+_shim.install_fake_modules()  # only if Anki isn't installed
+_shim.load_package()
+from note_organizer import template_analysis  # noqa: E402
+from note_organizer.bulk import delete_notes, renumber_notes, reposition_new_cards  # noqa: E402
+from note_organizer.no_consts import MODEL_SAME  # noqa: E402
+from note_organizer.planner import longest_increasing_subsequence  # noqa: E402
+from note_organizer.rearranger import Rearranger, planned_note_fields  # noqa: E402
+
+
+class OfflineModels:
+    """The parts of `col.models` that Rearranger.plan needs, only for schema 11
+
+    Newer schemas keep the note types in their own tables, then there are none.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._models = None
+
+    def all(self):
+        """{mid: note type}"""
+        if self._models is None:
+            raw = self.db.scalar("select models from col")
+            self._models = {int(mid): m for mid, m in json.loads(raw).items()} if raw else {}
+        return self._models
+
+    def get(self, mid):
+        return self.all().get(mid)
+
+    def byName(self, name):
+        for model in self.all().values():
+            if model["name"] == name:
+                return model
+        return None
+
+
+class OfflineCollection:
+    """The parts of `col` that Rearranger.plan needs, over a closed collection file"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = _shim.CountingDB(path)
+        self.version = self.db.scalar("select ver from col")
+        self.models = OfflineModels(self.db)
+
+    def usn(self):
+        return -1  # local change, sent with the next sync
+
+    def reset(self):
+        pass
+
+    def close(self):
+        self.db.close()
+
+    def _has_config_table(self):
+        return bool(self.db.scalar(
+            "select count() from sqlite_master where type = 'table' and name = 'config'"))
+
+    def next_pos(self):
+        if self._has_config_table():
+            raw = self.db.scalar("select val from config where key = 'nextPos'")
+            return json.loads(raw) if raw else 1
+        return json.loads(self.db.scalar("select conf from col")).get("nextPos", 1)
+
+    def set_next_pos(self, pos):
+        if self._has_config_table():
+            self.db.execute(
+                "update config set val = ?, mtime_secs = ?, usn = ? where key = 'nextPos'",
+                json.dumps(pos).encode(), int(time.time()), self.usn())
+        else:
+            conf = json.loads(self.db.scalar("select conf from col"))
+            conf["nextPos"] = pos
+            self.db.execute("update col set conf = ?", json.dumps(conf))
+
+
+def read_order(stream):
+    """Rows of the desired order, empty lines and lines starting with # are skipped"""
+    rows = []
+    for line in stream:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            rows.append(line)
+    return rows
+
+
+def moved_notes(rows):
+    """Nids of rows that are out of order, in place of NoteTable.moved
+
+    Nobody drags notes around here: the notes outside a longest increasing run
+    of the existing nids are the ones that were moved.
+    """
+    nids = [int(row) for row in rows if row.isdigit()]
+    kept = set(longest_increasing_subsequence(nids))
+    return [nid for pos, nid in enumerate(nids) if pos not in kept]
+
+
+def strip_html(text):
+    return re.sub(r"<[^>]*>", "", text)
+
+
+def field_checksum(field):
+    return int(hashlib.sha1(strip_html(field).encode("utf-8")).hexdigest()[:8], 16)
+
+
+def card_ords(model, fields):
+    """ords of the cards Anki would generate for a new note of model"""
+    if model.get("type") == template_analysis.MODEL_CLOZE:
+        return [0]
+    names = [f["name"] for f in model["flds"]]
+    filled = {name for name, value in zip(names, fields) if value}
+    ords = []
+    for template in model["tmpls"]:
+        try:
+            nodes = template_analysis.parse_template(template["qfmt"])
+        except template_analysis.TemplateError:
+            continue
+        if template_analysis.renders_nonempty(nodes, filled):
+            ords.append(template["ord"])
+    return ords or [0]
+
+
+def new_note_fields(model):
+    """Field contents for a new note, like Rearranger.newNote"""
+    fields = [""] * len(model["flds"])
+    tofill = template_analysis.fields_to_fill_for_first_card(model)
+    if not tofill:
+        fields = ["."] * len(model["flds"])
+    else:
+        for i in tofill:
+            fields[i] = "."
+    if model.get("type") == template_analysis.MODEL_CLOZE:
+        for i in template_analysis.cloze_field_indexes(model):
+            fields[i] = template_analysis.CLOZE_VALUE
+    return fields
+
+
+def write_flushed_fields(col, plan, mod):
+    """Backup fields that change the sort field or the first field (plan.field_flushes)
+
+    Anki would save these notes one by one, here sfld and csum are computed
+    like in create_notes. Call after the renumbering.
+    """
+    rows = []
+    for old_nid, fields in plan.field_flushes.items():
+        nid = plan.nid_plan.moves.get(old_nid, old_nid)
+        model = col.models.get(col.db.scalar("select mid from notes where id = ?", nid))
+        sortf = model.get("sortf", 0) if model else 0
+        rows.append(("\x1f".join(fields), strip_html(fields[sortf]), field_checksum(fields[0]),
+                     mod, col.usn(), nid))
+    if rows:
+        col.db.executemany(
+            "update notes set flds = ?, sfld = ?, csum = ?, mod = ?, usn = ? where id = ?", rows)
+    return len(rows)
+
+
+def create_notes(col, plan, mod):
+    """Insert the new notes of plan directly at their planned nids
+
+    Returns the number of created notes.
+    """
+    db = col.db
+    usn = col.usn()
+    next_cid = (db.scalar("select max(id) from cards") or 0) + 1
+    pos = col.next_pos()
+    notes = []
+    cards = []
+    for creation in plan.creations:
+        # the source might have been renumbered already
+        source_nid = plan.nid_plan.moves.get(creation.source_nid, creation.source_nid)
+        source = db.first("select mid, tags, flds, sfld, csum from notes where id = ?", source_nid)
+        source_cards = db.all(
+            "select ord, odid, did, type, queue, due, ivl, factor, reps, lapses, left "
+            "from cards where nid = ? order by ord", source_nid)
+        if not source or not source_cards:
+            continue
+        did = source_cards[0][1] or source_cards[0][2]  # account for dyn decks
+        if creation.ntype is None:  # dupe
+            mid, tags, flds, sfld, csum = source
+            ords = [c[0] for c in source_cards]
+            model = col.models.get(mid)
+            if model is not None:  # otherwise the fields can't be told apart, copy them
+                fields = planned_note_fields(model, flds.split("\x1f"), creation.nid)
+                flds = "\x1f".join(fields)
+                sfld = strip_html(fields[model.get("sortf", 0)])
+                csum = field_checksum(fields[0])
+        else:
+            if creation.ntype == MODEL_SAME:
+                model = col.models.get(source[0])
+            else:
+                model = col.models.byName(creation.ntype)
+            if model is None:
+                print("skipping {}: unknown note type".format(creation.action), file=sys.stderr)
+                continue
+            fields = planned_note_fields(model, new_note_fields(model), creation.nid)
+            mid, tags = model["id"], source[1]
+            flds = "\x1f".join(fields)
+            sfld = strip_html(fields[model.get("sortf", 0)])
+            csum = field_checksum(fields[0])
+            ords = card_ords(model, fields)
+        notes.append((creation.nid, _shim.guid64(), mid, mod, usn, tags, flds, sfld, csum))
+        scheduling = {c[0]: c[3:] for c in source_cards} if creation.sched else {}
+        for ord in ords:
+            sched = scheduling.get(ord, (0, 0, pos, 0, 0, 0, 0, 0))
+            cards.append((next_cid, creation.nid, did, ord, mod, usn) + tuple(sched))
+            next_cid += 1
+        pos += 1
+        creation.created_nid = creation.nid
+    db.executemany(
+        "insert into notes (id, guid, mid, mod, usn, tags, flds, sfld, csum, flags, data) "
+        "values (?, ?, ?, ?, ?, ?, ?, ?, ?, 0, '')", notes)
+    db.executemany(
+        "insert into cards (id, nid, did, ord, mod, usn, type, queue, due, ivl, factor, "
+        "reps, lapses, left, odue, odid, flags, data) "
+        "values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 0, 0, '')", cards)
+    col.set_next_pos(pos)
+    return len(notes)
+
+
+def reposition(col, nidlist, mod):
+    """Give the new cards of nidlist the first due positions in row order ("collection" mode)
+
+    Like sched.sortCards(cids, start=0, shift=True), the other new cards are
+    shifted behind them.
+    """
+    db = col.db
+    db.execute("drop table if exists temp.no_order")
+    db.execute("create temp table no_order (nid integer primary key, pos integer not null)")
+    db.executemany("insert or ignore into no_order values (?, ?)",
+                   [(nid, pos) for pos, nid in enumerate(nidlist)])
+    cids = db.list(
+        "select c.id from cards c join no_order o on c.nid = o.nid "
+        "where c.type = 0 order by o.pos, c.ord")
+    if cids:
+        db.execute(
+            "update cards set due = due + ?, mod = ?, usn = ? where type = 0 and due >= 0 "
+            "and nid not in (select nid from no_order)", len(cids), mod, col.usn())
+        db.executemany(
+            "update cards set due = ?, mod = ?, usn = ? where id = ?",
+            [(due, mod, col.usn(), cid) for due, cid in enumerate(cids)])
+    db.execute("drop table temp.no_order")
+    return len(cids)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[3].strip(),
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("collection", help="path of a collection.anki2 that isn't open in Anki")
+    parser.add_argument("order", help="file with the desired order, - for stdin")
+    parser.add_argument("--start", type=int,
+                        help="UNIX timestamp the first note should get (like the date in the dialog)")
+    parser.add_argument("--reposition", action="store_true", help="reposition new cards")
+    parser.add_argument("--reposition-mode", choices=("targeted", "collection"), default="targeted",
+                        help="like 'general: reposition mode' in the add-on config")
+    parser.add_argument("--dry-run", action="store_true", help="only print what would change")
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.collection):
+        parser.error("no such file: {}".format(args.collection))
+    if args.order == "-":
+        rows = read_order(sys.stdin)
+    else:
+        with open(args.order, encoding="utf-8") as f:
+            rows = read_order(f)
+
+    col = OfflineCollection(args.collection)
+    try:
+        col.db.execute("begin exclusive")
+    except sqlite3.OperationalError:
+        print("The collection is locked, close Anki first.", file=sys.stderr)
+        return 1
+    _shim.attach(col)  # the Rearranger talks to mw.col
+
+    try:
+        rearranger = Rearranger()
+        plan = rearranger.plan(rows, args.start, moved_notes(rows), repos=args.reposition)
+        if any(c.ntype is not None for c in plan.creations) and not col.models.all():
+            print("New notes need a collection with schema 11, this one has {}.".format(col.version),
+                  file=sys.stderr)
+            col.db.execute("rollback")
+            return 1
+
+        deleted = created = repositioned = 0
+        if not args.dry_run:
+            mod = int(time.time())
+            deleted = delete_notes(col.db, plan.deletions, col.usn())
+            renumber_notes(col.db, plan.nid_plan.moves, col.usn(), mod, plan.field_updates)
+            write_flushed_fields(col, plan, mod)
+            created = create_notes(col, plan, mod)
+            if args.reposition and args.reposition_mode == "collection":
+                repositioned = reposition(col, plan.nid_plan.nidlist, mod)
+            elif args.reposition:
+                repositioned = reposition_new_cards(
+                    col.db, plan.nid_plan.nidlist, col.usn(), mod,
+                    [c.nid for c in plan.creations if c.created_nid])
+            col.db.execute("update col set mod = ?", mod * 1000)
+            col.db.execute("commit")
+        else:
+            col.db.execute("rollback")
+    except Exception:
+        col.db.execute("rollback")
+        raise
+    finally:
+        col.close()
+
+    # same counts as the tooltip of Rearranger.execute
+    print("{}Reorganization {}:".format("[dry run] " if args.dry_run else "",
+                                        "planned" if args.dry_run else "complete"))
+    print("{} note(s) moved".format(len(plan.moved)))
+    print("{} note(s) deleted".format(len(plan.deletions) if args.dry_run else deleted))
+    print("{} note(s) created".format(len(plan.creations) if args.dry_run else created))
+    print("{} note(s) updated alongside".format(len(plan.alongside)))
+    print("{} renumbering(s) avoided".format(plan.nid_plan.saved_writes))
+    if args.reposition:
+        print("{} new card(s) repositioned".format(
+            plan.cards.get("repositioned", 0) if args.dry_run else repositioned))
+    print("{} SQL statements".format(col.db.statements))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())